@@ -0,0 +1,115 @@
+import argparse
+import os
+import sys
+import time
+
+# 端到端吞吐测试: 启动本地模拟服务器，把LeaderboardCrawlController指向它并写入本地mongodb的独立数据库，
+# 运行指定时长后报告仓位轮询的轮次速率、检测延迟与写库吞吐。不连接rabbitmq
+# 用法: python -m benchmark.bench_e2e --traders 5000 --duration 120 --engine async
+
+# 接口地址在导入CrawlConstants时确定，必须先于导入qtr设置环境变量
+pre_parser = argparse.ArgumentParser(add_help=False)
+pre_parser.add_argument("--host", default="127.0.0.1")
+pre_parser.add_argument("--port", type=int, default=18080)
+pre_args, _ = pre_parser.parse_known_args()
+os.environ["QTR_BINANCE_BAPI_BASE_URL"] = "http://%s:%d" % (pre_args.host, pre_args.port)
+
+import pymongo  # noqa: E402
+
+from benchmark.leaderboard_stub_server import add_arguments, make_state, start_server  # noqa: E402
+from qtr.crawl.binance.futures_umargin.leaderboard_crawl_controller import LeaderboardCrawlController  # noqa: E402
+from qtr.utils.crawl_constants import CrawlConstants  # noqa: E402
+from qtr.utils.constants import TradingConstants  # noqa: E402
+
+BENCH_DB_NAME = "bench_binance_crawl_futures_umargin"
+BENCH_SUMMARY_DB_NAME = "bench_binance_crawl_futures_umargin_summary"
+
+
+def percentile(values: list[float], q: float) -> float:
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def detection_latencies(db, population, since: float) -> list[float]:
+    """
+    操作记录的写入时间减去该版本仓位的变动时间，仓位全部平掉时按模拟群体的变动时间计算
+    """
+    latencies = []
+    for op in db["operations"].find({"record_time_stamp": {"$gte": since}},
+                                    {"_id": 0, "uid": 1, "record_time_stamp": 1, "new.update_time": 1}):
+        record_time = op.get("record_time_stamp")
+        update_times = [p.get("update_time") for p in op.get("new", []) if p.get("update_time") is not None]
+        if len(update_times) > 0:
+            change_time = max(update_times) / 1000
+        else:
+            change_time = population.last_change_time(op.get("uid"), record_time)
+        latencies.append(record_time - change_time)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="end to end crawl benchmark against the local stand-in")
+    add_arguments(parser)
+    parser.add_argument("--duration", type=float, default=120)
+    parser.add_argument("--db-url", default=TradingConstants.DEFAULT_DB_URL)
+    parser.add_argument("--engine", default=CrawlConstants.POSITION_ENGINE_ASYNC,
+                        choices=[CrawlConstants.POSITION_ENGINE_SYNC, CrawlConstants.POSITION_ENGINE_ASYNC])
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--rps", type=float, default=50)
+    parser.add_argument("--schedule", action="store_true", help="poll by activity instead of full rounds")
+    parser.add_argument("--writers", type=int, default=CrawlConstants.POSITION_WRITER_COUNT)
+    args = parser.parse_args()
+
+    CrawlConstants.CRAWL_FU_DB_NAME = BENCH_DB_NAME
+    CrawlConstants.CRAWL_FU_SUMMARY_DB_NAME = BENCH_SUMMARY_DB_NAME
+    client = pymongo.MongoClient(args.db_url)
+    client.drop_database(BENCH_DB_NAME)
+    client.drop_database(BENCH_SUMMARY_DB_NAME)
+
+    state = make_state(args)
+    server = start_server(state, args.host, args.port)
+    controller = LeaderboardCrawlController(db_url=args.db_url, rank_interval=0, user_info_interval=0,
+                                            position_engine=args.engine,
+                                            position_concurrency=args.concurrency,
+                                            position_rps=args.rps, position_schedule=args.schedule,
+                                            position_writer_count=args.writers,
+                                            checkpoint_path="")
+    # 测试时不需要rpc控制接口
+    controller.rpc_consumer.setup = lambda: True
+    controller.rpc_consumer.run = lambda: None
+    if not controller.setup():
+        print("controller setup failed")
+        sys.exit(1)
+    start_time = time.time()
+    controller.start_crawl()
+    time.sleep(args.duration)
+    elapsed = time.time() - start_time
+    controller.shutdown()
+
+    position_service = controller.trader_position_crawl_service
+    http_latency = controller.metrics.histogram("http_request_seconds", labels={"endpoint": "position"}).snapshot()
+    latencies = detection_latencies(client[BENCH_DB_NAME], state.population, start_time)
+    write_status = controller.mongo_writer.get_status()
+    print("duration          %.1fs" % elapsed)
+    print("traders           %d (%d sharing)" % (args.traders, len(controller.all_traders)))
+    print("position rounds   %d (%.3f/s)" % (position_service.total_crawl_time,
+                                            position_service.total_crawl_time / elapsed))
+    print("position polls    %d (%.1f/s), p50 %.3fs p99 %.3fs" % (
+        http_latency["count"], http_latency["count"] / elapsed, http_latency["p50"], http_latency["p99"]))
+    print("detections        %d, latency p50 %.2fs p90 %.2fs p99 %.2fs" % (
+        len(latencies), percentile(latencies, 0.5), percentile(latencies, 0.9), percentile(latencies, 0.99)))
+    print("mongo writes      %d ops (%.1f/s), %d batches, avg flush %.4fs" % (
+        write_status["total_ops"], write_status["total_ops"] / elapsed,
+        write_status["total_batches"], write_status["avg_flush_latency"]))
+    print("command queue     " + str({k: v for k, v in controller.position_command_queue.get_status().items()
+                                      if k != "workers"}))
+    print("stub responses    " + str(dict(sorted(state.counts.items()))))
+    server.shutdown()
+    # 爬虫线程不是守护线程，直接退出
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+import argparse
+import gc
+import json
+import sys
+import time
+import tracemalloc
+
+from benchmark.leaderboard_stub_server import TraderPopulation
+from qtr.crawl.binance.futures_umargin.detection_latency_tracker import DetectionLatencyTracker
+from qtr.crawl.binance.futures_umargin.leaderboard_crawl_controller import LeaderboardCrawlController
+from qtr.crawl.binance.futures_umargin.position_history import PositionHistoryWriter
+from qtr.crawl.binance.futures_umargin.trader_position import TraderPosition
+from qtr.crawl.binance.futures_umargin.trader_position_crawl_service import TraderPositionCrawlService
+from qtr.utils import json_codec
+from qtr.utils.json_encoder import TradingObjectEncode
+from qtr.utils.metrics import MetricsRegistry
+
+# 仓位解析、比对、写库文档构建与json编解码等热路径的微基准，带单人规模从1k到100k，
+# 报告耗时与tracemalloc统计的峰值内存。--save保存结果，--compare与保存的结果对比，
+# 任一项耗时或内存退化超过阈值时以非零状态退出，可以放在部署前执行
+# 用法: python -m benchmark.bench_hot_paths --sizes 1000 10000 100000 --compare baseline.json
+
+
+class CollectingWriter(object):
+    # 代替MongoWriteBehind，只统计写入的文档数
+
+    def __init__(self) -> None:
+        self.count = 0
+
+    def insert(self, collection, document: dict):
+        self.count += 1
+
+    def replace(self, collection, filter: dict, document: dict, upsert: bool = True):
+        self.count += 1
+
+
+class FakeController(object):
+    # 提供仓位服务与命令处理所需的controller属性，不连接mongodb与rabbitmq
+
+    def __init__(self) -> None:
+        self.metrics = MetricsRegistry()
+        self.detection_latency = DetectionLatencyTracker(self.metrics)
+        self.position_scheduler = None
+        self.trader_position_mapping: dict[str, list[TraderPosition]] = {}
+        self.mongo_writer = CollectingWriter()
+        self.position_col = None
+        self.position_op_col = None
+        self.position_history_writer = PositionHistoryWriter(self.mongo_writer, None)
+        self.commands: list[dict] = []
+
+    def on_trader_init_position(self, uid: str, positions: list[TraderPosition]):
+        self.commands.append({"name": "new", "uid": uid, "positions": positions})
+
+    def on_trader_position_changed(self, uid: str, old_positions, new_positions, diff_ref: dict):
+        self.commands.append({"name": "diff", "uid": uid, "new": new_positions,
+                              "old": old_positions, "diff": diff_ref})
+
+    def write_position_diff(self, *args):
+        LeaderboardCrawlController.write_position_diff(self, *args)
+
+
+def make_raw_rounds(trader_count: int) -> tuple:
+    """
+    同一群体相隔一小时的两轮原始仓位，所有带单人在两轮之间至少经过一次变动周期
+    """
+    population = TraderPopulation(trader_count, share_ratio=1.0, seed=trader_count, start_time=0)
+    first = {uid: population.positions(uid, 1000.0) for uid in population.uids}
+    second = {uid: population.positions(uid, 1000.0 + 3600) for uid in population.uids}
+    return first, second
+
+
+def case_parse(first: dict, second: dict):
+    def run():
+        # 保留解析结果，峰值内存反映常驻内存中的仓位大小
+        return [TraderPosition.from_raw_list(raw) for raw in first.values()]
+    return run
+
+
+def case_diff(first: dict, second: dict):
+    controller = FakeController()
+    service = TraderPositionCrawlService(controller)
+    initial = {uid: TraderPosition.from_raw_list(raw) for uid, raw in first.items()}
+    updated = {uid: TraderPosition.from_raw_list(raw) for uid, raw in second.items()}
+
+    def run():
+        controller.trader_position_mapping = dict(initial)
+        controller.commands = []
+        for uid, positions in updated.items():
+            service.do_position_diff_check(uid, positions)
+    return run
+
+
+def case_command(first: dict, second: dict):
+    controller = FakeController()
+    service = TraderPositionCrawlService(controller)
+    for uid, raw in first.items():
+        service.do_position_diff_check(uid, TraderPosition.from_raw_list(raw))
+    for uid, raw in second.items():
+        service.do_position_diff_check(uid, TraderPosition.from_raw_list(raw))
+    commands = controller.commands
+
+    def run():
+        for command in commands:
+            LeaderboardCrawlController.handle_position_command(controller, command)
+    return run
+
+
+def case_encode(first: dict, second: dict):
+    mapping = {uid: TraderPosition.from_raw_list(raw) for uid, raw in first.items()}
+
+    def run():
+        # 与分片协调器下发的assign消息相同的结构
+        json.dumps({"type": "assign", "uids": list(mapping.keys()), "positions": mapping},
+                   ensure_ascii=False, cls=TradingObjectEncode)
+    return run
+
+
+def case_codec_encode(first: dict, second: dict):
+    mapping = {uid: TraderPosition.from_raw_list(raw) for uid, raw in first.items()}
+
+    def run():
+        json_codec.dumps({"type": "assign", "uids": list(mapping.keys()), "positions": mapping})
+    return run
+
+
+def case_decode(first: dict, second: dict):
+    bodies = [json.dumps({"success": True, "data": {"otherPositionRetList": raw}}).encode()
+              for raw in first.values()]
+
+    def run():
+        # 与仓位轮询相同: 响应的原始bytes解码后直接构造仓位
+        return [TraderPosition.from_raw_list(json_codec.loads(body)["data"]["otherPositionRetList"])
+                for body in bodies]
+    return run
+
+
+CASES = {
+    "parse": case_parse,
+    "decode": case_decode,
+    "diff": case_diff,
+    "command": case_command,
+    "encode": case_encode,
+    "codec": case_codec_encode
+}
+
+
+def measure(make_case, first: dict, second: dict, rounds: int) -> tuple:
+    run = make_case(first, second)
+    best = float("inf")
+    for _ in range(rounds):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    # 单独一次运行统计内存，tracemalloc的开销不计入耗时
+    gc.collect()
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        for field in ("seconds", "peak_bytes"):
+            if base[field] > 0 and result[field] > base[field] * (1 + threshold):
+                regressions.append("%s %s %.4g -> %.4g (+%.0f%%)" % (
+                    key, field, base[field], result[field], (result[field] / base[field] - 1) * 100))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="hot path micro benchmarks")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--cases", nargs="+", default=list(CASES.keys()), choices=list(CASES.keys()))
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--save", help="write results to this json file")
+    parser.add_argument("--compare", help="compare with results saved by --save")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed regression ratio")
+    args = parser.parse_args()
+
+    results = {}
+    print("%-10s %10s %12s %14s %12s" % ("case", "traders", "total(ms)", "per trader(us)", "peak(MB)"))
+    for size in args.sizes:
+        first, second = make_raw_rounds(size)
+        for name in args.cases:
+            seconds, peak = measure(CASES[name], first, second, args.rounds)
+            results[name + "/" + str(size)] = {"seconds": seconds, "peak_bytes": peak}
+            print("%-10s %10d %12.1f %14.2f %12.2f" % (name, size, seconds * 1e3, seconds / size * 1e6,
+                                                      peak / 1024 / 1024))
+    if args.save is not None:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if len(regressions) > 0:
+            sys.exit(1)
@@ -0,0 +1,67 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# 在新进程中测量启动脚本所导入模块的导入耗时与常驻内存，并列出累计耗时最多的模块
+# --preload可以预先导入指定模块，例如--preload sympy模拟json_encoder在模块加载时导入sympy的旧行为
+# 用法: python -m benchmark.bench_import_time --runs 5
+
+STARTER_MODULES = {
+    "crawl_controller": "qtr.crawl.binance.futures_umargin.leaderboard_crawl_controller",
+    "shard_worker": "qtr.crawl.binance.futures_umargin.position_shard_worker"
+}
+
+CHILD_CODE = """
+import json, resource, sys, time
+start = time.perf_counter()
+for name in %r:
+    __import__(name)
+elapsed = time.perf_counter() - start
+print(json.dumps({"seconds": elapsed, "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  "modules": len(sys.modules), "sympy_loaded": "sympy" in sys.modules}))
+"""
+
+
+def run_once(modules: list[str]) -> dict:
+    output = subprocess.run([sys.executable, "-c", CHILD_CODE % (modules,)],
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def top_imports(modules: list[str], count: int) -> list[tuple]:
+    """
+    解析-X importtime的输出，返回累计耗时最多的模块
+    """
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                             "; ".join(["import " + name for name in modules])],
+                            capture_output=True, text=True, check=True).stderr
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        parts = line[len("import time:"):].split("|")
+        entries.append((int(parts[1].strip()), parts[2].rstrip()))
+    entries.sort(reverse=True)
+    return entries[0: count]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="starter import time and memory")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--preload", nargs="*", default=[], help="modules imported before the starter modules")
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    print("%-18s %12s %12s %10s %8s" % ("starter", "import(ms)", "rss(MB)", "modules", "sympy"))
+    for starter, module in STARTER_MODULES.items():
+        modules = args.preload + [module]
+        samples = [run_once(modules) for _ in range(args.runs)]
+        print("%-18s %12.1f %12.1f %10d %8s" % (
+            starter, statistics.median([s["seconds"] for s in samples]) * 1e3,
+            statistics.median([s["max_rss_kb"] for s in samples]) / 1024,
+            samples[-1]["modules"], samples[-1]["sympy_loaded"]))
+    print("\ntop cumulative imports of crawl_controller (us):")
+    for cumulative, name in top_imports(args.preload + [STARTER_MODULES["crawl_controller"]], args.top):
+        print("%10d %s" % (cumulative, name))
@@ -0,0 +1,75 @@
+import random
+import time
+
+from qtr.crawl.binance.futures_umargin.trader_position import TraderPosition
+
+# 对比逐个查找匹配的旧比对算法与按(symbol, position_side)哈希的新算法
+# 用法: python -m benchmark.bench_position_diff
+
+
+def legacy_diff_position_list(current_list: list[TraderPosition], new_list: list[TraderPosition]):
+    current_positions = current_list[0: len(current_list)]
+    new_positions = new_list[0: len(new_list)]
+    changed_list = []
+    add_list = []
+    for pos in new_list:
+        cp = next((p for p in current_positions if p.is_same_type(pos)), None)
+        if cp is not None:
+            if not cp.is_same_position(pos):
+                changed_list.append((cp, pos))
+            current_positions.remove(cp)
+            new_positions.remove(pos)
+        else:
+            add_list.append(pos)
+    return changed_list, add_list, list(current_positions)
+
+
+def make_positions(count: int, seed: int) -> tuple[list[TraderPosition], list[TraderPosition]]:
+    rnd = random.Random(seed)
+    current = []
+    for i in range(count):
+        current.append(TraderPosition(symbol="SYM" + str(i) + "USDT", leverage=rnd.randint(1, 50),
+                                      amount=rnd.choice([-1, 1]) * rnd.uniform(0.1, 100),
+                                      entry_price=rnd.uniform(1, 1000), update_time=1660000000000 + i))
+    new = []
+    for p in current:
+        r = rnd.random()
+        if r < 0.1:
+            continue  # 平仓
+        if r < 0.3:
+            new.append(TraderPosition(symbol=p.symbol, leverage=p.leverage, amount=p.amount * 2,
+                                      entry_price=p.entry_price, update_time=p.update_time + 1))
+        else:
+            new.append(TraderPosition(symbol=p.symbol, leverage=p.leverage, amount=p.amount,
+                                      entry_price=p.entry_price, update_time=p.update_time))
+    for i in range(count // 10):
+        new.append(TraderPosition(symbol="NEW" + str(i) + "USDT", leverage=10, amount=1,
+                                  entry_price=1, update_time=1660000000000))
+    rnd.shuffle(new)
+    return current, new
+
+
+def bench(func, current, new, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func(current, new)
+    return (time.perf_counter() - start) / rounds
+
+
+def check_same_output(current, new):
+    legacy = legacy_diff_position_list(current, new)
+    fast = TraderPosition.diff_position_list(current, new)
+    for a, b in zip(legacy, fast):
+        assert list(a) == list(b), "diff output mismatch"
+
+
+if __name__ == "__main__":
+    print("%10s %15s %15s %10s" % ("positions", "legacy(us)", "hashed(us)", "speedup"))
+    for count in [5, 20, 50, 100, 500, 2000]:
+        current, new = make_positions(count, count)
+        check_same_output(current, new)
+        rounds = max(3, 20000 // count)
+        legacy_time = bench(legacy_diff_position_list, current, new, rounds)
+        fast_time = bench(TraderPosition.diff_position_list, current, new, rounds)
+        print("%10d %15.1f %15.1f %9.1fx" % (count, legacy_time * 1e6, fast_time * 1e6,
+                                            legacy_time / fast_time))
@@ -0,0 +1,148 @@
+import bisect
+import json
+import random
+import time
+
+from qtr.crawl.binance.futures_umargin.position_history import PositionHistoryReader, PositionHistoryWriter
+from qtr.crawl.binance.futures_umargin.trader_position import TraderPosition
+
+# 对比operations集合的完整格式与position_history增量+关键帧格式的存储大小和重建耗时
+# 用法: python -m benchmark.bench_position_history
+
+try:
+    import bson
+
+    def encoded_size(doc: dict) -> int:
+        return len(bson.encode(doc))
+except ImportError:
+    def encoded_size(doc: dict) -> int:
+        return len(json.dumps(doc, separators=(",", ":")))
+
+
+class CollectingWriter(object):
+    # 代替MongoWriteBehind，只收集写入的文档
+
+    def __init__(self) -> None:
+        self.documents: list[dict] = []
+
+    def insert(self, collection, document: dict):
+        self.documents.append(document)
+
+
+def evolve(rnd: random.Random, positions: list[TraderPosition], t: int) -> list[TraderPosition]:
+    new_positions = []
+    for p in positions:
+        r = rnd.random()
+        if r < 0.1:
+            continue
+        if r < 0.3:
+            p = TraderPosition(symbol=p.symbol, leverage=p.leverage, amount=p.amount * rnd.uniform(0.5, 1.5),
+                               entry_price=p.entry_price * rnd.uniform(0.99, 1.01), update_time=t)
+        new_positions.append(p)
+    if rnd.random() < 0.3 or len(new_positions) == 0:
+        opened = TraderPosition(symbol="SYM" + str(rnd.randint(0, 200)) + "USDT",
+                                leverage=rnd.randint(1, 50), amount=rnd.uniform(-10, 10) or 1,
+                                entry_price=rnd.uniform(1, 1000), update_time=t)
+        # 同一symbol同一方向只会有一个仓位
+        if opened.type_key() not in [p.type_key() for p in new_positions]:
+            new_positions.append(opened)
+    return new_positions
+
+
+def make_full_entry(uid: str, old_positions, new_positions, diff_ref: dict, t: float) -> dict:
+    # 与position_command_handle_task写入operations集合的文档一致
+    return {
+        "record_time": "2022-08-01 00:00:00",
+        "record_time_stamp": t,
+        "uid": uid,
+        "new": TraderPosition.to_document_list(new_positions),
+        "old": TraderPosition.to_document_list(old_positions),
+        "diff": {
+            "removed": TraderPosition.to_document_list(diff_ref["removed"]),
+            "added": [TraderPosition.to_document_list(diff_ref["added"])],
+            "changed": [{"from": c[0].to_document(), "to": c[1].to_document()} for c in diff_ref["changed"]]
+        }
+    }
+
+
+def simulate(trader_count: int, events: int, position_count: int, keyframe_interval: int):
+    rnd = random.Random(trader_count)
+    collector = CollectingWriter()
+    writer = PositionHistoryWriter(collector, None, keyframe_interval)
+    full_docs: dict[str, list[dict]] = {}
+    for i in range(trader_count):
+        uid = "UID%08d" % i
+        positions = [TraderPosition(symbol="SYM" + str(j) + "USDT", leverage=10, amount=1 + j,
+                                    entry_price=100 + j, update_time=0) for j in range(position_count)]
+        writer.on_new(uid, positions, 0.0)
+        full_docs[uid] = []
+        for e in range(1, events + 1):
+            new_positions = evolve(rnd, positions, e)
+            changed, added, removed = TraderPosition.diff_position_list(positions, new_positions)
+            if len(changed) + len(added) + len(removed) == 0:
+                continue
+            diff_ref = {"changed": changed, "added": added, "removed": removed}
+            full_docs[uid].append(make_full_entry(uid, positions, new_positions, diff_ref, float(e)))
+            writer.on_diff(uid, new_positions, diff_ref, float(e))
+            positions = new_positions
+    return full_docs, collector.documents
+
+
+def index_delta_docs(delta_docs: list[dict]):
+    keyframes: dict[str, list[dict]] = {}
+    deltas: dict[str, list[dict]] = {}
+    for doc in delta_docs:
+        target = keyframes if doc["k"] == 1 else deltas
+        target.setdefault(doc["uid"], []).append(doc)
+    return keyframes, deltas
+
+
+def full_positions_at(docs: list[dict], times: list[float], t: float):
+    index = bisect.bisect_right(times, t) - 1
+    return TraderPosition.from_document_list(docs[index]["new"]) if index >= 0 else None
+
+
+def delta_positions_at(keyframes: list[dict], keyframe_times: list[float],
+                       deltas: list[dict], delta_times: list[float], t: float):
+    index = bisect.bisect_right(keyframe_times, t) - 1
+    keyframe = keyframes[index]
+    start = bisect.bisect_right(delta_times, keyframe["t"])
+    end = bisect.bisect_right(delta_times, t)
+    return PositionHistoryReader.reconstruct(keyframe, deltas[start: end])
+
+
+def as_set(positions: list[TraderPosition]):
+    return set([json.dumps(p.to_document(), sort_keys=True) for p in positions])
+
+
+if __name__ == "__main__":
+    print("%8s %8s %12s %12s %8s %14s %14s" % ("traders", "events", "full(KB)", "delta(KB)", "ratio",
+                                              "full_read(us)", "delta_read(us)"))
+    for trader_count, events, position_count in [(100, 100, 5), (100, 500, 20), (50, 1000, 40)]:
+        full_docs, delta_docs = simulate(trader_count, events, position_count, 50)
+        full_size = sum([encoded_size(d) for docs in full_docs.values() for d in docs])
+        delta_size = sum([encoded_size(d) for d in delta_docs])
+        keyframes, deltas = index_delta_docs(delta_docs)
+        rnd = random.Random(1)
+        queries = [(uid, rnd.uniform(1, events)) for uid in full_docs.keys() for _ in range(20)
+                   if len(full_docs[uid]) > 0]
+        prepared = {uid: ([d["record_time_stamp"] for d in full_docs[uid]],
+                          [k["t"] for k in keyframes[uid]],
+                          [d["t"] for d in deltas.get(uid, [])]) for uid in full_docs.keys()}
+        start = time.perf_counter()
+        for uid, t in queries:
+            full_positions_at(full_docs[uid], prepared[uid][0], t)
+        full_read = (time.perf_counter() - start) / len(queries)
+        start = time.perf_counter()
+        for uid, t in queries:
+            delta_positions_at(keyframes[uid], prepared[uid][1], deltas.get(uid, []), prepared[uid][2], t)
+        delta_read = (time.perf_counter() - start) / len(queries)
+        for uid, t in queries[0: 200]:
+            expected = full_positions_at(full_docs[uid], prepared[uid][0], t)
+            if expected is None:
+                continue
+            actual = delta_positions_at(keyframes[uid], prepared[uid][1], deltas.get(uid, []), prepared[uid][2], t)
+            assert as_set(expected) == as_set(actual), "reconstruction mismatch"
+        print("%8d %8d %12.1f %12.1f %7.1fx %14.1f %14.1f" % (
+            trader_count, events, full_size / 1024, delta_size / 1024, full_size / delta_size,
+            full_read * 1e6, delta_read * 1e6))
@@ -0,0 +1,304 @@
+import argparse
+import json
+import math
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from qtr.utils.crawl_constants import CrawlConstants
+
+# 本地模拟的币安leaderboard接口，提供排行榜、战绩、基本信息与仓位四个接口，用于端到端的吞吐测试
+# 带单人的仓位按各自的变动周期随时间演化，变动时间可由TraderPopulation.last_change_time计算，
+# 用于统计检测延迟。支持注入延迟、403/429错误以及按接口限速
+# 用法: python -m benchmark.leaderboard_stub_server --port 18080 --traders 5000
+# 爬虫端设置环境变量 QTR_BINANCE_BAPI_BASE_URL=http://127.0.0.1:18080 后启动
+
+SYMBOLS = ["BTCUSDT", "ETHUSDT", "BNBUSDT", "SOLUSDT", "XRPUSDT", "DOGEUSDT", "ADAUSDT",
+           "AVAXUSDT", "LINKUSDT", "DOTUSDT", "MATICUSDT", "LTCUSDT", "OPUSDT", "ARBUSDT"]
+
+# (占比, 仓位变动周期秒数)
+ACTIVITY_TIERS = [(0.1, 30), (0.3, 300), (0.6, 3600)]
+
+ENDPOINT_PATHS = {
+    urlsplit(CrawlConstants.RANK_URL).path: "rank",
+    urlsplit(CrawlConstants.PERFORMANCE_URL).path: "performance",
+    urlsplit(CrawlConstants.BASEINFO_URL).path: "baseinfo",
+    urlsplit(CrawlConstants.POSITION_URL).path: "position"
+}
+
+# fetch_trader_ranks每轮请求的排行榜数量
+RANK_LIST_COUNT = 24
+
+
+def stable_hash(text: str) -> int:
+    return zlib.crc32(text.encode())
+
+
+class TraderPopulation(object):
+    """
+    确定性的合成带单人群体，相同的参数在不同进程中生成相同的数据，
+    仓位只取决于(uid, 版本号)，版本号随时间按带单人的变动周期递增，因此无需保存状态
+    """
+
+    def __init__(self, trader_count: int, share_ratio: float = 0.5, seed: int = 1,
+                 start_time: float = None) -> None:
+        self.trader_count = trader_count
+        self.seed = seed
+        self.start_time = start_time if start_time is not None else time.time()
+        rnd = random.Random(seed)
+        self.uids: list[str] = []
+        self.shared: dict[str, bool] = {}
+        self.periods: dict[str, float] = {}
+        self.offsets: dict[str, float] = {}
+        for i in range(trader_count):
+            uid = "%032X" % rnd.getrandbits(128)
+            self.uids.append(uid)
+            self.shared[uid] = rnd.random() < share_ratio
+            r = rnd.random()
+            for ratio, period in ACTIVITY_TIERS:
+                if r < ratio:
+                    break
+                r -= ratio
+            self.periods[uid] = period
+            self.offsets[uid] = rnd.uniform(0, period)
+
+    def version(self, uid: str, t: float) -> int:
+        return int(math.floor((t - self.start_time + self.offsets[uid]) / self.periods[uid]))
+
+    def last_change_time(self, uid: str, t: float) -> float:
+        """
+        t时刻之前最近一次仓位变动的时间
+        """
+        return self.start_time - self.offsets[uid] + self.version(uid, t) * self.periods[uid]
+
+    def positions(self, uid: str, t: float) -> list[dict]:
+        version = self.version(uid, t)
+        base = random.Random(stable_hash(uid) ^ self.seed)
+        symbols = base.sample(SYMBOLS, base.randint(1, 5))
+        rnd = random.Random(stable_hash(uid + ":" + str(version)) ^ self.seed)
+        if len(symbols) > 1 and rnd.random() < 0.2:
+            symbols = symbols[:-1]  # 平掉一个仓位
+        change_time = self.last_change_time(uid, t)
+        result = []
+        for symbol in symbols:
+            entry_price = round(base.uniform(0.1, 50000), 4)
+            amount = round(base.choice([-1, 1]) * base.uniform(0.01, 100) * rnd.choice([1, 1, 2, 3]), 4)
+            mark_price = round(entry_price * rnd.uniform(0.95, 1.05), 4)
+            pnl = round((mark_price - entry_price) * amount, 4)
+            update = time.gmtime(change_time)
+            result.append({
+                "symbol": symbol,
+                "entryPrice": entry_price,
+                "markPrice": mark_price,
+                "pnl": pnl,
+                "roe": round(pnl / abs(entry_price * amount) if amount != 0 else 0, 6),
+                "updateTime": [update.tm_year, update.tm_mon, update.tm_mday,
+                               update.tm_hour, update.tm_min, update.tm_sec, 0],
+                "amount": amount,
+                "updateTimeStamp": int(change_time * 1000),
+                "yellow": False,
+                "tradeBefore": False,
+                "leverage": base.randint(1, 50)
+            })
+        return result
+
+    def rank_list(self, payload: dict) -> list[dict]:
+        index = stable_hash(json.dumps(payload, sort_keys=True)) % RANK_LIST_COUNT
+        shared_only = payload.get("isShared", False)
+        result = []
+        for i in range(index, self.trader_count, RANK_LIST_COUNT):
+            uid = self.uids[i]
+            if shared_only and not self.shared[uid]:
+                continue
+            result.append({
+                "futureUid": None,
+                "nickName": "trader-" + uid[0:8],
+                "userPhotoUrl": "",
+                "rank": len(result) + 1,
+                "value": round(random.Random(i).uniform(1000, 100000), 2),
+                "positionShared": self.shared[uid],
+                "twitterUrl": None,
+                "encryptedUid": uid,
+                "updateTime": int(time.time() * 1000),
+                "followerCount": i % 1000,
+                "twShared": False,
+                "isTwTrader": False,
+                "openId": None
+            })
+        return result
+
+    def performance(self, uid: str) -> dict:
+        rnd = random.Random(stable_hash(uid) ^ self.seed)
+        return {
+            "performanceRetList": [{
+                "periodType": period,
+                "statisticsType": statistics,
+                "value": round(rnd.uniform(-1, 5), 6),
+                "rank": rnd.randint(1, 500)
+            } for period in ("DAILY", "WEEKLY", "MONTHLY", "ALL") for statistics in ("ROI", "PNL")],
+            "lastTradeTime": int(self.start_time * 1000)
+        }
+
+    def baseinfo(self, uid: str) -> dict:
+        return {
+            "nickName": "trader-" + uid[0:8],
+            "userPhotoUrl": "",
+            "positionShared": self.shared.get(uid, False),
+            "deliveryPositionShared": False,
+            "followingCount": 0,
+            "followerCount": stable_hash(uid) % 1000,
+            "twitterUrl": None,
+            "introduction": "",
+            "twShared": False,
+            "isTwTrader": False,
+            "openId": None
+        }
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_take(self) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class StubState(object):
+
+    def __init__(self, population: TraderPopulation, latency: float = 0, jitter: float = 0,
+                 error_rate: float = 0, rate_limit: float = 0) -> None:
+        self.population = population
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.buckets: dict[str, TokenBucket] = {}
+        if rate_limit > 0:
+            self.buckets = {name: TokenBucket(rate_limit, max(1, rate_limit))
+                            for name in ENDPOINT_PATHS.values()}
+        self.counts: dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def count(self, key: str):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def handle(self, endpoint: str, payload: dict) -> tuple:
+        """
+        返回(status, headers, body)
+        """
+        if self.latency > 0 or self.jitter > 0:
+            time.sleep(max(0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        bucket = self.buckets.get(endpoint)
+        if bucket is not None and not bucket.try_take():
+            return 429, {"Retry-After": "1"}, {"code": "429", "message": "rate limited"}
+        if self.error_rate > 0 and random.random() < self.error_rate:
+            return random.choice([403, 429]), {}, {"code": "-1", "message": "injected error"}
+        uid = payload.get("encryptedUid")
+        if endpoint == "rank":
+            data = self.population.rank_list(payload)
+        elif uid not in self.population.shared:
+            return 200, {}, {"success": False, "code": "-1", "message": "unknown uid", "data": None}
+        elif endpoint == "performance":
+            data = self.population.performance(uid)
+        elif endpoint == "baseinfo":
+            data = self.population.baseinfo(uid)
+        elif self.population.shared[uid]:
+            now = time.time()
+            data = {
+                "otherPositionRetList": self.population.positions(uid, now),
+                "updateTimeStamp": int(now * 1000)
+            }
+        else:
+            data = {"otherPositionRetList": None, "updateTimeStamp": None}
+        return 200, {}, {"success": True, "code": "000000", "message": None, "data": data}
+
+
+def make_handler(state: StubState):
+
+    class StubRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status: int, headers: dict, body: dict):
+            content = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            if self.path == "/stub/stats":
+                with state.lock:
+                    self.send_json(200, {}, dict(state.counts))
+            else:
+                self.send_json(404, {}, {"message": "not found"})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+            endpoint = ENDPOINT_PATHS.get(urlsplit(self.path).path)
+            if endpoint is None:
+                self.send_json(404, {}, {"message": "not found"})
+                return
+            status, headers, body = state.handle(endpoint, payload)
+            state.count(endpoint + "_" + str(status))
+            self.send_json(status, headers, body)
+
+    return StubRequestHandler
+
+
+def start_server(state: StubState, host: str = "127.0.0.1", port: int = 18080) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--traders", type=int, default=5000)
+    parser.add_argument("--share-ratio", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of 403/429 responses")
+    parser.add_argument("--rate-limit", type=float, default=0, help="requests per second per endpoint, 0 for none")
+
+
+def make_state(args, start_time: float = None) -> StubState:
+    population = TraderPopulation(args.traders, args.share_ratio, args.seed, start_time)
+    return StubState(population, args.latency, args.jitter, args.error_rate, args.rate_limit)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="local binance leaderboard stand-in")
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = start_server(make_state(args), args.host, args.port)
+    print("serving %d traders on http://%s:%d" % (args.traders, args.host, args.port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -13,10 +13,11 @@ class ServiceController(object):
     具体的Service类将负责定制自己的ServiceController
     """
 
-    def __init__(self, mq_url:str, queue_name: str) -> None:
+    def __init__(self, mq_url:str, queue_name: str, rpc_workers: int = 1, rpc_prefetch: int = 1) -> None:
         self.mq_url = mq_url
         self.queue_name = queue_name
-        self.rpc_consumer = RPCMQConsumer(self.mq_url, self.queue_name, self.on_request)
+        self.rpc_consumer = RPCMQConsumer(self.mq_url, self.queue_name, self.on_request,
+                                          rpc_workers, rpc_prefetch)
         pass
 
     def setup(self) -> bool:
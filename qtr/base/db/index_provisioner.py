@@ -0,0 +1,122 @@
+import logging
+import threading
+import time
+import pymongo
+from pymongo.collection import Collection
+
+from qtr.base.nonjsonable import NoneJsonable
+
+LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
+              '-35s %(lineno) -5d: %(message)s')
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.INFO)
+
+
+class IndexSpec(NoneJsonable):
+
+    def __init__(self, collection: Collection, keys: list[tuple], unique: bool = False) -> None:
+        super().__init__()
+        self.collection = collection
+        self.keys = keys
+        self.unique = unique
+        self.state = "declared"  # declared / verified / created / failed
+        self.error: str = None
+
+    def name(self) -> str:
+        return "_".join([str(k) + "_" + str(d) for k, d in self.keys])
+
+
+class MongoIndexProvisioner(NoneJsonable):
+    """
+    各服务在setup()中声明自己查询所需的索引，由provisioner校验并创建缺失的索引。
+    状态中报告每个声明索引的结果，以及未被声明或自服务器启动以来从未被使用的索引
+    """
+
+    def __init__(self, stats_ttl: float = 60) -> None:
+        super().__init__()
+        self.specs: list[IndexSpec] = []
+        self.stats_ttl = stats_ttl
+        self.cached_stats: dict = None
+        self.cached_stats_time: float = 0
+        self.lock = threading.Lock()
+
+    def declare(self, collection: Collection, keys: list[tuple], unique: bool = False):
+        for spec in self.specs:
+            # 多个服务可能声明同一个索引
+            if spec.collection.full_name == collection.full_name and list(spec.keys) == list(keys):
+                return spec
+        spec = IndexSpec(collection, keys, unique)
+        self.specs.append(spec)
+        return spec
+
+    def ensure(self, specs: list[IndexSpec] = None) -> bool:
+        if specs is None:
+            specs = self.specs
+        all_ok = True
+        for spec in specs:
+            try:
+                existing = spec.collection.index_information()
+                found = any([list(info.get("key", [])) == list(spec.keys)
+                             for info in existing.values()])
+                if found:
+                    spec.state = "verified"
+                else:
+                    spec.collection.create_index(spec.keys, unique=spec.unique, background=True)
+                    spec.state = "created"
+                    LOGGER.info("created index " + spec.name() + " on " + spec.collection.full_name)
+            except Exception as ex:
+                spec.state = "failed"
+                spec.error = str(ex)
+                all_ok = False
+                LOGGER.error("ensure index " + spec.name() + " on " +
+                             spec.collection.full_name + " failed " + str(ex))
+        return all_ok
+
+    def collect_index_stats(self) -> dict:
+        """
+        通过$indexStats找出未声明和未使用的索引，结果缓存stats_ttl秒
+        """
+        collections: dict[str, Collection] = {}
+        declared: dict[str, list] = {}
+        for spec in self.specs:
+            collections[spec.collection.full_name] = spec.collection
+            declared.setdefault(spec.collection.full_name, []).append(list(spec.keys))
+        unused = []
+        undeclared = []
+        for full_name, collection in collections.items():
+            try:
+                for stat in collection.aggregate([{"$indexStats": {}}]):
+                    name = stat.get("name")
+                    if name == "_id_":
+                        continue
+                    keys = list(stat.get("key", {}).items())
+                    if keys not in declared[full_name]:
+                        undeclared.append(full_name + "." + name)
+                    if stat.get("accesses", {}).get("ops", 0) == 0:
+                        unused.append(full_name + "." + name)
+            except pymongo.errors.PyMongoError as ex:
+                LOGGER.error("index stats of " + full_name + " failed " + str(ex))
+        return {
+            "unused": unused,
+            "undeclared": undeclared
+        }
+
+    def get_status(self) -> dict:
+        with self.lock:
+            now = time.time()
+            if self.cached_stats is None or now - self.cached_stats_time > self.stats_ttl:
+                self.cached_stats = self.collect_index_stats()
+                self.cached_stats_time = now
+            stats = self.cached_stats
+        return {
+            "declared": [{
+                "collection": spec.collection.full_name,
+                "index": spec.name(),
+                "state": spec.state,
+                "error": spec.error
+            } for spec in self.specs],
+            "missing": [spec.collection.full_name + "." + spec.name()
+                        for spec in self.specs if spec.state in ("declared", "failed")],
+            "unused": stats.get("unused"),
+            "undeclared": stats.get("undeclared")
+        }
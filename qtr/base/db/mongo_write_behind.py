@@ -0,0 +1,307 @@
+import logging
+import threading
+import time
+from pymongo import InsertOne, ReplaceOne, UpdateOne
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from qtr.base.nonjsonable import NoneJsonable
+from qtr.utils.metrics import MetricsRegistry
+
+LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
+              '-35s %(lineno) -5d: %(message)s')
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.INFO)
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+def combine_callbacks(first, second):
+    if first is None:
+        return second
+    if second is None or second is first:
+        return first
+
+    def combined(operation):
+        first(operation)
+        second(operation)
+    return combined
+
+
+class KeyedWrite(NoneJsonable):
+    """
+    按过滤条件合并的写操作，replacement不为None时为整体替换，否则为$set更新。
+    同一文档的多次写入合并成一个操作，写入时才生成pymongo的操作对象，因此与无序bulk_write的执行顺序无关
+    """
+
+    def __init__(self, filter: dict, replacement: dict = None, set_fields: dict = None, upsert: bool = False) -> None:
+        super().__init__()
+        self.filter = filter
+        self.replacement = replacement
+        self.set_fields = set_fields
+        self.upsert = upsert
+
+    def fold(self, newer):
+        """
+        返回先执行self再执行newer的等价操作
+        """
+        if newer.replacement is not None:
+            return newer
+        if self.replacement is not None:
+            replacement = dict(self.replacement)
+            replacement.update(newer.set_fields)
+            return KeyedWrite(self.filter, replacement=replacement, upsert=self.upsert)
+        set_fields = dict(self.set_fields)
+        set_fields.update(newer.set_fields)
+        return KeyedWrite(self.filter, set_fields=set_fields, upsert=self.upsert or newer.upsert)
+
+    def to_operation(self):
+        if self.replacement is not None:
+            return ReplaceOne(self.filter, self.replacement, upsert=self.upsert)
+        return UpdateOne(self.filter, {"$set": self.set_fields}, upsert=self.upsert)
+
+
+class PendingWrites(NoneJsonable):
+    """
+    单个集合待写入的操作。insert按顺序追加，replace与update按过滤条件合并，同一文档只保留一个合并后的操作
+    """
+
+    def __init__(self, collection: Collection) -> None:
+        super().__init__()
+        self.collection = collection
+        self.unkeyed: list[tuple] = []  # (operation, attempts, on_dropped)
+        self.keyed: dict[str, tuple] = {}  # filter key -> (KeyedWrite, attempts, on_dropped)
+
+    def add_keyed(self, key: str, write: KeyedWrite, attempts: int, on_dropped, retry: bool = False) -> bool:
+        """
+        合并同一文档的写操作，retry为True时write是重试的旧操作，排在已有操作之前。返回是否新增了一个key
+        """
+        queued = self.keyed.get(key)
+        if queued is None:
+            self.keyed[key] = (write, attempts, on_dropped)
+            return True
+        queued_write, queued_attempts, queued_on_dropped = queued
+        if retry:
+            self.keyed[key] = (write.fold(queued_write), max(attempts, queued_attempts),
+                               combine_callbacks(on_dropped, queued_on_dropped))
+        else:
+            self.keyed[key] = (queued_write.fold(write), max(attempts, queued_attempts),
+                               combine_callbacks(queued_on_dropped, on_dropped))
+        return False
+
+    def size(self) -> int:
+        return len(self.unkeyed) + len(self.keyed)
+
+
+class MongoWriteBehind(NoneJsonable):
+    """
+    MongoDB的后写(write-behind)管道：写操作先进入内存，由后台线程按数量或时间攒批，
+    以无序bulk_write写入，爬虫线程不再等待数据库往返。
+    部分失败时重复键错误直接丢弃，其他错误重新入队，超过max_retries次后丢弃并计数，
+    写入时可以传入on_dropped回调，操作最终被丢弃时以该操作为参数调用，调用方据此撤销依赖写入成功的内存状态
+    """
+
+    def __init__(self, batch_size: int = 500, flush_interval: float = 1.0,
+                 max_pending: int = 100000, max_retries: int = 3,
+                 metrics: MetricsRegistry = None) -> None:
+        super().__init__()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.pending: dict[str, PendingWrites] = {}
+        self.pending_count = 0
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.running = False
+        self.flush_thread: threading.Thread = None
+        self.total_ops = 0
+        self.total_batches = 0
+        self.total_failed_ops = 0
+        self.total_retried_ops = 0
+        self.total_dropped_ops = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.last_error: str = None
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.metrics.gauge("mongo_write_pending", "operations waiting to be flushed").set_function(
+            lambda: self.pending_count)
+
+    def get_pending(self, collection: Collection) -> PendingWrites:
+        pending = self.pending.get(collection.full_name)
+        if pending is None:
+            pending = PendingWrites(collection)
+            self.pending[collection.full_name] = pending
+        return pending
+
+    def wait_for_space(self):
+        # 只有数据库长时间跟不上时才会阻塞调用方，避免内存无限增长
+        while self.pending_count >= self.max_pending:
+            self.condition.notify_all()
+            self.condition.wait(self.flush_interval)
+
+    def add(self, collection: Collection, operation, key: str = None, attempts: int = 0, on_dropped=None):
+        """
+        key为None时operation为pymongo的操作对象，否则为KeyedWrite
+        """
+        with self.condition:
+            self.wait_for_space()
+            pending = self.get_pending(collection)
+            if key is None:
+                pending.unkeyed.append((operation, attempts, on_dropped))
+                self.pending_count += 1
+            elif pending.add_keyed(key, operation, attempts, on_dropped):
+                self.pending_count += 1
+            if self.pending_count >= self.batch_size:
+                self.condition.notify_all()
+
+    def insert(self, collection: Collection, document: dict, on_dropped=None):
+        # bulk_write会往文档中写入_id，复制一份以免影响调用方
+        self.add(collection, InsertOne(dict(document)), on_dropped=on_dropped)
+
+    def replace(self, collection: Collection, filter: dict, document: dict, upsert: bool = True,
+                on_dropped=None):
+        self.add(collection, KeyedWrite(filter, replacement=dict(document), upsert=upsert),
+                 key=str(sorted(filter.items())), on_dropped=on_dropped)
+
+    def update(self, collection: Collection, filter: dict, update: dict, upsert: bool = False,
+               on_dropped=None):
+        # 只支持顶层字段的$set，才能与同一文档待写入的替换合并
+        set_fields: dict = update.get("$set")
+        if len(update) != 1 or set_fields is None or any(["." in field for field in set_fields.keys()]):
+            raise ValueError("write behind only supports $set of top level fields, got " + str(update))
+        self.add(collection, KeyedWrite(filter, set_fields=dict(set_fields), upsert=upsert),
+                 key=str(sorted(filter.items())), on_dropped=on_dropped)
+
+    def requeue(self, collection: Collection, entries: list[tuple]):
+        dropped: list[tuple] = []
+        with self.condition:
+            pending = self.get_pending(collection)
+            for key, operation, attempts, on_dropped in entries:
+                if attempts > self.max_retries:
+                    self.total_dropped_ops += 1
+                    dropped.append((operation, on_dropped))
+                    continue
+                self.total_retried_ops += 1
+                if key is None:
+                    pending.unkeyed.append((operation, attempts, on_dropped))
+                    self.pending_count += 1
+                elif pending.add_keyed(key, operation, attempts, on_dropped, retry=True):
+                    # 重试期间已有更新的写入时，在重试的操作之后合并新的写入
+                    self.pending_count += 1
+        for operation, on_dropped in dropped:
+            if on_dropped is not None:
+                try:
+                    on_dropped(operation)
+                except Exception as ex:
+                    LOGGER.error(msg="on_dropped callback failed", exc_info=ex)
+
+    def take_pending(self) -> list[PendingWrites]:
+        with self.condition:
+            batches = [p for p in self.pending.values() if p.size() > 0]
+            self.pending = {}
+            self.pending_count = 0
+            self.condition.notify_all()
+            return batches
+
+    def write_batch(self, pending: PendingWrites):
+        entries: list[tuple] = [(None, op, attempts, on_dropped) for op, attempts, on_dropped in pending.unkeyed]
+        entries.extend([(key, op, attempts, on_dropped)
+                        for key, (op, attempts, on_dropped) in pending.keyed.items()])
+        for start in range(0, len(entries), self.batch_size):
+            chunk = entries[start: start + self.batch_size]
+            begin = time.perf_counter()
+            try:
+                pending.collection.bulk_write([e[1] if e[0] is None else e[1].to_operation() for e in chunk],
+                                              ordered=False)
+            except BulkWriteError as bwe:
+                write_errors: list[dict] = bwe.details.get("writeErrors", [])
+                self.total_failed_ops += len(write_errors)
+                retry = [chunk[e.get("index")] for e in write_errors
+                         if e.get("code") != DUPLICATE_KEY_ERROR]
+                self.last_error = str(write_errors[0].get("errmsg")) if len(write_errors) > 0 else str(bwe)
+                LOGGER.error("bulk write to " + pending.collection.full_name + " partially failed, " +
+                             str(len(write_errors)) + " of " + str(len(chunk)) + " ops")
+                self.requeue(pending.collection, [(k, op, attempts + 1, on_dropped)
+                                                  for k, op, attempts, on_dropped in retry])
+            except PyMongoError as ex:
+                self.total_failed_ops += len(chunk)
+                self.last_error = str(ex)
+                LOGGER.error("bulk write to " + pending.collection.full_name + " failed " + str(ex))
+                self.requeue(pending.collection, [(k, op, attempts + 1, on_dropped)
+                                                  for k, op, attempts, on_dropped in chunk])
+            latency = time.perf_counter() - begin
+            self.metrics.histogram("mongo_bulk_write_seconds", "bulk_write latency per batch", {
+                "collection": pending.collection.full_name
+            }).observe(latency)
+            self.total_ops += len(chunk)
+            self.total_batches += 1
+            self.total_flush_latency += latency
+            self.last_flush_latency = latency
+            self.max_flush_latency = max(self.max_flush_latency, latency)
+            self.last_batch_size = len(chunk)
+            self.max_batch_size = max(self.max_batch_size, len(chunk))
+
+    def flush(self):
+        with self.flush_lock:
+            for pending in self.take_pending():
+                self.write_batch(pending)
+
+    def flush_task(self):
+        while self.running:
+            with self.condition:
+                if self.pending_count < self.batch_size:
+                    self.condition.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as ex:
+                LOGGER.error(msg="write behind flush exception", exc_info=ex)
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.flush_thread = threading.Thread(target=self.flush_task, daemon=True)
+        self.flush_thread.start()
+        LOGGER.info("mongo write behind ready")
+
+    def stop(self, timeout: float = 30) -> bool:
+        """
+        停止后台线程并写完所有待写入的操作，失败的操作按重试次数继续重写，直到全部写入或被丢弃。
+        返回是否没有剩余的操作，进程退出前调用
+        """
+        self.running = False
+        with self.condition:
+            self.condition.notify_all()
+        if self.flush_thread is not None:
+            self.flush_thread.join(timeout)
+            self.flush_thread = None
+        deadline = time.time() + timeout
+        while self.pending_count > 0 and time.time() < deadline:
+            self.flush()
+        if self.pending_count > 0:
+            LOGGER.error("mongo write behind stopped with %d pending ops", self.pending_count)
+        else:
+            LOGGER.info("mongo write behind stopped")
+        return self.pending_count == 0
+
+    def get_status(self) -> dict:
+        return {
+            "pending": self.pending_count,
+            "total_ops": self.total_ops,
+            "total_batches": self.total_batches,
+            "total_failed_ops": self.total_failed_ops,
+            "total_retried_ops": self.total_retried_ops,
+            "total_dropped_ops": self.total_dropped_ops,
+            "last_batch_size": self.last_batch_size,
+            "max_batch_size": self.max_batch_size,
+            "avg_batch_size": round(self.total_ops / self.total_batches, 2) if self.total_batches > 0 else 0,
+            "last_flush_latency": round(self.last_flush_latency, 6),
+            "max_flush_latency": round(self.max_flush_latency, 6),
+            "avg_flush_latency": round(self.total_flush_latency / self.total_batches, 6)
+            if self.total_batches > 0 else 0,
+            "last_error": self.last_error
+        }
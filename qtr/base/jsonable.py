@@ -1,5 +1,7 @@
 
 class Jsonable(object):
+    # 允许子类使用__slots__，未声明__slots__的子类仍然拥有__dict__
+    __slots__ = ()
 
     def __init__(self) -> None:
         pass
\ No newline at end of file
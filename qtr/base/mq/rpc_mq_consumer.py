@@ -1,15 +1,16 @@
+import functools
 import pika
 import threading
 import time
 import logging
-import json
+from concurrent.futures import ThreadPoolExecutor
 from typing import Callable
 
 from pika.adapters.blocking_connection import BlockingChannel
 from pika.spec import Basic
 from qtr.base.nonjsonable import NoneJsonable
 from qtr.utils.constants import TradingConstants
-from qtr.utils.json_encoder import TradingObjectEncode
+from qtr.utils import json_codec
 
 LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
               '-35s %(lineno) -5d: %(message)s')
@@ -20,13 +21,21 @@ LOGGER = logging.getLogger(__name__)
 
 class RPCMQConsumer(NoneJsonable):
     """
-    基于RabbitMQ的BlockingChannel封装的RPC模型
+    基于RabbitMQ的BlockingChannel封装的RPC模型。
+    worker_count为1时在连接线程中依次处理请求；大于1时请求交给线程池并发处理，
+    最多同时处理prefetch_count个请求，慢请求不会阻塞其他请求，回复与ack由连接线程执行
     """
 
-    def __init__(self, mq_url: str, queue_name: str, request_handler: Callable) -> None:
+    def __init__(self, mq_url: str, queue_name: str, request_handler: Callable,
+                 worker_count: int = 1, prefetch_count: int = 1) -> None:
         self.mq_url = mq_url
         self.queue_name = queue_name
         self.request_handler = request_handler
+        self.worker_count = worker_count
+        self.prefetch_count = max(prefetch_count, worker_count)
+        self.executor: ThreadPoolExecutor = None
+        if worker_count > 1:
+            self.executor = ThreadPoolExecutor(max_workers=worker_count, thread_name_prefix="rpc-worker")
         self.callback_queue = None
         self.mq_connection: pika.BlockingConnection = None
         self.channel: BlockingChannel = None
@@ -41,7 +50,7 @@ class RPCMQConsumer(NoneJsonable):
             )
             self.channel = self.mq_connection.channel()
             self.channel.queue_declare(queue=self.queue_name)
-            self.channel.basic_qos(prefetch_count=1)
+            self.channel.basic_qos(prefetch_count=self.prefetch_count)
             return True
         except Exception as ex:
             LOGGER.error(str(ex))
@@ -55,7 +64,7 @@ class RPCMQConsumer(NoneJsonable):
         "error": <string | json>
     }
     """
-    def on_request(self, ch: BlockingChannel, method: Basic.Deliver, properties: pika.BasicProperties, body: bytes):
+    def handle_request(self, properties: pika.BasicProperties, body: bytes) -> bytes:
         self.last_message = {
             "time": time.strftime(
                 TradingConstants.TIME_FORMAT, time.localtime(time.time())),
@@ -66,12 +75,11 @@ class RPCMQConsumer(NoneJsonable):
         LOGGER.info("Receive:%s, %s", content_type, body)
         body_object = None
         if content_type == "application/json":
-            body_object = json.loads(body)
+            body_object = json_codec.loads(body)
         else:
             body_object = {
                 "data": body
             }
-        result_str = None
         result = {
             "ok": True,
             "data": None,
@@ -87,12 +95,30 @@ class RPCMQConsumer(NoneJsonable):
             result["ok"] = False
             result["error"] = str(ex)
 
-        result_str = json.dumps(result, ensure_ascii=False, cls=TradingObjectEncode)
+        return json_codec.dumps(result)
 
+    def reply(self, ch: BlockingChannel, method: Basic.Deliver, properties: pika.BasicProperties, result_str: bytes):
+        # 先发送回复再ack，回复发送失败时请求会被重新投递
         ch.basic_publish(exchange='', routing_key=properties.reply_to, properties=pika.BasicProperties(
             correlation_id=properties.correlation_id), body=result_str)
         ch.basic_ack(delivery_tag=method.delivery_tag)
 
+    def handle_request_task(self, connection: pika.BlockingConnection, ch: BlockingChannel,
+                            method: Basic.Deliver, properties: pika.BasicProperties, body: bytes):
+        result_str = self.handle_request(properties, body)
+        try:
+            # pika的连接不是线程安全的，回复与ack交回连接所在的线程执行
+            connection.add_callback_threadsafe(
+                functools.partial(self.reply, ch, method, properties, result_str))
+        except Exception as ex:
+            LOGGER.error(msg="reply after connection closed", exc_info=ex)
+
+    def on_request(self, ch: BlockingChannel, method: Basic.Deliver, properties: pika.BasicProperties, body: bytes):
+        if self.executor is None:
+            self.reply(ch, method, properties, self.handle_request(properties, body))
+            return
+        self.executor.submit(self.handle_request_task, self.mq_connection, ch, method, properties, body)
+
     def consumer_task_thread(self):
         while True:
             try:
@@ -0,0 +1,179 @@
+from __future__ import annotations
+import typing
+if typing.TYPE_CHECKING:
+    from qtr.crawl.binance.futures_umargin.leaderboard_crawl_controller import LeaderboardCrawlController
+
+import logging
+import marshal
+import os
+import threading
+import time
+
+from qtr.base.nonjsonable import NoneJsonable
+from qtr.crawl.binance.futures_umargin.trader_position import TraderPosition
+
+LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
+              '-35s %(lineno) -5d: %(message)s')
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.INFO)
+
+CHECKPOINT_MAGIC = b"QTRCKPT1"
+
+
+class CrawlCheckpoint(NoneJsonable):
+    """
+    爬虫内存状态的本地检查点，用于快速热重启:
+    共享仓位与曾上榜的带单人、共享状态及其来自排行榜的时间、每个带单人最近一次的仓位(紧凑格式)以及轮询调度状态。
+    以marshal编码写入临时文件后原子替换，启动时一次读取即可恢复，检查点中缺失的带单人再从mongodb加载。
+    定期写入之外，controller关闭时再写入一次。库中仓位比检查点新的带单人不从检查点恢复，避免重启后重复记录已写入的变动。
+    marshal格式与python版本相关，版本不匹配或文件损坏时视为没有检查点
+    """
+
+    def __init__(self, controller: LeaderboardCrawlController, path: str, interval: float) -> None:
+        super().__init__()
+        self.controller = controller
+        self.path = path
+        self.interval = interval
+        self.last_save_time: float = None
+        self.last_save_duration = 0.0
+        self.last_size = 0
+        self.last_load_duration: float = None
+        self.restored_positions = 0
+        self.skipped_positions = 0
+        self.total_saves = 0
+        self.last_error: str = None
+        self.save_lock = threading.Lock()  # 定期写入与关闭时的写入共用同一个临时文件
+
+    def collect(self) -> dict:
+        controller = self.controller
+        rank_service = controller.rank_crawl_service
+        # 仓位列表创建后不再修改，复制字典的条目即可得到一致的引用
+        positions = {uid: [p.to_compact() for p in ps]
+                     for uid, ps in list(controller.trader_position_mapping.items()) if ps is not None}
+        return {
+            "time": time.time(),
+            "share_traders": list(controller.all_traders.snapshot()),
+            "crawl_traders": list(rank_service.all_crawl_trader_ids.snapshot()),
+            "share_state": dict(rank_service.trader_share_mapping),
+            "share_seen": dict(rank_service.share_seen_mapping),
+            "positions": positions,
+            "schedule": controller.position_scheduler.export_state()
+            if controller.position_scheduler is not None else None
+        }
+
+    def save(self) -> bool:
+        with self.save_lock:
+            return self.save_locked()
+
+    def save_locked(self) -> bool:
+        begin = time.perf_counter()
+        try:
+            content = CHECKPOINT_MAGIC + marshal.dumps(self.collect())
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            self.last_size = len(content)
+            self.last_save_time = time.time()
+            self.total_saves += 1
+            return True
+        except Exception as ex:
+            self.last_error = str(ex)
+            LOGGER.error(msg="checkpoint save failed", exc_info=ex)
+            return False
+        finally:
+            self.last_save_duration = time.perf_counter() - begin
+
+    def load(self) -> dict:
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, "rb") as f:
+                content = f.read()
+            if not content.startswith(CHECKPOINT_MAGIC):
+                LOGGER.warning("ignore checkpoint with unknown format " + self.path)
+                return None
+            return marshal.loads(content[len(CHECKPOINT_MAGIC):])
+        except Exception as ex:
+            self.last_error = str(ex)
+            LOGGER.error(msg="checkpoint load failed", exc_info=ex)
+            return None
+
+    def find_stale_uids(self, state: dict) -> set[str]:
+        """
+        库中仓位文档的record_time_stamp晚于检查点写入时间的uid，这些带单人的仓位以库中为准
+        """
+        position_col = self.controller.position_col
+        cursor = position_col.find({"record_time_stamp": {"$gt": state.get("time", 0)}}, {"_id": 0, "uid": 1})
+        return set([doc.get("uid") for doc in cursor])
+
+    def restore_positions(self, state: dict, stale: set[str] = None) -> set[str]:
+        """
+        恢复仓位与调度状态，stale中的uid不恢复仓位。共享仓位的带单人在restore_share_state中按最终的共享状态恢复。
+        返回已恢复仓位的uid，其余的由调用方从mongodb加载
+        """
+        begin = time.perf_counter()
+        controller = self.controller
+        if stale is None:
+            stale = set()
+        restored: set[str] = set()
+        for uid, compact_list in state.get("positions", {}).items():
+            if uid in stale:
+                continue
+            controller.trader_position_mapping[uid] = [TraderPosition.from_compact(c) for c in compact_list]
+            restored.add(uid)
+        if controller.position_scheduler is not None and state.get("schedule") is not None:
+            controller.position_scheduler.restore_state(state.get("schedule"))
+        self.restored_positions = len(restored)
+        self.skipped_positions = len(state.get("positions", {})) - len(restored)
+        self.last_load_duration = time.perf_counter() - begin
+        LOGGER.info("restored %d traders' positions from checkpoint in %.3fs, %d newer in db",
+                    self.restored_positions, self.last_load_duration, self.skipped_positions)
+        return restored
+
+    def restore_share_state(self, state: dict):
+        """
+        在排行榜服务从mongodb建立共享状态之后调用，只有检查点比库中该uid的共享状态更新时才以检查点为准。
+        之后按合并后的共享状态核对检查点中的共享带单人，已关闭共享的不再加入轮询
+        """
+        rank_service = self.controller.rank_crawl_service
+        checkpoint_time = state.get("time", 0)
+        rank_service.all_crawl_trader_ids.add_all(state.get("crawl_traders", []))
+        for uid, seen in state.get("share_seen", {}).items():
+            if seen > rank_service.share_seen_mapping.get(uid, 0):
+                rank_service.share_seen_mapping[uid] = seen
+        new_share_traders = [uid for uid, shared in state.get("share_state", {}).items()
+                             if checkpoint_time > rank_service.share_state_time_mapping.get(uid, 0)
+                             and rank_service.update_share_state(uid, shared)]
+        if len(new_share_traders) > 0:
+            self.controller.on_new_traders(new_share_traders)
+        share_traders = state.get("share_traders", [])
+        self.controller.on_new_traders([uid for uid in share_traders if rank_service.trader_share_mapping.get(uid)])
+        for uid in share_traders:
+            if not rank_service.trader_share_mapping.get(uid):
+                self.controller.on_trader_close_share(uid)
+
+    def checkpoint_task(self):
+        while True:
+            time.sleep(self.interval)
+            self.save()
+
+    def start(self):
+        threading.Thread(target=self.checkpoint_task, daemon=True).start()
+        LOGGER.info("crawl checkpoint every %ds to %s", self.interval, self.path)
+
+    def get_status(self) -> dict:
+        return {
+            "path": self.path,
+            "last_save": self.last_save_time,
+            "last_save_duration": round(self.last_save_duration, 6),
+            "last_size": self.last_size,
+            "total_saves": self.total_saves,
+            "last_load_duration": round(self.last_load_duration, 6)
+            if self.last_load_duration is not None else None,
+            "restored_positions": self.restored_positions,
+            "skipped_positions": self.skipped_positions,
+            "last_error": self.last_error
+        }
@@ -0,0 +1,80 @@
+import threading
+
+from qtr.base.nonjsonable import NoneJsonable
+from qtr.utils.metrics import MetricsRegistry
+
+# 检测延迟的分桶，单位为秒，覆盖从秒级到一天
+DETECTION_BUCKETS = (0.5, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 300, 450,
+                     600, 900, 1200, 1800, 2700, 3600, 7200, 14400, 43200, 86400)
+
+
+class DetectionLatencyTracker(NoneJsonable):
+    """
+    统计从币安仓位的updateTimeStamp到爬虫检测到变动的延迟，只统计新增与变动后的仓位(平仓没有对应的时间戳)。
+    按整体、轮询档位和分片分别维护固定分桶的直方图，分位数按分桶插值估算，内存占用与样本数无关
+    """
+
+    OVERALL = "overall"
+    UNSCHEDULED = "unscheduled"  # 未按活跃度调度时的档位
+
+    def __init__(self, metrics: MetricsRegistry, shard: str = "local") -> None:
+        super().__init__()
+        self.metrics = metrics
+        self.shard = shard
+        self.overall = self.histogram(self.OVERALL, self.OVERALL)
+        self.tiers: dict = {}
+        self.shards: dict = {}
+        self.total_negative = 0  # 时间戳晚于检测时间(时钟偏差)的样本，按0计入
+        self.lock = threading.Lock()
+
+    def histogram(self, scope: str, value: str):
+        if scope == self.OVERALL:
+            return self.metrics.histogram("position_detection_seconds",
+                                          "lag from binance updateTimeStamp to diff detection",
+                                          buckets=DETECTION_BUCKETS)
+        return self.metrics.histogram("position_detection_" + scope + "_seconds",
+                                      "detection lag by " + scope, {scope: value},
+                                      buckets=DETECTION_BUCKETS)
+
+    def get_histogram(self, histograms: dict, scope: str, value: str):
+        histogram = histograms.get(value)
+        if histogram is None:
+            with self.lock:
+                histogram = histograms.get(value)
+                if histogram is None:
+                    histogram = self.histogram(scope, value)
+                    histograms[value] = histogram
+        return histogram
+
+    def record_diff(self, diff_ref: dict, detected_at: float, tier: str = None, shard: str = None):
+        lags = [detected_at - p.update_time / 1000 for p in diff_ref.get("added", [])
+                if p.update_time is not None]
+        lags.extend([detected_at - c[1].update_time / 1000 for c in diff_ref.get("changed", [])
+                     if c[1].update_time is not None])
+        if len(lags) == 0:
+            return
+        if min(lags) < 0:
+            self.total_negative += len([lag for lag in lags if lag < 0])
+            lags = [max(0, lag) for lag in lags]
+        self.overall.observe_many(lags)
+        self.get_histogram(self.tiers, "tier", tier if tier is not None else self.UNSCHEDULED).observe_many(lags)
+        self.get_histogram(self.shards, "shard", shard if shard is not None else self.shard).observe_many(lags)
+
+    def summarize(self, histogram) -> dict:
+        snapshot = histogram.snapshot()
+        return {
+            "count": snapshot["count"],
+            "avg": snapshot["avg"],
+            "max": snapshot["max"],
+            "p50": snapshot["p50"],
+            "p95": snapshot["p95"],
+            "p99": snapshot["p99"]
+        }
+
+    def get_status(self) -> dict:
+        return {
+            self.OVERALL: self.summarize(self.overall),
+            "tiers": {tier: self.summarize(h) for tier, h in list(self.tiers.items())},
+            "shards": {shard: self.summarize(h) for shard, h in list(self.shards.items())},
+            "total_negative": self.total_negative
+        }
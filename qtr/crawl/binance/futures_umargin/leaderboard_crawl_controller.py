@@ -1,16 +1,27 @@
 import logging
 import threading
 import pymongo
-import queue
 import time
 from datetime import datetime
 
 from qtr.base.controller.monitor.service_controller import ServiceController
+from qtr.base.db.index_provisioner import MongoIndexProvisioner
+from qtr.base.db.mongo_write_behind import MongoWriteBehind
+from qtr.crawl.binance.http_client import BinanceHttpClient
+from qtr.crawl.binance.futures_umargin.crawl_checkpoint import CrawlCheckpoint
+from qtr.crawl.binance.futures_umargin.detection_latency_tracker import DetectionLatencyTracker
+from qtr.crawl.binance.futures_umargin.position_command_queue import PositionCommandQueue
+from qtr.crawl.binance.futures_umargin.position_event_publisher import PositionEventPublisher
+from qtr.crawl.binance.futures_umargin.position_history import PositionHistoryReader, PositionHistoryWriter
 from qtr.crawl.binance.futures_umargin.trader_position import TraderPosition
 from qtr.crawl.binance.futures_umargin.trader_position_crawl_service import TraderPositionCrawlService
+from qtr.crawl.binance.futures_umargin.trader_poll_scheduler import TraderPollScheduler
+from qtr.crawl.binance.futures_umargin.trader_registry import TraderRegistry
+from qtr.crawl.binance.futures_umargin.position_shard_coordinator import PositionShardCoordinator
 from qtr.crawl.binance.futures_umargin.trader_ranks_crawl_service import TraderRanksCrawlService
 from qtr.utils.constants import TradingConstants
 from qtr.utils.crawl_constants import CrawlConstants
+from qtr.utils.metrics import MetricsRegistry
 
 LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
               '-35s %(lineno) -5d: %(message)s')
@@ -27,18 +38,60 @@ class LeaderboardCrawlController(ServiceController):
     def __init__(self, db_url: str,
                  rank_interval: int = 1,
                  user_info_interval: int = 2,
-                 position_interval: int = 2) -> None:
+                 position_interval: int = 2,
+                 position_engine: str = CrawlConstants.POSITION_ENGINE_SYNC,
+                 position_concurrency: int = 8,
+                 position_rps: float = 4,
+                 position_schedule: bool = False,
+                 poll_min_interval: float = 30,
+                 poll_max_staleness: float = 1800,
+                 shard_mode: str = CrawlConstants.SHARD_MODE_STANDALONE,
+                 position_writer_count: int = CrawlConstants.POSITION_WRITER_COUNT,
+                 position_queue_capacity: int = CrawlConstants.POSITION_QUEUE_CAPACITY,
+                 position_backpressure: str = CrawlConstants.POSITION_BACKPRESSURE_COALESCE,
+                 position_events: bool = False,
+                 checkpoint_path: str = CrawlConstants.CHECKPOINT_PATH) -> None:
         super().__init__(TradingConstants.DEFAULT_MQ_URL,
-                         CrawlConstants.CRAWL_RPC_QUEUE_NAME)
+                         CrawlConstants.CRAWL_RPC_QUEUE_NAME,
+                         CrawlConstants.RPC_WORKER_COUNT, CrawlConstants.RPC_PREFETCH_COUNT)
         self.db_url = db_url
         self.rank_interval = rank_interval
         self.user_info_interval = user_info_interval
         self.position_interval = position_interval
-        self.all_traders: list[str] = []
+        self.position_engine = position_engine  # 仓位爬取引擎，sync或async
+        self.position_concurrency = position_concurrency  # async引擎的最大并发请求数
+        self.position_rps = position_rps  # async引擎初始的每秒请求数，之后由自适应限速器调整
+        self.metrics = MetricsRegistry()  # 热路径的计数器、仪表与延迟直方图，通过metrics方法查询
+        self.http_client = BinanceHttpClient(metrics=self.metrics)  # 所有爬虫服务共享的http连接池
+        self.detection_latency = DetectionLatencyTracker(self.metrics)  # 从仓位更新时间到检测到变动的延迟
+        self.apply_interval_rates()
+        self.position_scheduler: TraderPollScheduler = None  # 按活跃度安排仓位轮询，为None时每轮轮询全部带单人
+        if position_schedule:
+            self.position_scheduler = TraderPollScheduler(poll_min_interval, poll_max_staleness)
+        self.shard_mode = shard_mode
+        self.shard_coordinator: PositionShardCoordinator = None  # coordinator模式下把仓位爬取分发给worker节点
+        if shard_mode == CrawlConstants.SHARD_MODE_COORDINATOR:
+            self.shard_coordinator = PositionShardCoordinator(self)
+        self.all_traders = TraderRegistry()  # 当前共享仓位、需要爬取仓位的带单人
         self.trader_position_mapping = {}
-        self.position_command_queue = queue.SimpleQueue()
+        # 有界的仓位命令队列，按uid分给多个写入线程，写库跟不上时阻塞爬虫或合并同一uid的变动
+        self.position_command_queue = PositionCommandQueue(
+            self.handle_timed_position_command, position_writer_count, position_queue_capacity,
+            position_backpressure, self.metrics)
+        self.command_histograms = {name: self.metrics.histogram(
+            "position_command_seconds", "position command handle time", {"command": name})
+            for name in ("new", "diff")}
+        self.position_event_publisher: PositionEventPublisher = None  # 为None时不发布仓位变动事件
+        if position_events:
+            self.position_event_publisher = PositionEventPublisher(self.mq_url)
+        self.mongo_writer = MongoWriteBehind(metrics=self.metrics)  # 所有mongodb写操作经由后写管道批量写入
+        self.index_provisioner = MongoIndexProvisioner()  # 各服务声明并校验所需的索引
         self.rank_crawl_service = TraderRanksCrawlService(self) # 排行榜爬虫
         self.trader_position_crawl_service: TraderPositionCrawlService = None # 带单人仓位爬虫
+        self.checkpoint: CrawlCheckpoint = None  # 本地检查点，重启时先从检查点恢复，缺失的部分再从mongodb加载
+        if checkpoint_path:
+            self.checkpoint = CrawlCheckpoint(self, checkpoint_path, CrawlConstants.CHECKPOINT_INTERVAL)
+        self.status_snapshot: dict = None  # 定期重建的状态快照，发布后不再修改，status请求直接返回
 
     def setup(self) -> bool:
         LOGGER.info("ready to setup crawl controller")
@@ -51,21 +104,30 @@ class LeaderboardCrawlController(ServiceController):
                 self.trader_col = db["trader"]
                 self.position_col = db["position"]
                 self.position_op_col = db["operations"]
-                traders: list[dict] = self.trader_col.find(
-                    {"crawl_status": True})
-                if traders is not None:
-                    for trader in traders:
-                        uid = trader.get("uid")
-                        self.trader_position_mapping[uid] = None
-                        positions: dict = self.position_col.find_one(
-                            {"uid": uid})
-                        if positions is not None:
-                            ps = positions.get("positions")
-                            self.trader_position_mapping[uid] = TraderPosition.make_position_list(
-                                ps)
+                self.position_history_col = db["position_history"]
+                self.position_history_writer = PositionHistoryWriter(
+                    self.mongo_writer, self.position_history_col, CrawlConstants.POSITION_KEYFRAME_INTERVAL)
+                self.position_history_reader = PositionHistoryReader(self.position_history_col)
+                self.index_provisioner.ensure([
+                    self.index_provisioner.declare(self.trader_col, [("uid", pymongo.ASCENDING)]),
+                    self.index_provisioner.declare(self.position_col, [("uid", pymongo.ASCENDING)]),
+                    self.index_provisioner.declare(self.position_op_col, [("uid", pymongo.ASCENDING),
+                                                                          ("record_time_stamp", pymongo.ASCENDING)]),
+                    self.index_provisioner.declare(self.position_history_col, [("uid", pymongo.ASCENDING),
+                                                                               ("k", pymongo.ASCENDING),
+                                                                               ("t", pymongo.ASCENDING)])
+                ])
+                checkpoint_state = self.checkpoint.load() if self.checkpoint is not None else None
+                restored: set[str] = set()
+                if checkpoint_state is not None:
+                    restored = self.checkpoint.restore_positions(
+                        checkpoint_state, self.checkpoint.find_stale_uids(checkpoint_state))
+                self.load_trader_positions(restored)
                 if not self.rank_crawl_service.setup():
                     print("start fail due to rank crawl service setup failed")
                     return False
+                if checkpoint_state is not None:
+                    self.checkpoint.restore_share_state(checkpoint_state)
                 self.trader_position_crawl_service = TraderPositionCrawlService(
                     self)
                 return True
@@ -73,67 +135,206 @@ class LeaderboardCrawlController(ServiceController):
                 print(ex)
                 return False
 
+    def interval_to_rate(self, interval: float) -> float:
+        if interval is None or interval <= 0:
+            return float("inf")
+        return 1.0 / interval
+
+    def apply_interval_rates(self):
+        """
+        以配置的间隔作为各接口自适应限速器的初始速率，之后由限速器根据响应自动调整
+        """
+        self.http_client.set_rate(CrawlConstants.RANK_URL, self.interval_to_rate(self.rank_interval))
+        user_info_rate = self.interval_to_rate(self.user_info_interval)
+        self.http_client.set_rate(CrawlConstants.PERFORMANCE_URL, user_info_rate)
+        self.http_client.set_rate(CrawlConstants.BASEINFO_URL, user_info_rate)
+        if self.position_engine == CrawlConstants.POSITION_ENGINE_ASYNC:
+            self.http_client.set_rate(CrawlConstants.POSITION_URL, self.position_rps)
+        else:
+            self.http_client.set_rate(CrawlConstants.POSITION_URL,
+                                      self.interval_to_rate(self.position_interval))
+
+    def load_trader_positions(self, restored: set[str] = None):
+        """
+        批量加载需要爬取的带单人及其最近一次仓位，按uid分批用$in查询，避免逐个find_one。
+        restored为已从检查点恢复仓位的uid，不再从库中加载
+        """
+        start_time = time.perf_counter()
+        query_count = 1
+        if restored is None:
+            restored = set()
+        uids = []
+        traders = self.trader_col.find({"crawl_status": True}, {"_id": 0, "uid": 1})
+        for trader in traders:
+            uid = trader.get("uid")
+            if uid not in restored:
+                self.trader_position_mapping[uid] = None
+                uids.append(uid)
+        batch_size = CrawlConstants.WARM_LOAD_BATCH_SIZE
+        for start in range(0, len(uids), batch_size):
+            query_count += 1
+            positions_cursor = self.position_col.find(
+                {"uid": {"$in": uids[start: start + batch_size]}},
+                {"_id": 0, "uid": 1, "positions": 1})
+            for positions in positions_cursor:
+                ps = positions.get("positions")
+                if ps is not None:
+                    # 库中保存的是to_document生成的文档，不是币安接口的原始字段
+                    self.trader_position_mapping[positions.get("uid")] = \
+                        TraderPosition.from_document_list(ps)
+        LOGGER.info("loaded positions of %d traders in %.3fs with %d queries",
+                    len(uids), time.perf_counter() - start_time, query_count)
+
     def update_crawl_intervals(self, params: dict):
         if params is not None:
             self.rank_interval = params.get("rank", self.rank_interval)
             self.user_info_interval = params.get("user", self.user_info_interval)
             self.position_interval = params.get("position", self.position_interval)
+            self.position_concurrency = params.get("position_concurrency", self.position_concurrency)
+            self.position_rps = params.get("position_rps", self.position_rps)
+            self.apply_interval_rates()
             return self.make_success_result({
                 "data": True
             })
         return self.make_error_result("no config found")
 
+    def build_crawl_status(self) -> dict:
+        now = time.time()
+        result = {
+            "snapshot_time": datetime.strftime(datetime.fromtimestamp(now), TradingConstants.TIME_FORMAT),
+            "snapshot_stamp": now,
+            "intervals": {
+                "rank": self.rank_interval,
+                "user": self.user_info_interval,
+                "position": self.position_interval
+            },
+            "position_engine": {
+                "engine": self.position_engine,
+                "concurrency": self.position_concurrency,
+                "rps": self.position_rps
+            },
+            "rate_control": self.http_client.get_rate_status(),
+            "registry": {
+                "crawl_traders": self.rank_crawl_service.all_crawl_trader_ids.get_status(),
+                "share_traders": self.all_traders.get_status()
+            },
+            "dedup": {
+                "performance": self.rank_crawl_service.performance_dedup.get_status(),
+                "baseinfo": self.rank_crawl_service.baseinfo_dedup.get_status()
+            },
+            "mongo_write": self.mongo_writer.get_status(),
+            "position_commands": self.position_command_queue.get_status(),
+            "checkpoint": self.checkpoint.get_status() if self.checkpoint is not None else None,
+            "position_events": self.position_event_publisher.get_status()
+            if self.position_event_publisher is not None else None,
+            "indexes": self.index_provisioner.get_status(),
+            "rank_crawl": {
+                "total_trader_count": len(self.rank_crawl_service.all_crawl_trader_ids),
+                "last_rank_udpate": datetime.strftime(self.rank_crawl_service.last_rank_update, TradingConstants.TIME_FORMAT),
+                "last_rank_time_span": self.rank_crawl_service.last_rank_time.total_seconds(),
+                "last_rank_count": self.rank_crawl_service.last_rank_count,
+                "last_users_update": datetime.strftime(self.rank_crawl_service.last_performance_update, TradingConstants.TIME_FORMAT),
+                "last_users_time_span": self.rank_crawl_service.last_performance_time.total_seconds(),
+                "last_users_count": self.rank_crawl_service.last_performance_count,
+                "info_refresh": self.rank_crawl_service.info_refresher.get_status(),
+                "baseinfo_skipped": self.rank_crawl_service.total_baseinfo_skipped,
+                "new_trader_failed": self.rank_crawl_service.total_new_trader_failed
+            },
+            "position_crawl": {
+                "current_share_trader_count": len(self.all_traders),
+                "last_crawl_count": self.trader_position_crawl_service.last_crawl_count,
+                "last_crawl_fail": self.trader_position_crawl_service.last_fail_count,
+                "last_crawl_time": self.trader_position_crawl_service.last_crawl_time.total_seconds(),
+                "last_crawl_throttled": self.trader_position_crawl_service.has_error,
+                "last_update": datetime.strftime(self.trader_position_crawl_service.last_update, TradingConstants.TIME_FORMAT),
+                "total_failed": self.trader_position_crawl_service.total_failed_times,
+                "total_times": self.trader_position_crawl_service.total_crawl_time
+            },
+            "detection_latency": self.detection_latency.get_status(),
+            "position_schedule": self.position_scheduler.get_status()
+            if self.position_scheduler is not None else None,
+            "sharding": self.shard_coordinator.get_status()
+            if self.shard_coordinator is not None else None
+        }
+        return result
+
+    def refresh_status_snapshot(self):
+        try:
+            # 整体替换引用，读取方拿到的总是一个完整且不会再变化的快照
+            self.status_snapshot = self.build_crawl_status()
+        except Exception as ex:
+            LOGGER.error(msg="status snapshot refresh failed", exc_info=ex)
+
+    def status_snapshot_task(self):
+        while True:
+            time.sleep(CrawlConstants.STATUS_SNAPSHOT_INTERVAL)
+            self.refresh_status_snapshot()
+
     def get_crawl_status(self, params: dict):
+        """
+        默认返回最近一次的快照，params中fresh为true时重新统计
+        """
         try:
-            result = {
-                "intervals": {
-                    "rank": self.rank_interval,
-                    "user": self.user_info_interval,
-                    "position": self.position_interval
-                },
-                "rank_crawl": {
-                    "total_trader_count": len(self.rank_crawl_service.all_crawl_trader_ids),
-                    "last_rank_udpate": datetime.strftime(self.rank_crawl_service.last_rank_update, TradingConstants.TIME_FORMAT),
-                    "last_rank_time_span": self.rank_crawl_service.last_rank_time.total_seconds(),
-                    "last_rank_count": self.rank_crawl_service.last_rank_count,
-                    "last_users_update": datetime.strftime(self.rank_crawl_service.last_performance_update, TradingConstants.TIME_FORMAT),
-                    "last_users_time_span": self.rank_crawl_service.last_performance_time.total_seconds(),
-                    "last_users_count": self.rank_crawl_service.last_performance_count
-                },
-                "position_crawl": {
-                    "current_share_trader_count": len(self.all_traders),
-                    "last_crawl_count": self.trader_position_crawl_service.last_crawl_count,
-                    "last_crawl_fail": self.trader_position_crawl_service.last_fail_count,
-                    "last_crawl_time": self.trader_position_crawl_service.last_crawl_time.total_seconds(),
-                    "last_update": datetime.strftime(self.trader_position_crawl_service.last_update, TradingConstants.TIME_FORMAT),
-                    "total_failed": self.trader_position_crawl_service.total_failed_times,
-                    "total_times": self.trader_position_crawl_service.total_crawl_time
-                }
-            }
-            return self.make_success_result(result)
+            if params is not None and params.get("fresh", False):
+                return self.make_success_result(self.build_crawl_status())
+            snapshot = self.status_snapshot
+            if snapshot is None:
+                self.refresh_status_snapshot()
+                snapshot = self.status_snapshot
+            return self.make_success_result(snapshot)
         except Exception as ex:
             LOGGER.error(str(ex))
             return self.make_error_result("server interal error:" + str(ex))
         pass
 
+    def get_positions_at(self, params: dict):
+        if params is None or params.get("uid") is None:
+            return self.make_error_result("uid is required")
+        try:
+            positions = self.position_history_reader.positions_at(
+                params.get("uid"), params.get("time_stamp", time.time()))
+            return self.make_success_result({
+                "positions": None if positions is None else TraderPosition.to_document_list(positions)
+            })
+        except Exception as ex:
+            LOGGER.error(str(ex))
+            return self.make_error_result("server interal error:" + str(ex))
+
+    def get_metrics(self, params: dict):
+        """
+        params中format为prometheus时返回Prometheus文本格式，否则返回json结构
+        """
+        try:
+            self.metrics.gauge("share_trader_count", "traders whose positions are crawled").set(
+                len(self.all_traders))
+            self.metrics.gauge("crawl_trader_count", "traders ever seen on the rank list").set(
+                len(self.rank_crawl_service.all_crawl_trader_ids))
+            if params is not None and params.get("format") == "prometheus":
+                return self.make_success_result({"text": self.metrics.to_prometheus()})
+            return self.make_success_result(self.metrics.snapshot())
+        except Exception as ex:
+            LOGGER.error(str(ex))
+            return self.make_error_result("server interal error:" + str(ex))
+
     def process_control_task(self, method: str, params: dict):
         super().process_control_task(method, params)
         if method == "status":
             return self.get_crawl_status(params)
         elif method == "update_interval":
             return self.update_crawl_intervals(params)
+        elif method == "positions_at":
+            return self.get_positions_at(params)
+        elif method == "metrics":
+            return self.get_metrics(params)
         else:
             return self.make_error_result("unknown method " + method)
 
 
     def on_new_traders(self, new_trader_list: list[str]):
-        self.all_traders.extend(new_trader_list)
+        self.all_traders.add_all(new_trader_list)
 
     def on_trader_close_share(self, uid:str):
-        try:
-            self.all_traders.remove(uid)
-        except ValueError:
-            pass
+        self.all_traders.remove(uid)
 
     def on_trader_init_position(self, trader_id: str, positions: list[TraderPosition]):
         command = {
@@ -141,9 +342,12 @@ class LeaderboardCrawlController(ServiceController):
             "uid": trader_id,
             "positions": positions
         }
-        self.position_command_queue.put_nowait(command)
+        self.position_command_queue.put(command)
 
     def on_trader_position_changed(self, trader_id: str, old_positions: list[TraderPosition], new_positions: list[TraderPosition], diff_ref: dict):
+        if self.position_event_publisher is not None:
+            # 在写库之前发布，订阅方不受写库排队的影响
+            self.position_event_publisher.publish_diff(trader_id, diff_ref, time.time())
         command = {
             "name": "diff",
             "uid": trader_id,
@@ -151,75 +355,102 @@ class LeaderboardCrawlController(ServiceController):
             "old": old_positions,
             "diff": diff_ref
         }
-        self.position_command_queue.put_nowait(command)
+        self.position_command_queue.put(command)
 
-    def position_command_handle_task(self):
-        while True:
-            command: dict = self.position_command_queue.get()
-            name = command.get("name")
-            uid = command.get("uid")
-            if name == "new":
-                positions: list[TraderPosition] = command.get("positions", [])
-                entry = {
-                    "record_time":  datetime.strftime(datetime.now(),
-                                                      TradingConstants.TIME_FORMAT),
-                    "record_time_stamp": time.time(),
-                    "uid": uid,
-                    "positions": [p.__dict__.copy() for p in positions]
-                }
-                try:
-                    self.position_col.replace_one({"uid": uid}, entry, True)
-                except Exception as ex:
-                    print("failed to save new position", ex)
-            elif name == "diff":
-                new_positions: list[TraderPosition] = command.get("new", [])
-                old_positions: list[TraderPosition] = command.get("old", [])
-                diff_pos: list[dict] = command.get("diff", [])
-                entry = {
-                    "record_time":  datetime.strftime(datetime.now(),
-                                                      TradingConstants.TIME_FORMAT),
-                    "record_time_stamp": time.time(),
-                    "uid": uid,
-                    "positions": [p.__dict__.copy() for p in new_positions]
-                }
-                try:
-                    self.position_col.replace_one({"uid": uid}, entry, True)
-                except Exception as ex:
-                    print("failed to save new position", ex)
-                removed: list[TraderPosition] = diff_pos.get("removed", [])
-                added: list[TraderPosition] = diff_pos.get("added", [])
-                changed: list[(TraderPosition, TraderPosition)
-                              ] = diff_pos.get("changed", [])
-                diff = {
-                    "removed": [p.__dict__.copy() for p in removed],
-                    "added": [[p.__dict__.copy() for p in added]],
-                    "changed": [{"from": p[0].__dict__.copy(),
-                                 "to":p[1].__dict__.copy()}
-                                for p in changed]
-                }
-                entry = {
-                    "record_time":  datetime.strftime(datetime.now(),
-                                                      TradingConstants.TIME_FORMAT),
-                    "record_time_stamp": time.time(),
-                    "uid": uid,
-                    "new": [p.__dict__.copy() for p in new_positions],
-                    "old": [p.__dict__.copy() for p in old_positions],
-                    "diff": diff
-                }
-                try:
-                    self.position_op_col.insert_one(entry)
-                except Exception as ex:
-                    print("failed to save position operation failed", ex)
-
-    def position_command_task_thread(self):
-        self.position_command_handle_task()
+    def handle_timed_position_command(self, command: dict):
+        begin = time.perf_counter()
+        self.handle_position_command(command)
+        histogram = self.command_histograms.get(command.get("name"))
+        if histogram is not None:
+            histogram.observe(time.perf_counter() - begin)
+
+    def handle_position_command(self, command: dict):
+        name = command.get("name")
+        uid = command.get("uid")
+        if name == "new":
+            positions: list[TraderPosition] = command.get("positions", [])
+            entry = {
+                "record_time":  datetime.strftime(datetime.now(),
+                                                  TradingConstants.TIME_FORMAT),
+                "record_time_stamp": time.time(),
+                "uid": uid,
+                "positions": TraderPosition.to_document_list(positions)
+            }
+            self.mongo_writer.replace(self.position_col, {"uid": uid}, entry)
+            if CrawlConstants.POSITION_HISTORY_DELTA:
+                self.position_history_writer.on_new(uid, positions, entry["record_time_stamp"])
+            if command.get("diff") is not None:
+                # 排队期间合并进来的变动，时间戳晚于关键帧，重建历史时不会被关键帧覆盖
+                self.write_position_diff(uid, positions, command.get("new", []), command.get("diff"),
+                                         max(time.time(), entry["record_time_stamp"] + 0.000001))
+        elif name == "diff":
+            self.write_position_diff(uid, command.get("old", []), command.get("new", []),
+                                     command.get("diff", {}), time.time())
+
+    def write_position_diff(self, uid: str, old_positions: list[TraderPosition],
+                            new_positions: list[TraderPosition], diff_pos: dict, record_time_stamp: float):
+        new_documents = TraderPosition.to_document_list(new_positions)
+        entry = {
+            "record_time":  datetime.strftime(datetime.now(),
+                                              TradingConstants.TIME_FORMAT),
+            "record_time_stamp": record_time_stamp,
+            "uid": uid,
+            "positions": new_documents
+        }
+        self.mongo_writer.replace(self.position_col, {"uid": uid}, entry)
+        if CrawlConstants.POSITION_HISTORY_DELTA:
+            self.position_history_writer.on_diff(uid, new_positions, diff_pos,
+                                                 entry["record_time_stamp"])
+        if not CrawlConstants.POSITION_HISTORY_FULL:
+            return
+        removed: list[TraderPosition] = diff_pos.get("removed", [])
+        added: list[TraderPosition] = diff_pos.get("added", [])
+        changed: list[(TraderPosition, TraderPosition)
+                      ] = diff_pos.get("changed", [])
+        diff = {
+            "removed": TraderPosition.to_document_list(removed),
+            "added": [TraderPosition.to_document_list(added)],
+            "changed": [{"from": p[0].to_document(),
+                         "to":p[1].to_document()}
+                        for p in changed]
+        }
+        entry = {
+            "record_time":  datetime.strftime(datetime.now(),
+                                              TradingConstants.TIME_FORMAT),
+            "record_time_stamp": record_time_stamp,
+            "uid": uid,
+            "new": new_documents,
+            "old": TraderPosition.to_document_list(old_positions),
+            "diff": diff
+        }
+        self.mongo_writer.insert(self.position_op_col, entry)
 
     def start_crawl(self):
         LOGGER.info("enter start_crawl")
+        self.mongo_writer.start()
+        if self.position_event_publisher is not None:
+            self.position_event_publisher.start()
+        if self.checkpoint is not None:
+            self.checkpoint.start()
+        self.refresh_status_snapshot()
+        threading.Thread(target=self.status_snapshot_task, daemon=True).start()
         self.rpc_consumer.run()
-        position_handle_thread = threading.Thread(
-            target=self.position_command_task_thread)
-        position_handle_thread.start()
+        self.position_command_queue.start()
         self.rank_crawl_service.start_task()
-        self.trader_position_crawl_service.start_task()
+        if self.shard_coordinator is not None:
+            self.shard_coordinator.start_task()
+        else:
+            self.trader_position_crawl_service.start_task()
         LOGGER.info("start_crawl ready")
+
+    def shutdown(self):
+        """
+        进程退出前调用，等待仓位命令处理完并写完后写管道中的操作，最后写入检查点
+        """
+        LOGGER.info("enter shutdown")
+        if not self.position_command_queue.drain(CrawlConstants.SHUTDOWN_TIMEOUT):
+            LOGGER.error("position commands not drained before shutdown")
+        self.mongo_writer.stop(CrawlConstants.SHUTDOWN_TIMEOUT)
+        if self.checkpoint is not None:
+            self.checkpoint.save()
+        LOGGER.info("shutdown ready")
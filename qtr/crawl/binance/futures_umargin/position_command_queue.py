@@ -0,0 +1,190 @@
+import collections
+import logging
+import threading
+import time
+import zlib
+
+from qtr.base.nonjsonable import NoneJsonable
+from qtr.crawl.binance.futures_umargin.trader_position import TraderPosition
+from qtr.utils.crawl_constants import CrawlConstants
+from qtr.utils.metrics import MetricsRegistry
+
+LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
+              '-35s %(lineno) -5d: %(message)s')
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.INFO)
+
+
+class CommandShard(NoneJsonable):
+    """
+    单个写入worker的有界队列。pending记录每个uid尚未被取走的最后一条命令，用于合并
+    """
+
+    def __init__(self, capacity: int) -> None:
+        super().__init__()
+        self.capacity = capacity
+        self.commands: collections.deque = collections.deque()
+        self.pending: dict[str, dict] = {}
+        self.condition = threading.Condition()
+        self.max_depth = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.taken = 0
+        self.handled = 0
+
+
+class PositionCommandQueue(NoneJsonable):
+    """
+    有界的仓位命令队列，由worker_count个写入线程处理。同一uid的命令总是进入同一个worker，保证按顺序写入。
+    背压策略:
+    block    队列满时阻塞爬虫线程，直到写入线程跟上
+    coalesce 队列满时，同一uid已有未处理的命令则把diff合并进去(重新与最早的旧仓位比对)，
+             无法合并时同样阻塞。队列未满时不合并，每次变动都单独记录
+    """
+
+    def __init__(self, handler, worker_count: int = CrawlConstants.POSITION_WRITER_COUNT,
+                 capacity: int = CrawlConstants.POSITION_QUEUE_CAPACITY,
+                 backpressure: str = CrawlConstants.POSITION_BACKPRESSURE_COALESCE,
+                 metrics: MetricsRegistry = None) -> None:
+        super().__init__()
+        self.handler = handler
+        self.worker_count = max(1, worker_count)
+        self.backpressure = backpressure
+        # 总容量平均分给各worker
+        self.shards = [CommandShard(max(1, capacity // self.worker_count))
+                       for _ in range(self.worker_count)]
+        self.total_put = 0
+        self.total_coalesced = 0
+        self.total_blocked = 0
+        self.total_blocked_time = 0.0
+        self.total_failed = 0
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.lag_histogram = self.metrics.histogram(
+            "position_command_lag_seconds", "time from enqueue to handle of position commands")
+        self.metrics.gauge("position_command_queue_depth", "pending position commands").set_function(
+            self.qsize)
+
+    def shard_of(self, uid: str) -> CommandShard:
+        # crc32在进程间稳定，便于对比不同进程的状态
+        return self.shards[zlib.crc32(uid.encode()) % self.worker_count]
+
+    def qsize(self) -> int:
+        return sum([len(shard.commands) for shard in self.shards])
+
+    def merge(self, queued: dict, command: dict):
+        """
+        把command合并进队列中尚未处理的queued，合并后queued反映同一uid的最终状态
+        """
+        if queued.get("name") == "new":
+            # new保留初始仓位，之后的变动作为相对初始仓位的diff附在命令上，处理时仍写入变动记录
+            old_positions = queued.get("positions")
+        else:
+            old_positions = queued.get("old")
+        new_positions = command.get("new")
+        changed, added, removed = TraderPosition.diff_position_list(old_positions, new_positions)
+        queued["new"] = new_positions
+        queued["diff"] = {
+            "changed": changed,
+            "removed": removed,
+            "added": added
+        }
+
+    def put(self, command: dict):
+        uid = command.get("uid")
+        shard = self.shard_of(uid)
+        with shard.condition:
+            self.total_put += 1
+            if len(shard.commands) >= shard.capacity and command.get("name") == "diff" and \
+                    self.backpressure == CrawlConstants.POSITION_BACKPRESSURE_COALESCE:
+                queued = shard.pending.get(uid)
+                if queued is not None:
+                    self.merge(queued, command)
+                    self.total_coalesced += 1
+                    return
+            if len(shard.commands) >= shard.capacity:
+                self.total_blocked += 1
+                begin = time.perf_counter()
+                while len(shard.commands) >= shard.capacity:
+                    shard.condition.wait()
+                self.total_blocked_time += time.perf_counter() - begin
+            command["enqueue_time"] = time.time()
+            shard.commands.append(command)
+            shard.pending[uid] = command
+            shard.max_depth = max(shard.max_depth, len(shard.commands))
+            shard.condition.notify_all()
+
+    def take(self, shard: CommandShard) -> dict:
+        with shard.condition:
+            while len(shard.commands) == 0:
+                shard.condition.wait()
+            command: dict = shard.commands.popleft()
+            shard.taken += 1
+            uid = command.get("uid")
+            if shard.pending.get(uid) is command:
+                # 取走后不再合并，之后的命令重新排队
+                del shard.pending[uid]
+            shard.condition.notify_all()
+        lag = time.time() - command.get("enqueue_time")
+        shard.last_lag = lag
+        shard.max_lag = max(shard.max_lag, lag)
+        self.lag_histogram.observe(lag)
+        return command
+
+    def worker_task(self, shard: CommandShard):
+        while True:
+            command = self.take(shard)
+            try:
+                self.handler(command)
+            except Exception as ex:
+                self.total_failed += 1
+                LOGGER.error(msg="position command handle failed " + str(command.get("uid")), exc_info=ex)
+            with shard.condition:
+                shard.handled += 1
+                shard.condition.notify_all()
+
+    def drain(self, timeout: float) -> bool:
+        """
+        等待已入队的命令全部处理完，返回是否在timeout内完成，关闭前调用
+        """
+        deadline = time.time() + timeout
+        for shard in self.shards:
+            with shard.condition:
+                while len(shard.commands) > 0 or shard.taken > shard.handled:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    shard.condition.wait(remaining)
+        return True
+
+    def start(self):
+        for index, shard in enumerate(self.shards):
+            threading.Thread(target=self.worker_task, args=(shard,),
+                             name="position-writer-" + str(index)).start()
+        LOGGER.info("position command queue ready with %d writers", self.worker_count)
+
+    def get_status(self) -> dict:
+        now = time.time()
+        workers = []
+        for shard in self.shards:
+            with shard.condition:
+                oldest = shard.commands[0].get("enqueue_time") if len(shard.commands) > 0 else None
+                workers.append({
+                    "depth": len(shard.commands),
+                    "max_depth": shard.max_depth,
+                    "capacity": shard.capacity,
+                    "lag": round(now - oldest, 3) if oldest is not None else 0,
+                    "last_lag": round(shard.last_lag, 3),
+                    "max_lag": round(shard.max_lag, 3),
+                    "handled": shard.handled
+                })
+        return {
+            "backpressure": self.backpressure,
+            "depth": sum([w["depth"] for w in workers]),
+            "lag": max([w["lag"] for w in workers]),
+            "total_put": self.total_put,
+            "total_coalesced": self.total_coalesced,
+            "total_blocked": self.total_blocked,
+            "total_blocked_time": round(self.total_blocked_time, 3),
+            "total_failed": self.total_failed,
+            "workers": workers
+        }
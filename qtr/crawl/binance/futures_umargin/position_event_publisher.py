@@ -0,0 +1,146 @@
+import collections
+import logging
+import threading
+import time
+import pika
+from pika.adapters.blocking_connection import BlockingChannel
+
+from qtr.base.nonjsonable import NoneJsonable
+from qtr.crawl.binance.futures_umargin.trader_position import TraderPosition
+from qtr.utils import json_codec
+from qtr.utils.crawl_constants import CrawlConstants
+
+LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
+              '-35s %(lineno) -5d: %(message)s')
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.INFO)
+
+
+class PositionEventPublisher(NoneJsonable):
+    """
+    把仓位变动实时发布到topic exchange，订阅方无需轮询operations集合。
+    每个新增/平仓/变动事件为一条消息，routing key为"<uid>.<symbol>.<event>"，例如按"*.BTCUSDT.*"订阅某个币种。
+    消息体为 {"u": uid, "e": event, "t": 检测时间, "p": 变动后的紧凑仓位, "o": 变动前的紧凑仓位}。
+    事件先进入内存队列，由后台线程按批发布，每批在一个channel事务中提交，提交成功即代表整批已被broker接收；
+    失败时整批保留并在重连后重发。队列超过max_pending时丢弃最旧的事件，爬虫线程不会被阻塞
+    """
+
+    def __init__(self, mq_url: str, exchange: str = CrawlConstants.POSITION_EVENT_EXCHANGE,
+                 batch_size: int = CrawlConstants.POSITION_EVENT_BATCH_SIZE,
+                 flush_interval: float = CrawlConstants.POSITION_EVENT_FLUSH_INTERVAL,
+                 max_pending: int = CrawlConstants.POSITION_EVENT_MAX_PENDING) -> None:
+        super().__init__()
+        self.mq_url = mq_url
+        self.exchange = exchange
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending: collections.deque = collections.deque()
+        self.condition = threading.Condition()
+        self.channel: BlockingChannel = None
+        self.total_events = 0
+        self.total_published = 0
+        self.total_batches = 0
+        self.total_dropped = 0
+        self.total_failed_batches = 0
+        self.last_batch_latency = 0.0
+        self.max_batch_latency = 0.0
+        self.last_error: str = None
+
+    def make_event(self, uid: str, event: str, t: float, new: TraderPosition, old: TraderPosition) -> tuple:
+        position = new if new is not None else old
+        routing_key = uid + "." + str(position.symbol) + "." + event
+        return routing_key, {
+            "u": uid,
+            "e": event,
+            "t": t,
+            "p": new.to_compact() if new is not None else None,
+            "o": old.to_compact() if old is not None else None
+        }
+
+    def publish_diff(self, uid: str, diff_ref: dict, t: float):
+        events = [self.make_event(uid, "added", t, p, None) for p in diff_ref.get("added", [])]
+        events.extend([self.make_event(uid, "removed", t, None, p) for p in diff_ref.get("removed", [])])
+        events.extend([self.make_event(uid, "changed", t, c[1], c[0]) for c in diff_ref.get("changed", [])])
+        if len(events) == 0:
+            return
+        with self.condition:
+            self.pending.extend(events)
+            self.total_events += len(events)
+            while len(self.pending) > self.max_pending:
+                self.pending.popleft()
+                self.total_dropped += 1
+            if len(self.pending) >= self.batch_size:
+                self.condition.notify()
+
+    def take_batch(self) -> list[tuple]:
+        with self.condition:
+            if len(self.pending) < self.batch_size:
+                self.condition.wait(self.flush_interval)
+            count = min(self.batch_size, len(self.pending))
+            return [self.pending.popleft() for _ in range(count)]
+
+    def requeue(self, batch: list[tuple]):
+        with self.condition:
+            self.pending.extendleft(reversed(batch))
+            while len(self.pending) > self.max_pending:
+                self.pending.popleft()
+                self.total_dropped += 1
+
+    def connect(self) -> BlockingChannel:
+        connection = pika.BlockingConnection(pika.URLParameters(self.mq_url))
+        channel = connection.channel()
+        channel.exchange_declare(exchange=self.exchange, exchange_type="topic", durable=True)
+        channel.tx_select()
+        return channel
+
+    def publish_batch(self, batch: list[tuple]):
+        begin = time.perf_counter()
+        properties = pika.BasicProperties(content_type="application/json")
+        for routing_key, body in batch:
+            self.channel.basic_publish(exchange=self.exchange, routing_key=routing_key,
+                                       body=json_codec.dumps(body), properties=properties)
+        self.channel.tx_commit()
+        latency = time.perf_counter() - begin
+        self.total_published += len(batch)
+        self.total_batches += 1
+        self.last_batch_latency = latency
+        self.max_batch_latency = max(self.max_batch_latency, latency)
+
+    def publish_task(self):
+        while True:
+            batch = self.take_batch()
+            if len(batch) == 0:
+                if self.channel is not None and self.channel.is_open:
+                    # 空闲时处理心跳
+                    self.channel.connection.process_data_events(0)
+                continue
+            try:
+                if self.channel is None or self.channel.is_closed:
+                    self.channel = self.connect()
+                self.publish_batch(batch)
+            except Exception as ex:
+                self.total_failed_batches += 1
+                self.last_error = str(ex)
+                LOGGER.error(msg="position event publish failed", exc_info=ex)
+                self.channel = None
+                self.requeue(batch)
+                time.sleep(1)
+
+    def start(self):
+        threading.Thread(target=self.publish_task, daemon=True).start()
+        LOGGER.info("position event publisher ready on exchange " + self.exchange)
+
+    def get_status(self) -> dict:
+        return {
+            "exchange": self.exchange,
+            "pending": len(self.pending),
+            "total_events": self.total_events,
+            "total_published": self.total_published,
+            "total_batches": self.total_batches,
+            "total_dropped": self.total_dropped,
+            "total_failed_batches": self.total_failed_batches,
+            "last_batch_latency": round(self.last_batch_latency, 6),
+            "max_batch_latency": round(self.max_batch_latency, 6),
+            "last_error": self.last_error
+        }
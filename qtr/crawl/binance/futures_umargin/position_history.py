@@ -0,0 +1,89 @@
+"""
+增量格式的仓位历史，保存在position_history集合中，每个文档为以下两种之一:
+关键帧 {"uid": uid, "t": 时间戳, "k": 1, "p": [紧凑仓位...]}
+增量   {"uid": uid, "t": 时间戳, "k": 0, "u": [新增或变动后的紧凑仓位...], "r": [[symbol, position_side]...]}
+每个带单人每keyframe_interval个增量写一次关键帧，任意时刻的仓位由最近的关键帧加其后的增量重建
+"""
+import pymongo
+from pymongo.collection import Collection
+
+from qtr.base.db.mongo_write_behind import MongoWriteBehind
+from qtr.base.nonjsonable import NoneJsonable
+from qtr.crawl.binance.futures_umargin.trader_position import TraderPosition
+
+
+class PositionHistoryWriter(NoneJsonable):
+
+    def __init__(self, mongo_writer: MongoWriteBehind, collection: Collection,
+                 keyframe_interval: int = 50) -> None:
+        super().__init__()
+        self.mongo_writer = mongo_writer
+        self.collection = collection
+        self.keyframe_interval = keyframe_interval
+        self.events_since_keyframe: dict[str, int] = {}
+
+    def make_keyframe(self, uid: str, positions: list[TraderPosition], t: float) -> dict:
+        return {
+            "uid": uid,
+            "t": t,
+            "k": 1,
+            "p": [p.to_compact() for p in positions]
+        }
+
+    def make_delta(self, uid: str, diff_ref: dict, t: float) -> dict:
+        upserted = [p.to_compact() for p in diff_ref.get("added", [])]
+        upserted.extend([c[1].to_compact() for c in diff_ref.get("changed", [])])
+        return {
+            "uid": uid,
+            "t": t,
+            "k": 0,
+            "u": upserted,
+            "r": [[p.symbol, p.position_side] for p in diff_ref.get("removed", [])]
+        }
+
+    def on_new(self, uid: str, positions: list[TraderPosition], t: float):
+        self.mongo_writer.insert(self.collection, self.make_keyframe(uid, positions, t))
+        self.events_since_keyframe[uid] = 0
+
+    def on_diff(self, uid: str, new_positions: list[TraderPosition], diff_ref: dict, t: float):
+        self.mongo_writer.insert(self.collection, self.make_delta(uid, diff_ref, t))
+        # 重启后计数未知，第一次变动时补写关键帧
+        count = self.events_since_keyframe.get(uid, self.keyframe_interval - 1) + 1
+        if count >= self.keyframe_interval:
+            # 与增量同一时间戳，重建时关键帧已包含该增量
+            self.mongo_writer.insert(self.collection, self.make_keyframe(uid, new_positions, t))
+            count = 0
+        self.events_since_keyframe[uid] = count
+
+
+class PositionHistoryReader(NoneJsonable):
+
+    def __init__(self, collection: Collection) -> None:
+        super().__init__()
+        self.collection = collection
+
+    def reconstruct(keyframe: dict, deltas: list[dict]) -> list[TraderPosition]:
+        """
+        在关键帧上按时间顺序应用增量
+        """
+        state: dict[tuple, list] = {}
+        for c in keyframe.get("p", []):
+            state[(c[0], c[1])] = c
+        for delta in deltas:
+            for key in delta.get("r", []):
+                state.pop((key[0], key[1]), None)
+            for c in delta.get("u", []):
+                state[(c[0], c[1])] = c
+        return [TraderPosition.from_compact(c) for c in state.values()]
+
+    def positions_at(self, uid: str, t: float) -> list[TraderPosition]:
+        """
+        返回带单人在时间戳t时的仓位，t早于第一个关键帧时返回None
+        """
+        keyframe = self.collection.find_one({"uid": uid, "k": 1, "t": {"$lte": t}},
+                                            sort=[("t", pymongo.DESCENDING)])
+        if keyframe is None:
+            return None
+        deltas = self.collection.find({"uid": uid, "k": 0, "t": {"$gt": keyframe.get("t"), "$lte": t}},
+                                      sort=[("t", pymongo.ASCENDING)])
+        return PositionHistoryReader.reconstruct(keyframe, deltas)
@@ -0,0 +1,229 @@
+from __future__ import annotations
+import typing
+if typing.TYPE_CHECKING:
+    from qtr.crawl.binance.futures_umargin.leaderboard_crawl_controller import LeaderboardCrawlController
+
+import logging
+import threading
+import time
+import pika
+from pika.adapters.blocking_connection import BlockingChannel
+from pika.spec import Basic
+
+from qtr.base.nonjsonable import NoneJsonable
+from qtr.crawl.binance.futures_umargin.trader_position import TraderPosition
+from qtr.utils.consistent_hash import ConsistentHashRing
+from qtr.utils.crawl_constants import CrawlConstants
+from qtr.utils import json_codec
+
+LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
+              '-35s %(lineno) -5d: %(message)s')
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.INFO)
+
+
+class PositionShardCoordinator(NoneJsonable):
+    """
+    仓位爬取的分片协调器，运行在LeaderboardCrawlController进程中。
+    worker通过控制队列加入/心跳/离开，协调器用一致性哈希把all_traders分片后下发到各worker的队列，
+    worker把仓位变动发回结果队列，由协调器按原有流程写库。worker加入或超时后自动重新分片
+    """
+
+    def __init__(self, controller: LeaderboardCrawlController) -> None:
+        super().__init__()
+        self.controller = controller
+        self.mq_url = controller.mq_url
+        self.workers: dict[str, float] = {}  # worker_id -> 最后一次心跳时间
+        self.pending_workers: set[str] = set()  # 新加入或重启、需要下发完整分片的worker
+        self.ring = ConsistentHashRing()
+        self.assignment: dict[str, str] = {}  # uid -> worker_id
+        self.assigned_traders: tuple = ()
+        self.assignment_version = 0
+        self.last_rebalance: float = None
+        self.total_results = 0
+        self.total_stale_results = 0
+        self.lock = threading.Lock()
+
+    def worker_queue_name(self, worker_id: str) -> str:
+        return CrawlConstants.SHARD_WORKER_QUEUE_PREFIX + worker_id
+
+    def on_control_message(self, ch: BlockingChannel, method: Basic.Deliver,
+                           properties: pika.BasicProperties, body: bytes):
+        message: dict = json_codec.loads(body)
+        message_type = message.get("type")
+        worker_id = message.get("worker_id")
+        with self.lock:
+            if message_type == "join":
+                LOGGER.info("shard worker joined " + worker_id)
+                self.workers[worker_id] = time.time()
+                self.pending_workers.add(worker_id)
+            elif message_type == "heartbeat":
+                if worker_id not in self.workers:
+                    # 协调器重启后，正在运行的worker以心跳重新加入
+                    self.pending_workers.add(worker_id)
+                self.workers[worker_id] = time.time()
+            elif message_type == "leave":
+                LOGGER.info("shard worker left " + worker_id)
+                self.workers.pop(worker_id, None)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    def on_result_message(self, ch: BlockingChannel, method: Basic.Deliver,
+                          properties: pika.BasicProperties, body: bytes):
+        try:
+            message: dict = json_codec.loads(body)
+            self.handle_result(message)
+        except Exception as ex:
+            LOGGER.error(msg="shard result handle failed", exc_info=ex)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    def handle_result(self, message: dict):
+        uid = message.get("uid")
+        worker_id = message.get("worker_id")
+        with self.lock:
+            owner = self.assignment.get(uid)
+        if owner != worker_id:
+            # 重新分片前发出的结果，该uid已不归此worker负责
+            self.total_stale_results += 1
+            return
+        self.total_results += 1
+        name = message.get("name")
+        if name == "new":
+            positions = TraderPosition.from_document_list(message.get("positions", []))
+            self.controller.trader_position_mapping[uid] = positions
+            self.controller.on_trader_init_position(uid, positions)
+        elif name == "diff":
+            old_positions = self.controller.trader_position_mapping.get(uid)
+            if old_positions is None:
+                old_positions = TraderPosition.from_document_list(message.get("old", []))
+            new_positions = TraderPosition.from_document_list(message.get("new", []))
+            diff: dict = message.get("diff", {})
+            diff_ref = {
+                "changed": [(TraderPosition.from_document(c[0]),
+                             TraderPosition.from_document(c[1]))
+                            for c in diff.get("changed", [])],
+                "removed": TraderPosition.from_document_list(diff.get("removed", [])),
+                "added": TraderPosition.from_document_list(diff.get("added", []))
+            }
+            if message.get("detected_at") is not None:
+                self.controller.detection_latency.record_diff(
+                    diff_ref, message.get("detected_at"), message.get("tier"), worker_id)
+            self.controller.on_trader_position_changed(uid, old_positions, new_positions, diff_ref)
+            self.controller.trader_position_mapping[uid] = new_positions
+
+    def consumer_task_thread(self):
+        while True:
+            try:
+                connection = pika.BlockingConnection(pika.URLParameters(self.mq_url))
+                channel = connection.channel()
+                channel.queue_declare(queue=CrawlConstants.SHARD_CONTROL_QUEUE)
+                channel.queue_declare(queue=CrawlConstants.SHARD_RESULT_QUEUE)
+                channel.basic_qos(prefetch_count=100)
+                channel.basic_consume(queue=CrawlConstants.SHARD_CONTROL_QUEUE,
+                                      on_message_callback=self.on_control_message)
+                channel.basic_consume(queue=CrawlConstants.SHARD_RESULT_QUEUE,
+                                      on_message_callback=self.on_result_message)
+                channel.start_consuming()
+            except Exception as ex:
+                LOGGER.error(msg="shard coordinator consumer exception", exc_info=ex)
+                time.sleep(5)
+
+    def compute_assignment(self) -> dict[str, list[str]]:
+        """
+        清理超时的worker并在成员或带单人变化时重新分片，返回需要下发的{worker_id: uids}
+        """
+        now = time.time()
+        traders = self.controller.all_traders.snapshot()
+        with self.lock:
+            for worker_id, last_seen in list(self.workers.items()):
+                if now - last_seen > CrawlConstants.SHARD_WORKER_TIMEOUT:
+                    LOGGER.warning("shard worker timeout " + worker_id)
+                    del self.workers[worker_id]
+            members_changed = set(self.workers.keys()) != self.ring.nodes
+            if not members_changed and traders == self.assigned_traders \
+                    and len(self.pending_workers) == 0:
+                return {}
+            for worker_id in list(self.ring.nodes):
+                if worker_id not in self.workers:
+                    self.ring.remove_node(worker_id)
+            for worker_id in self.workers.keys():
+                self.ring.add_node(worker_id)
+            shards = self.ring.partition(list(traders))
+            new_assignment = {}
+            for worker_id, uids in shards.items():
+                for uid in uids:
+                    new_assignment[uid] = worker_id
+            # 只向分片内容有变化或需要完整分片的worker下发
+            changed_workers = set(self.pending_workers)
+            for uid in set(new_assignment.keys()) | set(self.assignment.keys()):
+                old_owner = self.assignment.get(uid)
+                new_owner = new_assignment.get(uid)
+                if old_owner != new_owner:
+                    if new_owner is not None:
+                        changed_workers.add(new_owner)
+                    if old_owner is not None:
+                        changed_workers.add(old_owner)
+            self.assignment = new_assignment
+            self.assigned_traders = traders
+            self.pending_workers.clear()
+            self.assignment_version += 1
+            self.last_rebalance = now
+            return {worker_id: shards.get(worker_id, []) for worker_id in changed_workers
+                    if worker_id in self.workers}
+
+    def make_assign_message(self, uids: list[str]) -> bytes:
+        positions = {}
+        for uid in uids:
+            ps = self.controller.trader_position_mapping.get(uid)
+            positions[uid] = ps
+        return json_codec.dumps({
+            "type": "assign",
+            "version": self.assignment_version,
+            "uids": uids,
+            "positions": positions
+        })
+
+    def rebalance_task_thread(self):
+        channel: BlockingChannel = None
+        while True:
+            try:
+                if channel is None or channel.is_closed:
+                    connection = pika.BlockingConnection(pika.URLParameters(self.mq_url))
+                    channel = connection.channel()
+                shards = self.compute_assignment()
+                for worker_id, uids in shards.items():
+                    queue_name = self.worker_queue_name(worker_id)
+                    channel.queue_declare(queue=queue_name)
+                    channel.basic_publish(exchange='', routing_key=queue_name,
+                                          body=self.make_assign_message(uids))
+                    LOGGER.info("assign " + str(len(uids)) + " traders to " + worker_id)
+            except Exception as ex:
+                LOGGER.error(msg="shard rebalance exception", exc_info=ex)
+                channel = None
+                with self.lock:
+                    # 下发失败时强制下一次重新下发
+                    self.pending_workers.update(self.workers.keys())
+            time.sleep(CrawlConstants.SHARD_REBALANCE_INTERVAL)
+
+    def get_status(self) -> dict:
+        now = time.time()
+        with self.lock:
+            assigned_count = {worker_id: 0 for worker_id in self.workers.keys()}
+            for worker_id in self.assignment.values():
+                if worker_id in assigned_count:
+                    assigned_count[worker_id] += 1
+            return {
+                "version": self.assignment_version,
+                "workers": [{
+                    "worker_id": worker_id,
+                    "last_seen": round(now - last_seen, 3),
+                    "trader_count": assigned_count.get(worker_id, 0)
+                } for worker_id, last_seen in self.workers.items()],
+                "unassigned_count": len(self.controller.all_traders) - len(self.assignment),
+                "total_results": self.total_results,
+                "total_stale_results": self.total_stale_results
+            }
+
+    def start_task(self):
+        threading.Thread(target=self.consumer_task_thread).start()
+        threading.Thread(target=self.rebalance_task_thread).start()
+        LOGGER.info("position shard coordinator ready")
@@ -0,0 +1,196 @@
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+import pika
+from pika.adapters.blocking_connection import BlockingChannel
+from pika.spec import Basic
+
+from qtr.base.nonjsonable import NoneJsonable
+from qtr.crawl.binance.http_client import BinanceHttpClient
+from qtr.crawl.binance.futures_umargin.detection_latency_tracker import DetectionLatencyTracker
+from qtr.crawl.binance.futures_umargin.trader_position import TraderPosition
+from qtr.crawl.binance.futures_umargin.trader_position_crawl_service import TraderPositionCrawlService
+from qtr.crawl.binance.futures_umargin.trader_poll_scheduler import TraderPollScheduler
+from qtr.crawl.binance.futures_umargin.trader_registry import TraderRegistry
+from qtr.utils.constants import TradingConstants
+from qtr.utils.crawl_constants import CrawlConstants
+from qtr.utils import json_codec
+from qtr.utils.metrics import MetricsRegistry
+
+LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
+              '-35s %(lineno) -5d: %(message)s')
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.INFO)
+
+
+class PositionShardWorker(NoneJsonable):
+    """
+    仓位爬取的worker节点，只爬取协调器分配给自己的带单人。
+    对TraderPositionCrawlService而言它扮演controller的角色，仓位变动不写库而是发回协调器。
+    trader_position_mapping只在爬取线程中读写，mq消费线程收到的分配经由队列在每轮开始前应用
+    """
+
+    def __init__(self, worker_id: str = None, mq_url: str = TradingConstants.DEFAULT_MQ_URL,
+                 position_engine: str = CrawlConstants.POSITION_ENGINE_ASYNC,
+                 position_concurrency: int = 8,
+                 position_rps: float = 4,
+                 position_schedule: bool = False,
+                 poll_min_interval: float = 30,
+                 poll_max_staleness: float = 1800) -> None:
+        super().__init__()
+        if worker_id is None:
+            worker_id = socket.gethostname() + "-" + str(os.getpid())
+        self.worker_id = worker_id
+        self.mq_url = mq_url
+        self.position_engine = position_engine
+        self.position_concurrency = position_concurrency
+        self.position_rps = position_rps
+        self.position_scheduler: TraderPollScheduler = None
+        if position_schedule:
+            self.position_scheduler = TraderPollScheduler(poll_min_interval, poll_max_staleness)
+        self.metrics = MetricsRegistry()
+        self.http_client = BinanceHttpClient(metrics=self.metrics)
+        self.detection_latency = DetectionLatencyTracker(self.metrics, self.worker_id)
+        self.http_client.set_rate(CrawlConstants.POSITION_URL, position_rps)
+        self.all_traders = TraderRegistry()
+        self.trader_position_mapping = {}
+        self.assignment_version = 0
+        self.assignments: queue.Queue = queue.Queue()
+        self.result_channel: BlockingChannel = None
+        self.trader_position_crawl_service = TraderPositionCrawlService(self)
+        self.trader_position_crawl_service.before_round = self.apply_assignments
+
+    def queue_name(self) -> str:
+        return CrawlConstants.SHARD_WORKER_QUEUE_PREFIX + self.worker_id
+
+    def on_assign_message(self, ch: BlockingChannel, method: Basic.Deliver,
+                          properties: pika.BasicProperties, body: bytes):
+        try:
+            self.assignments.put(json_codec.loads(body))
+        except Exception as ex:
+            LOGGER.error(msg="assign message handle failed", exc_info=ex)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    def apply_assignments(self):
+        # 在爬取线程中调用，与仓位比对不会并发修改trader_position_mapping
+        while True:
+            try:
+                message: dict = self.assignments.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                self.apply_assignment(message)
+            except Exception as ex:
+                LOGGER.error(msg="assign message apply failed", exc_info=ex)
+
+    def apply_assignment(self, message: dict):
+        uids: list[str] = message.get("uids", [])
+        positions: dict = message.get("positions", {})
+        assigned = set(uids)
+        for uid in list(self.trader_position_mapping.keys()):
+            if uid not in assigned:
+                del self.trader_position_mapping[uid]
+        for uid in uids:
+            if uid not in self.all_traders:
+                # 新接手的带单人以协调器记录的仓位为比对基准
+                ps = positions.get(uid)
+                self.trader_position_mapping[uid] = None if ps is None \
+                    else TraderPosition.from_document_list(ps)
+        self.assignment_version = message.get("version", 0)
+        self.all_traders.replace_all(uids)
+        LOGGER.info("worker " + self.worker_id + " assigned " + str(len(uids)) + " traders")
+
+    def publish(self, channel: BlockingChannel, queue_name: str, message: dict):
+        channel.basic_publish(exchange='', routing_key=queue_name,
+                              body=json_codec.dumps(message))
+
+    def publish_result(self, message: dict):
+        # 只在仓位爬取线程中调用，独占一个连接
+        message["worker_id"] = self.worker_id
+        message["version"] = self.assignment_version
+        for _ in range(2):
+            try:
+                if self.result_channel is None or self.result_channel.is_closed:
+                    connection = pika.BlockingConnection(pika.URLParameters(self.mq_url))
+                    self.result_channel = connection.channel()
+                    self.result_channel.queue_declare(queue=CrawlConstants.SHARD_RESULT_QUEUE)
+                self.publish(self.result_channel, CrawlConstants.SHARD_RESULT_QUEUE, message)
+                return
+            except Exception as ex:
+                LOGGER.error(msg="publish shard result failed", exc_info=ex)
+                self.result_channel = None
+
+    def on_trader_init_position(self, trader_id: str, positions: list[TraderPosition]):
+        self.publish_result({
+            "name": "new",
+            "uid": trader_id,
+            "positions": positions
+        })
+
+    def on_trader_position_changed(self, trader_id: str, old_positions: list[TraderPosition],
+                                   new_positions: list[TraderPosition], diff_ref: dict):
+        self.publish_result({
+            "name": "diff",
+            "uid": trader_id,
+            "new": new_positions,
+            "old": old_positions,
+            "diff": diff_ref,
+            # 协调器据此按分片统计检测延迟
+            "detected_at": time.time(),
+            "tier": self.position_scheduler.get_tier(trader_id)
+            if self.position_scheduler is not None else None
+        })
+
+    def assign_consumer_thread(self):
+        while True:
+            try:
+                connection = pika.BlockingConnection(pika.URLParameters(self.mq_url))
+                channel = connection.channel()
+                channel.queue_declare(queue=self.queue_name())
+                # 重启后丢弃旧的分片消息，加入时协调器会重新下发
+                channel.queue_purge(queue=self.queue_name())
+                channel.basic_qos(prefetch_count=1)
+                channel.basic_consume(queue=self.queue_name(),
+                                      on_message_callback=self.on_assign_message)
+                self.send_control("join")
+                channel.start_consuming()
+            except Exception as ex:
+                LOGGER.error(msg="worker assign consumer exception", exc_info=ex)
+                time.sleep(5)
+
+    def send_control(self, message_type: str):
+        connection = pika.BlockingConnection(pika.URLParameters(self.mq_url))
+        try:
+            channel = connection.channel()
+            channel.queue_declare(queue=CrawlConstants.SHARD_CONTROL_QUEUE)
+            self.publish(channel, CrawlConstants.SHARD_CONTROL_QUEUE, {
+                "type": message_type,
+                "worker_id": self.worker_id
+            })
+        finally:
+            connection.close()
+
+    def heartbeat_thread(self):
+        while True:
+            time.sleep(CrawlConstants.SHARD_HEARTBEAT_INTERVAL)
+            try:
+                self.send_control("heartbeat")
+            except Exception as ex:
+                LOGGER.error(msg="worker heartbeat failed", exc_info=ex)
+
+    def leave(self):
+        try:
+            self.send_control("leave")
+        except Exception as ex:
+            LOGGER.error(msg="worker leave failed", exc_info=ex)
+
+    def start_task(self):
+        threading.Thread(target=self.assign_consumer_thread, daemon=True).start()
+        threading.Thread(target=self.heartbeat_thread, daemon=True).start()
+        crawl_thread = threading.Thread(target=self.trader_position_crawl_service.crawl_task, daemon=True)
+        crawl_thread.start()
+        LOGGER.info("position shard worker " + self.worker_id + " ready")
+        return crawl_thread
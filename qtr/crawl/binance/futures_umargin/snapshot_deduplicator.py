@@ -0,0 +1,63 @@
+import hashlib
+import json
+import sys
+import threading
+
+from qtr.base.nonjsonable import NoneJsonable
+
+
+class SnapshotDeduplicator(NoneJsonable):
+    """
+    按uid记录最近一次保存的数据的8字节内容哈希，数据未变化时跳过历史记录写入。
+    大部分不活跃带单人的战绩与基本信息每天都完全相同。
+    写入最终失败时须调用forget，否则之后相同的数据都会被跳过，库中的数据一直得不到更新
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.digests: dict[str, bytes] = {}
+        self.total_checked = 0
+        self.total_skipped = 0
+        self.total_forgotten = 0
+        self.lock = threading.Lock()
+
+    def digest(self, payload) -> bytes:
+        content = json.dumps(payload, sort_keys=True, separators=(",", ":"),
+                             ensure_ascii=False, default=str)
+        return hashlib.blake2b(content.encode("utf-8"), digest_size=8).digest()
+
+    def warm(self, uid: str, payload):
+        # 启动时用库中已保存的数据初始化，不计入统计
+        digest = self.digest(payload)
+        with self.lock:
+            self.digests[sys.intern(uid)] = digest
+
+    def is_unchanged(self, uid: str, payload) -> bool:
+        """
+        与上一次保存的数据比较，有变化时记录新的哈希并返回False
+        """
+        digest = self.digest(payload)
+        with self.lock:
+            self.total_checked += 1
+            if self.digests.get(uid) == digest:
+                self.total_skipped += 1
+                return True
+            self.digests[sys.intern(uid)] = digest
+            return False
+
+    def forget(self, uid: str):
+        with self.lock:
+            if self.digests.pop(uid, None) is not None:
+                self.total_forgotten += 1
+
+    def get_status(self) -> dict:
+        with self.lock:
+            return {
+                "tracked_count": len(self.digests),
+                "total_checked": self.total_checked,
+                "total_skipped": self.total_skipped,
+                "total_forgotten": self.total_forgotten,
+                "skip_rate": round(self.total_skipped / self.total_checked, 4)
+                if self.total_checked > 0 else 0,
+                "memory_bytes": sys.getsizeof(self.digests) + len(self.digests) * sys.getsizeof(b"12345678")
+            }
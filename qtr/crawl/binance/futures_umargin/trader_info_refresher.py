@@ -0,0 +1,85 @@
+import heapq
+import sys
+import threading
+import time
+
+from qtr.base.nonjsonable import NoneJsonable
+
+
+class TraderInfoRefresher(NoneJsonable):
+    """
+    按过期程度增量刷新带单人战绩与基本信息。
+    最近出现在排行榜上的带单人每fresh_interval秒刷新一次，长期缺席的带单人的刷新间隔随缺席时长增加，
+    在absent_min_interval与max_interval之间。每次运行只刷新最过期的一批，请求数不超过预算。
+    刷新时间与上榜时间在启动时从总结库恢复，因此重启后可以接着上次的进度继续
+    """
+
+    def __init__(self, request_budget: int, fresh_interval: float, presence_window: float,
+                 absent_min_interval: float, max_interval: float) -> None:
+        super().__init__()
+        self.request_budget = request_budget
+        self.fresh_interval = fresh_interval
+        self.presence_window = presence_window
+        self.absent_min_interval = absent_min_interval
+        self.max_interval = max_interval
+        self.last_refresh: dict[str, float] = {}
+        self.last_rank_seen: dict[str, float] = {}
+        self.last_run_requests = 0
+        self.last_run_traders = 0
+        self.last_run_due = 0
+        self.lock = threading.Lock()
+
+    def warm_refresh(self, uid: str, t: float):
+        if t is not None and t > self.last_refresh.get(uid, 0):
+            self.last_refresh[sys.intern(uid)] = t
+
+    def on_rank_seen(self, uids: list[str], t: float):
+        with self.lock:
+            for uid in uids:
+                if t > self.last_rank_seen.get(uid, 0):
+                    self.last_rank_seen[sys.intern(uid)] = t
+
+    def on_refreshed(self, uid: str, t: float = None):
+        if t is None:
+            t = time.time()
+        with self.lock:
+            self.last_refresh[sys.intern(uid)] = t
+
+    def refresh_interval(self, uid: str, now: float) -> float:
+        last_seen = self.last_rank_seen.get(uid)
+        if last_seen is None:
+            return self.absent_min_interval
+        absence = now - last_seen
+        if absence <= self.presence_window:
+            return self.fresh_interval
+        return min(self.max_interval, max(self.absent_min_interval, absence))
+
+    def overdue(self, uid: str, now: float) -> float:
+        # 已过去的时间与刷新间隔之比，不小于1表示需要刷新，从未刷新过的最优先
+        last_refresh = self.last_refresh.get(uid)
+        if last_refresh is None:
+            return float("inf")
+        return (now - last_refresh) / self.refresh_interval(uid, now)
+
+    def select(self, uids: tuple, now: float = None) -> list[str]:
+        """
+        返回本次需要刷新的uid，按过期程度从高到低排列。每个uid至少消耗一个请求，
+        调用方在请求数达到预算时停止
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            due = [(self.overdue(uid, now), uid) for uid in uids]
+        due = [d for d in due if d[0] >= 1]
+        self.last_run_due = len(due)
+        return [uid for _, uid in heapq.nlargest(self.request_budget, due, key=lambda d: d[0])]
+
+    def get_status(self) -> dict:
+        return {
+            "tracked_count": len(self.last_refresh),
+            "rank_seen_count": len(self.last_rank_seen),
+            "request_budget": self.request_budget,
+            "last_run_due": self.last_run_due,
+            "last_run_traders": self.last_run_traders,
+            "last_run_requests": self.last_run_requests
+        }
@@ -0,0 +1,169 @@
+import heapq
+import threading
+import time
+
+from qtr.base.nonjsonable import NoneJsonable
+
+
+class TraderPollState(NoneJsonable):
+
+    def __init__(self, activity: float, next_due: float) -> None:
+        super().__init__()
+        self.activity = activity  # 仓位变动频率的指数移动平均，1表示每次轮询都有变动
+        self.next_due = next_due
+        self.last_poll: float = None
+        self.poll_count = 0
+        self.change_count = 0
+
+
+class TraderPollScheduler(NoneJsonable):
+    """
+    按交易活跃度安排带单人仓位轮询的优先级调度器。
+    每次轮询后根据do_position_diff_check的结果更新活跃度，轮询间隔为min_interval / activity，
+    并限制在[min_interval, max_staleness]之间，保证不活跃的带单人也不会超过max_staleness秒不被轮询
+    """
+
+    TIER_HOT = "hot"
+    TIER_WARM = "warm"
+    TIER_COLD = "cold"
+
+    def __init__(self, min_interval: float, max_staleness: float, decay: float = 0.3) -> None:
+        super().__init__()
+        self.min_interval = min_interval
+        self.max_staleness = max_staleness
+        self.decay = decay
+        self.states: dict[str, TraderPollState] = {}
+        self.due_heap: list[tuple[float, str]] = []
+        self.lock = threading.Lock()
+
+    def interval_for(self, activity: float) -> float:
+        if activity <= 0:
+            return self.max_staleness
+        return min(self.max_staleness, max(self.min_interval, self.min_interval / activity))
+
+    def schedule(self, uid: str, state: TraderPollState, next_due: float):
+        # 堆中旧的条目不删除，出堆时与state.next_due比对后丢弃
+        state.next_due = next_due
+        heapq.heappush(self.due_heap, (next_due, uid))
+
+    def sync(self, traders: list[str], now: float = None):
+        """
+        与当前共享仓位的带单人列表同步，新加入的带单人立即到期
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            current = set(traders)
+            for uid in list(self.states.keys()):
+                if uid not in current:
+                    del self.states[uid]
+            for uid in traders:
+                if uid not in self.states:
+                    state = TraderPollState(1.0, now)
+                    self.states[uid] = state
+                    self.schedule(uid, state, now)
+
+    def pop_due(self, now: float = None, limit: int = None) -> list[str]:
+        if now is None:
+            now = time.time()
+        due: list[str] = []
+        with self.lock:
+            while len(self.due_heap) > 0 and self.due_heap[0][0] <= now:
+                if limit is not None and len(due) >= limit:
+                    break
+                next_due, uid = heapq.heappop(self.due_heap)
+                state = self.states.get(uid)
+                if state is None or state.next_due != next_due:
+                    continue
+                # 出堆后在轮询结果返回前不再重复调度
+                state.next_due = None
+                due.append(uid)
+        return due
+
+    def next_due_time(self) -> float:
+        with self.lock:
+            while len(self.due_heap) > 0:
+                next_due, uid = self.due_heap[0]
+                state = self.states.get(uid)
+                if state is not None and state.next_due == next_due:
+                    return next_due
+                heapq.heappop(self.due_heap)
+        return None
+
+    def on_polled(self, uid: str, changed: bool, now: float = None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            state = self.states.get(uid)
+            if state is None:
+                return
+            state.activity = self.decay * (1.0 if changed else 0.0) + \
+                (1 - self.decay) * state.activity
+            state.last_poll = now
+            state.poll_count += 1
+            if changed:
+                state.change_count += 1
+            self.schedule(uid, state, now + self.interval_for(state.activity))
+
+    def export_state(self) -> dict:
+        """
+        uid -> (activity, next_due, last_poll, poll_count, change_count)，用于写入检查点
+        """
+        with self.lock:
+            return {uid: (state.activity, state.next_due, state.last_poll, state.poll_count, state.change_count)
+                    for uid, state in self.states.items()}
+
+    def restore_state(self, exported: dict, now: float = None):
+        """
+        从检查点恢复活跃度与到期时间，检查点写入时正在轮询的带单人立即到期
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            for uid, (activity, next_due, last_poll, poll_count, change_count) in exported.items():
+                state = TraderPollState(activity, next_due)
+                state.last_poll = last_poll
+                state.poll_count = poll_count
+                state.change_count = change_count
+                self.states[uid] = state
+                self.schedule(uid, state, now if next_due is None else next_due)
+
+    def on_poll_failed(self, uid: str, now: float = None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            state = self.states.get(uid)
+            if state is not None:
+                self.schedule(uid, state, now + self.min_interval)
+
+    def get_tier(self, uid: str) -> str:
+        state = self.states.get(uid)
+        if state is None:
+            return None
+        interval = self.interval_for(state.activity)
+        if interval <= self.min_interval * 4:
+            return self.TIER_HOT
+        if interval >= self.max_staleness / 2:
+            return self.TIER_COLD
+        return self.TIER_WARM
+
+    def get_status(self) -> dict:
+        now = time.time()
+        with self.lock:
+            tiers = {
+                self.TIER_HOT: 0,
+                self.TIER_WARM: 0,
+                self.TIER_COLD: 0
+            }
+            max_staleness = 0
+            for uid, state in self.states.items():
+                tiers[self.get_tier(uid)] += 1
+                if state.last_poll is not None:
+                    max_staleness = max(max_staleness, now - state.last_poll)
+            return {
+                "tracked_count": len(self.states),
+                "min_interval": self.min_interval,
+                "max_staleness": self.max_staleness,
+                "tiers": tiers,
+                "current_max_staleness": round(max_staleness, 3)
+            }
@@ -1,3 +1,5 @@
+from collections import deque
+import sys
 from sys import getsizeof
 from typing_extensions import Self
 
@@ -10,22 +12,101 @@ class Formatter():
         return getsizeof(s)
 
 class TraderPosition(Jsonable):
-    def make_position_list(raw_list: list[dict]):
-        new_position_list = []
-        for p in raw_list:
-            pos = TraderPosition(symbol=p.get("symbol"), leverage=p.get("leverage"),
-                                 amount=p.get("amount"), entry_price=p.get("entryPrice"),
-                                 update_time=p.get("updateTimeStamp"), mark_price=p.get("markPrice"),
-                                pnl=p.get("pnl"), roe=p.get("roe"), yellow=p.get("yellow"),
-                                trade_before=p.get("tradeBefore"))
-            new_position_list.append(pos)
-        return new_position_list
+    # 常驻内存的仓位数量很大，使用__slots__去掉每个实例的__dict__
+    __slots__ = ("symbol", "position_side", "leverage", "amount", "entry_price", "update_time",
+                 "mark_price", "pnl", "roe", "yellow", "trade_before")
+    # 旧仓位不超过该数量时diff_position_list使用线性扫描
+    DIFF_LINEAR_LIMIT = 16
+
+    def from_raw(p: dict):
+        # 从币安接口返回的仓位数据(驼峰字段)构造
+        return TraderPosition(symbol=p.get("symbol"), leverage=p.get("leverage"),
+                              amount=p.get("amount"), entry_price=p.get("entryPrice"),
+                              update_time=p.get("updateTimeStamp"), mark_price=p.get("markPrice"),
+                              pnl=p.get("pnl"), roe=p.get("roe"), yellow=p.get("yellow"),
+                              trade_before=p.get("tradeBefore"))
+
+    def from_raw_list(raw_list: list[dict]):
+        return [TraderPosition.from_raw(p) for p in raw_list]
+
+    def from_document(d: dict):
+        # 从to_document生成的文档(mongodb或mq消息)恢复
+        return TraderPosition(symbol=d.get("symbol"), leverage=d.get("leverage"),
+                              amount=d.get("amount"), entry_price=d.get("entry_price"),
+                              update_time=d.get("update_time"), mark_price=d.get("mark_price"),
+                              pnl=d.get("pnl"), roe=d.get("roe"), yellow=d.get("yellow"),
+                              trade_before=d.get("trade_before"))
+
+    def from_document_list(doc_list: list[dict]):
+        return [TraderPosition.from_document(d) for d in doc_list]
+
+    def to_document_list(positions: list):
+        return [p.to_document() for p in positions]
+
+    def from_compact(c: list):
+        # to_compact生成的定长数组，字段顺序与__slots__一致
+        return TraderPosition(symbol=c[0], leverage=c[2], amount=c[3], entry_price=c[4],
+                              update_time=c[5], mark_price=c[6], pnl=c[7], roe=c[8],
+                              yellow=c[9], trade_before=c[10])
+
+    def diff_position_list_linear(current_list: list, new_list: list):
+        changed = []
+        added = []
+        unmatched = list(current_list)
+        for pos in new_list:
+            symbol = pos.symbol
+            position_side = pos.position_side
+            for index, cp in enumerate(unmatched):
+                if cp.symbol == symbol and cp.position_side == position_side:
+                    del unmatched[index]
+                    if not cp.is_same_position(pos):
+                        changed.append((cp, pos))
+                    break
+            else:
+                added.append(pos)
+        # 剩余未匹配的即被删除的仓位，保持原列表顺序
+        return changed, added, unmatched
+
+    def diff_position_list(current_list: list, new_list: list):
+        """
+        以(symbol, position_side)为key一次遍历完成比对，返回(changed, added, removed)，
+        changed为(旧仓位, 新仓位)列表，顺序与逐个匹配的旧实现一致。
+        仓位很少时(最常见的情况)建索引的开销大于查找，直接线性扫描
+        """
+        if len(current_list) <= TraderPosition.DIFF_LINEAR_LIMIT:
+            return TraderPosition.diff_position_list_linear(current_list, new_list)
+        current_by_type: dict[tuple, deque] = {}
+        for p in current_list:
+            key = p.type_key()
+            same_type = current_by_type.get(key)
+            if same_type is None:
+                current_by_type[key] = deque([p])
+            else:
+                same_type.append(p)
+        changed = []
+        added = []
+        matched_ids = set()
+        for pos in new_list:
+            same_type = current_by_type.get(pos.type_key())
+            if same_type:
+                cp = same_type.popleft()
+                matched_ids.add(id(cp))
+                if not cp.is_same_position(pos):
+                    changed.append((cp, pos))
+            else:
+                added.append(pos)
+        removed = []
+        if len(matched_ids) < len(current_list):
+            # 未匹配的仓位表示被删除的仓位，按原列表顺序输出
+            removed = [p for p in current_list if id(p) not in matched_ids]
+        return changed, added, removed
 
     def __init__(self, symbol: str, leverage: int, amount: float, 
                  entry_price: float, update_time: int, mark_price: float = None, 
                  pnl: float = None, roe: float=None, yellow: bool = None, trade_before:bool = None) -> None:
         super().__init__()
-        self.symbol = symbol
+        # symbol的取值种类很少，intern后所有仓位共享同一个字符串对象
+        self.symbol = sys.intern(symbol) if symbol is not None else None
         self.position_side = TradingConstants.POSITION_SIDE_LONG \
             if amount > 0 else TradingConstants.POSITION_SIDE_SHORT
         self.leverage = leverage
@@ -40,6 +121,29 @@ class TraderPosition(Jsonable):
 
         pass
 
+    def to_document(self) -> dict:
+        return {
+            "symbol": self.symbol,
+            "position_side": self.position_side,
+            "leverage": self.leverage,
+            "amount": self.amount,
+            "entry_price": self.entry_price,
+            "update_time": self.update_time,
+            "mark_price": self.mark_price,
+            "pnl": self.pnl,
+            "roe": self.roe,
+            "yellow": self.yellow,
+            "trade_before": self.trade_before
+        }
+
+    def to_compact(self) -> list:
+        # 不带字段名的紧凑格式，用于增量历史记录
+        return [self.symbol, self.position_side, self.leverage, self.amount, self.entry_price,
+                self.update_time, self.mark_price, self.pnl, self.roe, self.yellow, self.trade_before]
+
+    def type_key(self) -> tuple:
+        return (self.symbol, self.position_side)
+
     def is_same_type(self, pos: Self):
         return self.symbol == pos.symbol and self.position_side == pos.position_side
 
@@ -3,7 +3,8 @@ import typing
 if typing.TYPE_CHECKING:
     from qtr.crawl.binance.futures_umargin.leaderboard_crawl_controller import LeaderboardCrawlController
 
-import requests
+import aiohttp
+import asyncio
 import threading
 import time
 import logging
@@ -12,6 +13,7 @@ from qtr.base.jsonable import Jsonable
 
 from qtr.crawl.binance.futures_umargin.trader_position import TraderPosition
 from qtr.utils.crawl_constants import CrawlConstants
+from qtr.utils import json_codec
 
 LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
               '-35s %(lineno) -5d: %(message)s')
@@ -31,123 +33,168 @@ class TraderPositionCrawlService(Jsonable):
         self.total_failed_times = 0
         self.last_crawl_count = 0
         self.last_fail_count = 0
+        self.has_error = False
+        self.event_loop: asyncio.AbstractEventLoop = None
+        self.async_session: aiohttp.ClientSession = None
+        self.before_round = None  # 每轮开始前在爬取线程中调用，worker节点借此应用协调器的分配
+        metrics = controller.metrics
+        self.parse_histogram = metrics.histogram("position_parse_seconds", "position response parse time")
+        self.diff_histogram = metrics.histogram("position_diff_seconds", "position diff time")
+        self.changed_counter = metrics.counter("position_changed_total", "polls that found position changes")
+        self.round_histogram = metrics.histogram(
+            "position_round_seconds", "position crawl round duration",
+            buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
 
-    def do_position_diff_check(self, uid: str, new_positions_list: list[TraderPosition]):
+    def do_position_diff_check(self, uid: str, new_positions_list: list[TraderPosition]) -> bool:
+        """
+        与内存中的仓位比对，返回仓位是否发生变化
+        """
         LOGGER.debug("do_position_diff_check")
         current_positions: list[TraderPosition] = self.controller.trader_position_mapping.get(
             uid)
         if current_positions is None:
             LOGGER.debug("do_position_diff_check new !")
             self.controller.on_trader_init_position(uid, new_positions_list)
-            self.controller.trader_position_mapping[uid] = new_positions_list[::]
-            return
+            self.controller.trader_position_mapping[uid] = new_positions_list
+            return False
 
-        current_positions = current_positions[0: len(current_positions)]
-        new_positions: list[TraderPosition] = new_positions_list[0: len(
-            new_positions_list)]
-        position_changed = False
+        begin = time.perf_counter()
+        changed_list, add_list, removed = TraderPosition.diff_position_list(
+            current_positions, new_positions_list)
+        self.diff_histogram.observe(time.perf_counter() - begin)
+        if len(changed_list) == 0 and len(add_list) == 0 and len(removed) == 0:
+            return False
+        LOGGER.debug("do_position_diff_check changed!")
         diff_ref = {
-            "changed": [],
-            "removed": [],
-            "added": []
+            "changed": changed_list,
+            "removed": removed,
+            "added": add_list
         }
-        if len(new_positions) > 0:
-            same_list: list[TraderPosition] = []
-            changed_list: list[TraderPosition] = []
-            add_list: list[TraderPosition] = []
-            removed: list[TraderPosition] = []
-            for pos in new_positions_list:
-                cp: TraderPosition = next(
-                    (p for p in current_positions if p.is_same_type(pos)), None)
-                if cp is not None:
-                    if cp.is_same_position(pos):
-                        # 仓位未变
-                        same_list.append(cp)
-                    else:
-                        # 仓位变动
-                        changed_list.append((cp, pos))
-                        position_changed = True
-                    current_positions.remove(cp)
-                    new_positions.remove(pos)
-                else:
-                    # 新增仓位
-                    add_list.append(pos)
-                    position_changed = True
-            if len(current_positions) > 0:
-                # 未匹配的仓位表示被删除的仓位
-                position_changed = True
-                removed.extend(current_positions)
-            if position_changed:
-                LOGGER.debug("do_position_diff_check changed!")
-                diff_ref["changed"] = changed_list
-                diff_ref["added"] = add_list
-                diff_ref["removed"] = removed
-                self.controller.on_trader_position_changed(
-                    uid, self.controller.trader_position_mapping.get(uid),
-                    new_positions_list, diff_ref)
-                self.controller.trader_position_mapping[uid] = new_positions_list[0: len(
-                    new_positions_list)]
-        elif len(current_positions) > 0:
-            LOGGER.debug("do_position_diff_check cleared!")
-            diff_ref["removed"].extend(current_positions)
-            self.controller.on_trader_position_changed(
-                uid, self.controller.trader_position_mapping.get(uid),
-                new_positions_list, diff_ref)
-            self.controller.trader_position_mapping[uid] = []
-        pass
+        scheduler = self.controller.position_scheduler
+        self.controller.detection_latency.record_diff(
+            diff_ref, time.time(), scheduler.get_tier(uid) if scheduler is not None else None)
+        self.controller.on_trader_position_changed(
+            uid, current_positions, new_positions_list, diff_ref)
+        # 仓位列表创建后不再被修改，无需复制
+        self.controller.trader_position_mapping[uid] = new_positions_list
+        self.changed_counter.inc()
+        return True
+
+    def on_position_response(self, uid: str, status_code: int, result: dict) -> bool:
+        """
+        处理一次仓位请求的结果，返回仓位是否变化，请求失败时返回None
+        """
+        self.last_crawl_count += 1
+        changed = None
+        if status_code == 200:
+            changed = False
+            self.total_success_times += 1
+            # LOGGER.info(str(result))
+            position_result: dict = result.get("data")
+            if position_result is not None:
+                position_list = position_result.get(
+                    "otherPositionRetList", [])
+                if position_list is not None:
+                    begin = time.perf_counter()
+                    new_positions = TraderPosition.from_raw_list(position_list)
+                    self.parse_histogram.observe(time.perf_counter() - begin)
+                    changed = self.do_position_diff_check(uid, new_positions)
+        elif status_code < 400:
+            print("not know how to handle ", status_code, uid)
+        else:
+            self.last_fail_count += 1
+            self.total_failed_times += 1
+            if status_code == 403:
+                self.has_error = True
+                print("failed", self.last_fail_count,
+                      self.total_failed_times)
+        return changed
+
+    def on_poll_done(self, uid: str, changed: bool):
+        scheduler = self.controller.position_scheduler
+        if scheduler is None:
+            return
+        if changed is None:
+            scheduler.on_poll_failed(uid)
+        else:
+            scheduler.on_polled(uid, changed)
+
+    def crawl_positions_sync(self, my_traders: list[str]):
+        for kv in my_traders:
+            try:
+                position_response = self.controller.http_client.post(
+                    CrawlConstants.POSITION_URL, {
+                        "encryptedUid": kv,
+                        "tradeType": "PERPETUAL"
+                    })
+                result = json_codec.loads(position_response.content) \
+                    if position_response.status_code == 200 else None
+                changed = self.on_position_response(kv, position_response.status_code, result)
+                self.on_poll_done(kv, changed)
+            except Exception as ex:
+                LOGGER.error(str(ex))
+                print(ex)
+                self.on_poll_done(kv, None)
+                continue
+
+    async def do_position_fetch_async(self, uid: str):
+        try:
+            status, result = await self.controller.http_client.post_async(
+                self.async_session, CrawlConstants.POSITION_URL, {
+                    "encryptedUid": uid,
+                    "tradeType": "PERPETUAL"
+                })
+            changed = self.on_position_response(uid, status, result)
+            self.on_poll_done(uid, changed)
+        except Exception as ex:
+            LOGGER.error(str(ex))
+            print(ex)
+            self.on_poll_done(uid, None)
+
+    async def crawl_positions_async(self, my_traders: list[str]):
+        """
+        并发爬取仓位：最多position_concurrency个请求同时进行，
+        请求发起速率由http_client中仓位接口的自适应限速器控制，一轮的耗时取决于速率预算而不是用户数乘以间隔
+        """
+        if self.async_session is None or self.async_session.closed:
+            # 会话跨轮次复用，保持与服务器的长连接
+            self.async_session = self.controller.http_client.create_async_session()
+        trader_iter = iter(my_traders)
+
+        async def worker():
+            # 所有worker共享同一个迭代器，单线程事件循环下无需加锁
+            for uid in trader_iter:
+                await self.do_position_fetch_async(uid)
+        await asyncio.gather(*[worker() for _ in range(self.controller.position_concurrency)])
 
     def fetch_trader_position(self):
         self.running = True
         self.last_crawl_count = 0
         self.last_fail_count = 0
         self.total_crawl_time += 1
-        # self.controller.trader_list_lock.acquire()
-        my_traders = self.controller.all_traders.copy()
-        # self.controller.trader_list_lock.release()
+        if self.before_round is not None:
+            self.before_round()
+        # 不可变快照，遍历期间排行榜线程的增删不会影响本轮
+        my_traders = self.controller.all_traders.snapshot()
         if CrawlConstants.ENABLE_CRAWL_USER_LIMIT:
             my_traders = my_traders[0: CrawlConstants.CRAWL_USER_LIMIT]
+        scheduler = self.controller.position_scheduler
+        if scheduler is not None:
+            # 按活跃度调度时，每轮只轮询已到期的带单人
+            scheduler.sync(my_traders)
+            my_traders = scheduler.pop_due()
         LOGGER.info("start new round of user position crawl, count: " + str(len(my_traders)))
         start_time = datetime.now()
-        has_error = False
-        for kv in my_traders:
-            try:
-                position_response = requests.post(CrawlConstants.POSITION_URL,
-                                                  json={
-                                                      "encryptedUid": kv,
-                                                      "tradeType": "PERPETUAL"
-                                                  })
-                time.sleep(self.controller.position_interval)
-                self.last_crawl_count += 1
-                if position_response.ok:
-                    # print(position_response.headers)
-                    if position_response.status_code == 200:
-                        self.total_success_times += 1
-                        result: dict = position_response.json()
-                        # LOGGER.info(str(result))
-                        position_result: dict = result.get("data")
-                        if position_result is not None:
-                            position_list = position_result.get(
-                                "otherPositionRetList", [])
-                            if position_list is not None:
-                                new_positions = TraderPosition.make_position_list(
-                                    position_list)
-                                self.do_position_diff_check(kv, new_positions)
-                    else:
-                        print("not know how to handle ", position_response.status_code, str(
-                            position_response))
-                else:
-                    self.last_fail_count += 1
-                    self.total_failed_times += 1
-                    if position_response.status_code == 403:
-                        has_error = True
-                        print("failed", self.last_fail_count,
-                              self.total_failed_times)
-            except Exception as ex:
-                LOGGER.error(str(ex))
-                print(ex)
-                continue
+        self.has_error = False
+        if self.controller.position_engine == CrawlConstants.POSITION_ENGINE_ASYNC:
+            if self.event_loop is None:
+                self.event_loop = asyncio.new_event_loop()
+            self.event_loop.run_until_complete(self.crawl_positions_async(my_traders))
+        else:
+            self.crawl_positions_sync(my_traders)
         end_time = datetime.now()
         self.last_crawl_time = end_time - start_time
+        self.round_histogram.observe(self.last_crawl_time.total_seconds())
         self.last_update = datetime.now()
         self.running = False
         LOGGER.info("user position crawl round done")
@@ -155,7 +202,13 @@ class TraderPositionCrawlService(Jsonable):
     def crawl_task(self):
         while True:
             self.fetch_trader_position()
-            time.sleep(5)
+            scheduler = self.controller.position_scheduler
+            if scheduler is None:
+                time.sleep(5)
+                continue
+            next_due = scheduler.next_due_time()
+            wait = 5 if next_due is None else next_due - time.time()
+            time.sleep(min(5, max(0.5, wait)))
 
     def start_task(self):
         crawl_thread = threading.Thread(target=self.crawl_task)
@@ -11,8 +11,12 @@ import time
 import logging
 from datetime import datetime, timedelta
 from qtr.base.jsonable import Jsonable
+from qtr.crawl.binance.futures_umargin.snapshot_deduplicator import SnapshotDeduplicator
+from qtr.crawl.binance.futures_umargin.trader_info_refresher import TraderInfoRefresher
+from qtr.crawl.binance.futures_umargin.trader_registry import TraderRegistry
 from qtr.utils.constants import TradingConstants
 from qtr.utils.crawl_constants import CrawlConstants
+from qtr.utils import json_codec
 
 LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
               '-35s %(lineno) -5d: %(message)s')
@@ -30,33 +34,83 @@ class TraderRanksCrawlService(Jsonable):
         self.last_rank_count = 0
         self.last_performance_update: datetime = datetime.now() - timedelta(seconds=100000)
         self.last_performance_count = 0
-        self.all_crawl_trader_ids = [] # 曾经在排行榜出现的所有uid，本爬虫将爬取所有用户信息以及战绩数据
+        self.all_crawl_trader_ids = TraderRegistry() # 曾经在排行榜出现的所有uid，本爬虫将爬取所有用户信息以及战绩数据
         self.trader_share_mapping = {
 
         }
+        self.share_seen_mapping: dict[str, float] = {}  # uid -> 最近一次从排行榜得到positionShared的时间
+        self.share_state_time_mapping: dict[str, float] = {}  # uid -> 启动时从库中得到的共享状态的时间
+        self.total_baseinfo_skipped = 0
+        self.total_new_trader_failed = 0  # 写库最终失败的新带单人数量
         self.task_lock = threading.BoundedSemaphore(1)
+        self.performance_dedup = SnapshotDeduplicator()
+        self.baseinfo_dedup = SnapshotDeduplicator()
+        self.info_refresher = TraderInfoRefresher(
+            request_budget=CrawlConstants.INFO_REFRESH_BUDGET,
+            fresh_interval=CrawlConstants.INFO_FRESH_INTERVAL,
+            presence_window=CrawlConstants.INFO_PRESENCE_WINDOW,
+            absent_min_interval=CrawlConstants.INFO_ABSENT_MIN_INTERVAL,
+            max_interval=CrawlConstants.INFO_MAX_INTERVAL)
+        metrics = controller.metrics
+        self.parse_histograms = {name: metrics.histogram(
+            "rank_parse_seconds", "rank crawl response parse time", {"endpoint": name})
+            for name in ("rank", "performance", "baseinfo")}
+        self.baseinfo_skipped_counter = metrics.counter(
+            "baseinfo_skipped_total", "baseinfo requests skipped by fresh rank share state")
 
     def build_all_trader_info(self):
-        # 此处是从总结库中获取最新结果
+        # 此处是从总结库中获取最新结果，每个集合各用一次带投影的游标读取，不再逐个uid查询
+        start_time = time.perf_counter()
         binance_crawl_summary_db = self.mongoclient[CrawlConstants.CRAWL_FU_SUMMARY_DB_NAME]
         binance_trader_col = binance_crawl_summary_db["trader"]
         binance_trader_board_info_col = binance_crawl_summary_db["board_info"]
-        all_trader: list[dict] = binance_trader_col.find()
-        all_shared_traders:list[str] = []
+        binance_trader_performance_col = binance_crawl_summary_db["performance"]
+        binance_trader_rank_col = binance_crawl_summary_db["rank"]
+        shared_mapping: dict[str, bool] = {}
+        shared_time_mapping: dict[str, float] = {}
+        board_infos = binance_trader_board_info_col.find(
+            {}, {"_id": 0, "uid": 1, "base_info": 1, "record_time_stamp": 1})
+        for board_info in board_infos:
+            base_info = board_info.get("base_info")
+            if base_info is not None:
+                shared_mapping[board_info.get("uid")] = base_info.get("positionShared", False)
+                shared_time_mapping[board_info.get("uid")] = board_info.get("record_time_stamp", 0)
+                self.baseinfo_dedup.warm(board_info.get("uid"), base_info)
+        performances = binance_trader_performance_col.find(
+            {}, {"_id": 0, "uid": 1, "performance": 1, "record_time_stamp": 1, "last_seen_stamp": 1})
+        for performance in performances:
+            uid = performance.get("uid")
+            if performance.get("performance") is not None:
+                self.performance_dedup.warm(uid, performance.get("performance"))
+            # 恢复上次刷新的时间，重启后按原进度继续增量刷新
+            self.info_refresher.warm_refresh(uid, performance.get("record_time_stamp"))
+            self.info_refresher.warm_refresh(uid, performance.get("last_seen_stamp"))
+        ranks = binance_trader_rank_col.find(
+            {}, {"_id": 0, "record_time_stamp": 1, "rank_list.encryptedUid": 1, "rank_list.positionShared": 1})
+        for rank in ranks:
+            rank_list: list[dict] = rank.get("rank_list", [])
+            record_time_stamp = rank.get("record_time_stamp", 0)
+            self.info_refresher.on_rank_seen([kv.get("encryptedUid") for kv in rank_list], record_time_stamp)
+            for kv in rank_list:
+                uid = kv.get("encryptedUid")
+                self.share_seen_mapping[uid] = max(record_time_stamp, self.share_seen_mapping.get(uid, 0))
+                # 排行榜比基本信息新时以排行榜上的共享状态为准
+                if record_time_stamp > shared_time_mapping.get(uid, 0):
+                    shared_mapping[uid] = kv.get("positionShared", False)
+                    shared_time_mapping[uid] = record_time_stamp
+        all_trader = binance_trader_col.find({}, {"_id": 0, "uid": 1})
+        all_shared_traders: list[str] = []
         for trader in all_trader:
             uid = trader.get("uid")
-            self.all_crawl_trader_ids.append(uid)
-            board_info: dict = binance_trader_board_info_col.find_one({
-                                                                      "uid": uid})
-            position_shared = False
-            if board_info is not None:
-                position_shared = board_info.get("base_info", {})\
-                    .get("positionShared", False)
-                if position_shared:
-                    all_shared_traders.append(uid)
+            self.all_crawl_trader_ids.add(uid)
+            position_shared = shared_mapping.get(uid, False)
+            if position_shared:
+                all_shared_traders.append(uid)
             self.trader_share_mapping[uid] = position_shared
+        self.share_state_time_mapping = shared_time_mapping
         self.controller.on_new_traders(all_shared_traders)
-        LOGGER.info("current all traders count " + str(len(self.all_crawl_trader_ids)))
+        LOGGER.info("current all traders count %d, loaded in %.3fs with 4 queries",
+                    len(self.all_crawl_trader_ids), time.perf_counter() - start_time)
 
     def setup(self):
         try:
@@ -71,6 +125,7 @@ class TraderRanksCrawlService(Jsonable):
             self.trader_board_info_summary_col = summary_db["board_info"]
             self.trader_performance_col = db["performance"]
             self.trader_performance_summary_col = summary_db["performance"]
+            self.ensure_indexes()
             self.build_all_trader_info()
 
             return True
@@ -79,34 +134,68 @@ class TraderRanksCrawlService(Jsonable):
             return False
         pass
 
+    def ensure_indexes(self):
+        provisioner = self.controller.index_provisioner
+        uid_index = [("uid", pymongo.ASCENDING)]
+        history_index = [("uid", pymongo.ASCENDING), ("record_time_stamp", pymongo.ASCENDING)]
+        provisioner.ensure([
+            provisioner.declare(self.trader_col, uid_index),
+            provisioner.declare(self.trader_summary_col, uid_index),
+            provisioner.declare(self.trader_rank_summary_col, [("record_time_stamp", pymongo.ASCENDING)]),
+            provisioner.declare(self.trader_board_info_col, history_index),
+            provisioner.declare(self.trader_board_info_summary_col, uid_index),
+            provisioner.declare(self.trader_performance_col, history_index),
+            provisioner.declare(self.trader_performance_summary_col, uid_index)
+        ])
+
     def has_trader(self, uid: str):
-        try:
-            self.all_crawl_trader_ids.index(uid)
-            return True
-        except ValueError as er:
-            return False
+        return uid in self.all_crawl_trader_ids
         
     def has_share_trader(self, uid:str):
         return self.trader_share_mapping.get(uid, False)
+
+    def update_share_state(self, uid: str, position_shared: bool) -> bool:
+        """
+        更新带单人的仓位共享状态，关闭共享时通知controller，返回是否为新开启共享
+        """
+        old_shared = self.trader_share_mapping.get(uid)
+        if old_shared and not position_shared:
+            # 用户关闭仓位共享
+            self.controller.on_trader_close_share(uid)
+        self.trader_share_mapping[uid] = position_shared
+        return position_shared and not old_shared
+
+    def is_share_state_fresh(self, uid: str) -> bool:
+        seen = self.share_seen_mapping.get(uid)
+        return seen is not None and time.time() - seen < CrawlConstants.SHARE_STATE_FRESH_INTERVAL
         
     def add_new_trader(self, trader: dict):
+        """
+        登记新的带单人并交给后写管道写库。写入最终失败时从all_crawl_trader_ids中移除，
+        下一次在排行榜上出现时重新写入，失败次数记录在total_new_trader_failed中
+        """
+        uid = trader.get("uid")
         now = datetime.strftime(datetime.now(), TradingConstants.TIME_FORMAT)
         entry = {
-            "uid": trader.get("uid"),
+            "uid": uid,
             "nickname": trader.get("nickname"),
             "crawl_status": True,
             "create_at": now,
             "last_update": now
         }
         try:
-            self.trader_col.insert_one(entry)
-            self.trader_summary_col.insert_one(entry)
-            return True
+            self.all_crawl_trader_ids.add(uid)
+            self.controller.mongo_writer.insert(self.trader_col, entry,
+                                                on_dropped=lambda operation: self.on_new_trader_dropped(uid))
+            self.controller.mongo_writer.insert(self.trader_summary_col, entry)
         except Exception as ex:
-            LOGGER.error("save new trader failed " + str(ex))
+            self.on_new_trader_dropped(uid)
             print("save new trader failed", ex)
-            return False
-        pass
+
+    def on_new_trader_dropped(self, uid: str):
+        self.total_new_trader_failed += 1
+        self.all_crawl_trader_ids.remove(uid)
+        LOGGER.error("save new trader failed " + uid)
 
     def clear_rank_summary(self):
         try:
@@ -125,8 +214,8 @@ class TraderRanksCrawlService(Jsonable):
                 "payload": payload,
                 "rank_list": rank_list
             }
-            self.trader_rank_col.insert_one(entry)
-            self.trader_rank_summary_col.insert_one(entry)
+            self.controller.mongo_writer.insert(self.trader_rank_col, entry)
+            self.controller.mongo_writer.insert(self.trader_rank_summary_col, entry)
         except Exception as ex:
             LOGGER.error("save trader rank failed " + str(ex))
             print("save trader rank error", ex)
@@ -136,15 +225,18 @@ class TraderRanksCrawlService(Jsonable):
         LOGGER.info("do_rank_list_fetch " + str(payload))
         new_share_traders: list[str] = []
         try:
-            list_response = requests.post(
-                CrawlConstants.RANK_URL, json=payload)
-            list_result: dict = list_response.json()
+            list_response = self.controller.http_client.post(
+                CrawlConstants.RANK_URL, payload)
+            with self.parse_histograms["rank"].time():
+                list_result: dict = json_codec.loads(list_response.content)
             if list_result.get("success", False):
                 self.last_rank_count += 1
                 data = list_result.get("data")
                 if data is not None:
                     kv_list: list[dict] = data
                     self.save_rank_result(payload, kv_list)
+                    now = time.time()
+                    self.info_refresher.on_rank_seen([kv.get("encryptedUid") for kv in kv_list], now)
                     for kv in kv_list:
                         e_uid = kv.get("encryptedUid")
                         nickname = kv.get("nickName")
@@ -153,153 +245,188 @@ class TraderRanksCrawlService(Jsonable):
                             "uid": e_uid,
                             "nickname": nickname
                         }
-                        if not self.has_trader(e_uid) and self.add_new_trader(trader):
-                            self.all_crawl_trader_ids.append(e_uid)
-                        
-                        if position_shared and not self.has_share_trader(e_uid):
+                        if not self.has_trader(e_uid):
+                            self.add_new_trader(trader)
+
+                        # 排行榜上已有共享状态，在有效期内无需再请求基本信息
+                        self.share_seen_mapping[e_uid] = now
+                        if self.update_share_state(e_uid, position_shared):
                             new_share_traders.append(e_uid)
 
                     if len(new_share_traders) > 0:
                         self.controller.on_new_traders(new_share_traders)
 
-        except requests.RequestException as re:
+        except (requests.RequestException, json_codec.DecodeError) as re:
+            # 被限流时币安可能返回html页面，解析失败与请求失败同样处理
             print("rank list fetch failed", payload, re)
             LOGGER.error("rank list fetch failed" + str(payload) + ";" + str(re))
     
     def fetch_trader_ranks(self):
         LOGGER.info("start fetch_trader_ranks")
         self.task_lock.acquire()
-        if self.last_rank_update is not None:
-            last_span = datetime.now() - self.last_rank_update
-            if last_span.total_seconds() < 60 * 10:
-                self.task_lock.release()
-                LOGGER.info("exit fetch_trader_ranks too fast")
-                return
-        self.clear_rank_summary()
-        start_time = datetime.now()
-        self.last_rank_count = 0
-        share_options = [True, False]
-        trader_options = [True, False]
-        periodTypes = ["DAILY", "WEEKLY", "MONTHLY", "ALL"]
-        statisticsTypes = ["PNL", "ROI"]
-        for share_option in share_options:
-            for trader_option in trader_options:
-                if share_option and trader_option: # 这两个参数为True时，返回的的数据是[]，不知何故。
-                    continue
-                for pt in periodTypes:
-                    for st in statisticsTypes:
-                        # 按日收益额的排名
-                        payload = {
-                            "isShared": share_option,
-                            "isTrader": trader_option,
-                            "periodType": pt,
-                            "statisticsType": st,
-                            "tradeType": "PERPETUAL"  # "PERPETUAL", "DELIVERY"
-                        }
-                        self.do_rank_list_fetch(payload)
-                        time.sleep(self.controller.rank_interval)
-        end_time = datetime.now()
-        self.last_rank_time = end_time - start_time
-        self.last_rank_update = datetime.now()
-        self.task_lock.release()
-        LOGGER.info("exit fetch_trader_ranks normally")
+        try:
+            if self.last_rank_update is not None:
+                last_span = datetime.now() - self.last_rank_update
+                if last_span.total_seconds() < 60 * 10:
+                    LOGGER.info("exit fetch_trader_ranks too fast")
+                    return
+            self.clear_rank_summary()
+            start_time = datetime.now()
+            self.last_rank_count = 0
+            share_options = [True, False]
+            trader_options = [True, False]
+            periodTypes = ["DAILY", "WEEKLY", "MONTHLY", "ALL"]
+            statisticsTypes = ["PNL", "ROI"]
+            for share_option in share_options:
+                for trader_option in trader_options:
+                    if share_option and trader_option: # 这两个参数为True时，返回的的数据是[]，不知何故。
+                        continue
+                    for pt in periodTypes:
+                        for st in statisticsTypes:
+                            # 按日收益额的排名
+                            payload = {
+                                "isShared": share_option,
+                                "isTrader": trader_option,
+                                "periodType": pt,
+                                "statisticsType": st,
+                                "tradeType": "PERPETUAL"  # "PERPETUAL", "DELIVERY"
+                            }
+                            # 请求速率由http_client的自适应限速器控制
+                            self.do_rank_list_fetch(payload)
+            end_time = datetime.now()
+            self.last_rank_time = end_time - start_time
+            self.last_rank_update = datetime.now()
+            LOGGER.info("exit fetch_trader_ranks normally")
+        finally:
+            self.task_lock.release()
+
+    def touch_summary(self, summary_col, uid: str):
+        # 数据未变化时只更新总结库中的最后确认时间
+        self.controller.mongo_writer.update(summary_col, {"uid": uid}, {
+            "$set": {
+                "last_seen": datetime.strftime(datetime.now(), TradingConstants.TIME_FORMAT),
+                "last_seen_stamp": time.time()
+            }
+        })
 
     def save_trader_performance(self, uid: str, performance: dict):
         try:
+            if self.performance_dedup.is_unchanged(uid, performance):
+                self.touch_summary(self.trader_performance_summary_col, uid)
+                return
             entry = {
                 "record_time":  datetime.strftime(datetime.now(), TradingConstants.TIME_FORMAT),
                 "record_time_stamp": time.time(),
                 "uid": uid,
                 "performance": performance
             }
-            self.trader_performance_col.insert_one(entry)
-            del entry["_id"]
-            self.trader_performance_summary_col.replace_one({"uid": uid}, entry, upsert=True)
+            # 写入被丢弃时撤销记录的哈希，下一次相同的数据仍会写入
+            on_dropped = lambda operation: self.performance_dedup.forget(uid)
+            self.controller.mongo_writer.insert(self.trader_performance_col, entry, on_dropped=on_dropped)
+            self.controller.mongo_writer.replace(self.trader_performance_summary_col, {"uid": uid}, entry,
+                                                 on_dropped=on_dropped)
         except Exception as ex:
             print("save trader performance error", ex)
         pass
 
     def save_trader_baseinfo(self, uid: str, baseinfo: dict):
         try:
-            entry = {
-                "record_time":  datetime.strftime(datetime.now(), TradingConstants.TIME_FORMAT),
-                "record_time_stamp": time.time(),
-                "uid": uid,
-                "base_info": baseinfo
-            }
-            self.trader_board_info_col.insert_one(entry)
-            del entry["_id"]
-            self.trader_board_info_summary_col.replace_one({"uid": uid}, entry, upsert=True)
-            positionShared = baseinfo.get("positionShared")
-            old_shared = self.trader_share_mapping.get(uid)
-            if old_shared is not None:
-                if old_shared and not positionShared:
-                    # 用户关闭仓位共享
-                    self.controller.on_trader_close_share(uid)
-            self.trader_share_mapping[uid] = positionShared
+            if self.baseinfo_dedup.is_unchanged(uid, baseinfo):
+                self.touch_summary(self.trader_board_info_summary_col, uid)
+            else:
+                entry = {
+                    "record_time":  datetime.strftime(datetime.now(), TradingConstants.TIME_FORMAT),
+                    "record_time_stamp": time.time(),
+                    "uid": uid,
+                    "base_info": baseinfo
+                }
+                on_dropped = lambda operation: self.baseinfo_dedup.forget(uid)
+                self.controller.mongo_writer.insert(self.trader_board_info_col, entry, on_dropped=on_dropped)
+                self.controller.mongo_writer.replace(self.trader_board_info_summary_col, {"uid": uid}, entry,
+                                                     on_dropped=on_dropped)
+            if self.update_share_state(uid, baseinfo.get("positionShared", False)):
+                self.controller.on_new_traders([uid])
 
         except Exception as ex:
             print("save trader base info error", ex)
         pass
 
-    def do_trader_info_fetch(self, uid: str):
+    def do_trader_info_fetch(self, uid: str) -> int:
+        """
+        刷新带单人的战绩与基本信息，返回发出的请求数
+        """
         payload = {
             "encryptedUid": uid,
             "tradeType": "PERPETUAL"
         }
         try:
-            response = requests.post(
-                CrawlConstants.PERFORMANCE_URL, json=payload)
-            result: dict = response.json()
+            response = self.controller.http_client.post(
+                CrawlConstants.PERFORMANCE_URL, payload)
+            with self.parse_histograms["performance"].time():
+                result: dict = json_codec.loads(response.content)
             if result.get("success", False):
                 data = result.get("data")
                 self.save_trader_performance(uid, data)
 
-        except requests.RequestException as re:
+        except (requests.RequestException, json_codec.DecodeError) as re:
             print("trader performance fetch failed", payload, re)
+        if self.is_share_state_fresh(uid):
+            self.total_baseinfo_skipped += 1
+            self.baseinfo_skipped_counter.inc()
+            return 1
         payload = {
             "encryptedUid": uid
         }
         try:
-            response = requests.post(
-                CrawlConstants.BASEINFO_URL, json=payload)
-            result: dict = response.json()
+            response = self.controller.http_client.post(
+                CrawlConstants.BASEINFO_URL, payload)
+            with self.parse_histograms["baseinfo"].time():
+                result: dict = json_codec.loads(response.content)
             if result.get("success", False):
                 data = result.get("data")
                 self.save_trader_baseinfo(uid, data)
-        except requests.RequestException as re:
+        except (requests.RequestException, json_codec.DecodeError) as re:
             print("trader base info fetch failed", payload, re)
-        pass
+        return 2
 
     def fetch_trader_info(self):
         LOGGER.info("start fetch_trader_info")
         self.task_lock.acquire()
-        if self.last_performance_update is not None:
-            last_span = datetime.now() - self.last_performance_update
-            if last_span.total_seconds() < 60 * 10:
-                self.task_lock.release()
-                LOGGER.info("exit fetch_trader_info too fast")
-                return
-        start_time = datetime.now()
-        self.last_performance_count = 0
-        traders: list[str] = self.all_crawl_trader_ids.copy()
-        if CrawlConstants.ENABLE_CRAWL_USER_LIMIT:
-            traders = traders[0: CrawlConstants.CRAWL_USER_LIMIT]
-        for trader_id in traders:
-            self.do_trader_info_fetch(trader_id)
-            self.last_performance_count += 1
-            time.sleep(self.controller.user_info_interval)
-        end_time = datetime.now()
-        self.last_performance_time = end_time - start_time
-        self.last_performance_update = datetime.now()
-        self.task_lock.release()
-        LOGGER.info("exit fetch_trader_info normally")
+        try:
+            if self.last_performance_update is not None:
+                last_span = datetime.now() - self.last_performance_update
+                if last_span.total_seconds() < 60 * 10:
+                    LOGGER.info("exit fetch_trader_info too fast")
+                    return
+            start_time = datetime.now()
+            self.last_performance_count = 0
+            traders: tuple = self.all_crawl_trader_ids.snapshot()
+            if CrawlConstants.ENABLE_CRAWL_USER_LIMIT:
+                traders = traders[0: CrawlConstants.CRAWL_USER_LIMIT]
+            # 只刷新最过期的一批，请求数不超过每次运行的预算
+            request_count = 0
+            for trader_id in self.info_refresher.select(traders):
+                if request_count >= self.info_refresher.request_budget:
+                    break
+                request_count += self.do_trader_info_fetch(trader_id)
+                # 失败的uid也记为已刷新，避免每次运行都被同一批失败的uid占满预算
+                self.info_refresher.on_refreshed(trader_id)
+                self.last_performance_count += 1
+            self.info_refresher.last_run_requests = request_count
+            self.info_refresher.last_run_traders = self.last_performance_count
+            end_time = datetime.now()
+            self.last_performance_time = end_time - start_time
+            self.last_performance_update = datetime.now()
+            LOGGER.info("exit fetch_trader_info normally")
+        finally:
+            self.task_lock.release()
 
     def crawl_task(self):
         self.fetch_trader_ranks()
         self.fetch_trader_info()
         schedule.every().day.at("02:00").do(self.fetch_trader_ranks)
-        schedule.every().day.at("06:00").do(self.fetch_trader_info)
+        # 增量刷新，每次只处理预算内最过期的带单人
+        schedule.every(CrawlConstants.INFO_REFRESH_PERIOD).minutes.do(self.fetch_trader_info)
         while True:
             schedule.run_pending()
             time.sleep(10)
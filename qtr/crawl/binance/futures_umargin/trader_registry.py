@@ -0,0 +1,77 @@
+import sys
+import threading
+
+from qtr.base.nonjsonable import NoneJsonable
+
+
+class TraderRegistry(NoneJsonable):
+    """
+    线程安全的带单人uid登记表：O(1)的成员判断与增删，uid经过intern。
+    遍历使用snapshot()返回的不可变tuple，写入后首次读取时才重建快照，读取方无需复制也不会与写入方竞争
+    """
+
+    def __init__(self, uids: list[str] = None) -> None:
+        super().__init__()
+        self.members: dict[str, None] = {}  # 使用dict保持加入顺序
+        self.cached_snapshot: tuple = ()
+        self.dirty = False
+        self.lock = threading.Lock()
+        if uids is not None:
+            self.add_all(uids)
+
+    def __contains__(self, uid: str) -> bool:
+        return uid in self.members
+
+    def __len__(self) -> int:
+        return len(self.members)
+
+    def add(self, uid: str) -> bool:
+        with self.lock:
+            if uid in self.members:
+                return False
+            self.members[sys.intern(uid)] = None
+            self.dirty = True
+            return True
+
+    def add_all(self, uids: list[str]) -> list[str]:
+        added = []
+        with self.lock:
+            for uid in uids:
+                if uid not in self.members:
+                    uid = sys.intern(uid)
+                    self.members[uid] = None
+                    added.append(uid)
+            if len(added) > 0:
+                self.dirty = True
+        return added
+
+    def remove(self, uid: str) -> bool:
+        with self.lock:
+            if uid not in self.members:
+                return False
+            del self.members[uid]
+            self.dirty = True
+            return True
+
+    def replace_all(self, uids: list[str]):
+        with self.lock:
+            self.members = dict.fromkeys([sys.intern(uid) for uid in uids])
+            self.dirty = True
+
+    def snapshot(self) -> tuple:
+        if not self.dirty:
+            return self.cached_snapshot
+        with self.lock:
+            if self.dirty:
+                self.cached_snapshot = tuple(self.members.keys())
+                self.dirty = False
+            return self.cached_snapshot
+
+    def get_status(self) -> dict:
+        with self.lock:
+            memory = sys.getsizeof(self.members) + sys.getsizeof(self.cached_snapshot) + \
+                sum([sys.getsizeof(uid) for uid in self.members.keys()])
+            return {
+                "size": len(self.members),
+                "memory_bytes": memory
+            }
@@ -0,0 +1,234 @@
+import aiohttp
+import asyncio
+import threading
+import logging
+import time
+import requests
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from qtr.base.nonjsonable import NoneJsonable
+from qtr.utils.crawl_constants import CrawlConstants
+from qtr.utils import json_codec
+from qtr.utils.metrics import MetricsRegistry
+from qtr.utils.rate_limiter import AdaptiveRateLimiter
+
+LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
+              '-35s %(lineno) -5d: %(message)s')
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.INFO)
+
+
+class RetryPolicy(NoneJsonable):
+    """
+    单个接口的重试策略，同步请求转换成urllib3的Retry，异步请求由BinanceHttpClient自行重试
+    """
+
+    def __init__(self, total: int = 2, backoff_factor: float = 0.5,
+                 status_forcelist: tuple = (500, 502, 503, 504)) -> None:
+        super().__init__()
+        self.total = total
+        self.backoff_factor = backoff_factor
+        self.status_forcelist = status_forcelist
+
+    def to_urllib3_retry(self) -> Retry:
+        return Retry(total=self.total, connect=self.total, read=self.total,
+                     status=self.total, backoff_factor=self.backoff_factor,
+                     status_forcelist=self.status_forcelist,
+                     allowed_methods=frozenset(["POST"]),
+                     respect_retry_after_header=True,
+                     raise_on_status=False)
+
+    def backoff_time(self, attempt: int) -> float:
+        return self.backoff_factor * (2 ** attempt)
+
+
+class BinanceHttpClient(NoneJsonable):
+    """
+    币安bapi接口的共享传输层：每个接口持有一个保持长连接的连接池，
+    统一压缩协商、连接/读取超时以及按接口区分的重试策略，所有爬虫服务共用一个实例
+    """
+
+    DEFAULT_HEADERS = {
+        "Accept-Encoding": "gzip, deflate",
+        "Content-Type": "application/json"
+    }
+
+    DEFAULT_RETRY_POLICIES = {
+        CrawlConstants.RANK_URL: RetryPolicy(total=3),
+        CrawlConstants.PERFORMANCE_URL: RetryPolicy(total=2),
+        CrawlConstants.BASEINFO_URL: RetryPolicy(total=2),
+        # 仓位会被反复轮询，失败后等下一轮即可
+        CrawlConstants.POSITION_URL: RetryPolicy(total=1)
+    }
+
+    ENDPOINT_NAMES = {
+        CrawlConstants.RANK_URL: "rank",
+        CrawlConstants.PERFORMANCE_URL: "performance",
+        CrawlConstants.BASEINFO_URL: "baseinfo",
+        CrawlConstants.POSITION_URL: "position"
+    }
+
+    # 被判定为限流的状态码，触发限速器乘性降速
+    THROTTLE_STATUS = (403, 429, 500, 502, 503, 504)
+
+    def __init__(self, connect_timeout: float = CrawlConstants.HTTP_CONNECT_TIMEOUT,
+                 read_timeout: float = CrawlConstants.HTTP_READ_TIMEOUT,
+                 pool_size: int = CrawlConstants.HTTP_POOL_SIZE,
+                 retry_policies: dict = None,
+                 metrics: MetricsRegistry = None) -> None:
+        super().__init__()
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_size = pool_size
+        self.retry_policies: dict[str, RetryPolicy] = self.DEFAULT_RETRY_POLICIES.copy()
+        if retry_policies is not None:
+            self.retry_policies.update(retry_policies)
+        self.sessions: dict[str, requests.Session] = {}
+        self.session_lock = threading.Lock()
+        self.limiters: dict[str, AdaptiveRateLimiter] = {}
+        for url in self.ENDPOINT_NAMES.keys():
+            self.limiters[url] = AdaptiveRateLimiter(
+                rate=CrawlConstants.ADAPTIVE_MIN_RATE,
+                min_rate=CrawlConstants.ADAPTIVE_MIN_RATE,
+                max_rate=CrawlConstants.ADAPTIVE_MAX_RATES.get(url, 1),
+                increase_step=CrawlConstants.ADAPTIVE_INCREASE_STEP,
+                decrease_factor=CrawlConstants.ADAPTIVE_DECREASE_FACTOR)
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        # 热路径上直接使用预先创建的指标对象
+        self.latency_histograms = {url: self.metrics.histogram(
+            "http_request_seconds", "request latency including retries", {"endpoint": name})
+            for url, name in self.ENDPOINT_NAMES.items()}
+
+    def on_request_error(self, url: str, error: str):
+        self.metrics.counter("http_errors_total", "failed requests by error class", {
+            "endpoint": self.ENDPOINT_NAMES.get(url, url),
+            "error": error
+        }).inc()
+
+    def error_class(self, status: int) -> str:
+        if status in self.THROTTLE_STATUS:
+            return "throttled"
+        return "http_" + str(status // 100) + "xx"
+
+    def set_rate(self, url: str, rate: float):
+        limiter = self.limiters.get(url)
+        if limiter is not None:
+            limiter.set_rate(rate)
+
+    def get_rate_status(self) -> dict:
+        return {self.ENDPOINT_NAMES[url]: limiter.get_status()
+                for url, limiter in self.limiters.items()}
+
+    def parse_retry_after(self, value: str) -> float:
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        try:
+            return parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+
+    def on_response(self, url: str, status: int, headers):
+        if status >= 400:
+            self.on_request_error(url, self.error_class(status))
+        limiter = self.limiters.get(url)
+        if limiter is None:
+            return
+        if status in self.THROTTLE_STATUS:
+            retry_after = self.parse_retry_after(headers.get("Retry-After"))
+            LOGGER.warning("throttled by %s, status %d, retry after %s",
+                           self.ENDPOINT_NAMES.get(url, url), status, str(retry_after))
+            limiter.on_throttled(status, retry_after)
+        elif status < 400:
+            limiter.on_success()
+
+    def get_retry_policy(self, url: str) -> RetryPolicy:
+        policy = self.retry_policies.get(url)
+        if policy is None:
+            policy = RetryPolicy()
+        return policy
+
+    def get_session(self, url: str) -> requests.Session:
+        session = self.sessions.get(url)
+        if session is not None:
+            return session
+        with self.session_lock:
+            session = self.sessions.get(url)
+            if session is None:
+                session = requests.Session()
+                session.headers.update(self.DEFAULT_HEADERS)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size,
+                                      max_retries=self.get_retry_policy(url).to_urllib3_retry())
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self.sessions[url] = session
+        return session
+
+    def post(self, url: str, payload: dict) -> requests.Response:
+        limiter = self.limiters.get(url)
+        if limiter is not None:
+            limiter.acquire()
+        begin = time.perf_counter()
+        try:
+            response = self.get_session(url).post(url, json=payload,
+                                                  timeout=(self.connect_timeout, self.read_timeout))
+        except requests.RequestException as ex:
+            self.on_request_error(url, type(ex).__name__)
+            raise ex
+        histogram = self.latency_histograms.get(url)
+        if histogram is not None:
+            histogram.observe(time.perf_counter() - begin)
+        self.on_response(url, response.status_code, response.headers)
+        return response
+
+    def create_async_session(self) -> aiohttp.ClientSession:
+        """
+        创建异步会话，必须在使用它的事件循环中调用。会话应跨轮次复用以保持长连接
+        """
+        connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+        timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout,
+                                        sock_read=self.read_timeout)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                     headers=self.DEFAULT_HEADERS, auto_decompress=True)
+
+    async def post_async(self, session: aiohttp.ClientSession, url: str, payload: dict):
+        """
+        返回(status, result)，result仅在status为200时为解析后的json
+        """
+        policy = self.get_retry_policy(url)
+        limiter = self.limiters.get(url)
+        attempt = 0
+        while True:
+            try:
+                if limiter is not None:
+                    await limiter.acquire_async()
+                begin = time.perf_counter()
+                async with session.post(url, json=payload) as response:
+                    histogram = self.latency_histograms.get(url)
+                    if histogram is not None:
+                        histogram.observe(time.perf_counter() - begin)
+                    self.on_response(url, response.status, response.headers)
+                    if response.status in policy.status_forcelist and attempt < policy.total:
+                        raise aiohttp.ClientResponseError(response.request_info, response.history,
+                                                          status=response.status)
+                    result = json_codec.loads(await response.read()) \
+                        if response.status == 200 else None
+                    return response.status, result
+            except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                if not isinstance(ex, aiohttp.ClientResponseError):
+                    self.on_request_error(url, type(ex).__name__)
+                if attempt >= policy.total:
+                    raise ex
+                await asyncio.sleep(policy.backoff_time(attempt))
+                attempt += 1
+
+    def close(self):
+        with self.session_lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
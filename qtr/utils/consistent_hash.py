@@ -0,0 +1,57 @@
+import bisect
+import hashlib
+
+from qtr.base.nonjsonable import NoneJsonable
+
+
+class ConsistentHashRing(NoneJsonable):
+    """
+    带虚拟节点的一致性哈希环，节点加入或离开时只有相邻区间的key需要迁移
+    """
+
+    def __init__(self, nodes: list[str] = None, virtual_nodes: int = 64) -> None:
+        super().__init__()
+        self.virtual_nodes = virtual_nodes
+        self.ring_hashes: list[int] = []
+        self.ring_nodes: list[str] = []
+        self.nodes: set[str] = set()
+        if nodes is not None:
+            for node in nodes:
+                self.add_node(node)
+
+    def hash_key(self, key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[0:8], "big")
+
+    def add_node(self, node: str):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for i in range(self.virtual_nodes):
+            h = self.hash_key(node + "#" + str(i))
+            index = bisect.bisect(self.ring_hashes, h)
+            self.ring_hashes.insert(index, h)
+            self.ring_nodes.insert(index, node)
+
+    def remove_node(self, node: str):
+        if node not in self.nodes:
+            return
+        self.nodes.remove(node)
+        keep = [(h, n) for h, n in zip(self.ring_hashes, self.ring_nodes) if n != node]
+        self.ring_hashes = [h for h, _ in keep]
+        self.ring_nodes = [n for _, n in keep]
+
+    def get_node(self, key: str) -> str:
+        if len(self.ring_hashes) == 0:
+            return None
+        index = bisect.bisect(self.ring_hashes, self.hash_key(key))
+        if index == len(self.ring_hashes):
+            index = 0
+        return self.ring_nodes[index]
+
+    def partition(self, keys: list[str]) -> dict[str, list[str]]:
+        shards: dict[str, list[str]] = {node: [] for node in self.nodes}
+        for key in keys:
+            node = self.get_node(key)
+            if node is not None:
+                shards[node].append(key)
+        return shards
@@ -1,17 +1,93 @@
+import os
+
 
 class CrawlConstants(object):
     CRAWL_FU_DB_NAME = "binance_crawl_futures_umargin"
     CRAWL_FU_SUMMARY_DB_NAME = "binance_crawl_futures_umargin_summary"
     CRAWL_RPC_QUEUE_NAME = "quantrend.binance_futures_umargin_leaderboard_crawl_controller"
+    # rpc并发处理的线程数与预取数，status由每STATUS_SNAPSHOT_INTERVAL秒重建的快照直接返回
+    RPC_WORKER_COUNT = 4
+    RPC_PREFETCH_COUNT = 8
+    STATUS_SNAPSHOT_INTERVAL = 2
 
 
     ENABLE_CRAWL_USER_LIMIT = False
     CRAWL_USER_LIMIT = 10
 
-    RANK_URL = "https://www.binance.com/bapi/futures/v3/public/future/leaderboard/getLeaderboardRank"
-    PERFORMANCE_URL = "https://www.binance.com/bapi/futures/v2/public/future/leaderboard/getOtherPerformance"
-    BASEINFO_URL = "https://www.binance.com/bapi/futures/v2/public/future/leaderboard/getOtherLeaderboardBaseInfo"
-    POSITION_URL = "https://www.binance.com/bapi/futures/v1/public/future/leaderboard/getOtherPosition"
+    # 接口的域名部分，可以通过环境变量指向本地的模拟服务器(见benchmark/leaderboard_stub_server.py)
+    BAPI_BASE_URL = os.environ.get("QTR_BINANCE_BAPI_BASE_URL", "https://www.binance.com").rstrip("/")
+    RANK_URL = BAPI_BASE_URL + "/bapi/futures/v3/public/future/leaderboard/getLeaderboardRank"
+    PERFORMANCE_URL = BAPI_BASE_URL + "/bapi/futures/v2/public/future/leaderboard/getOtherPerformance"
+    BASEINFO_URL = BAPI_BASE_URL + "/bapi/futures/v2/public/future/leaderboard/getOtherLeaderboardBaseInfo"
+    POSITION_URL = BAPI_BASE_URL + "/bapi/futures/v1/public/future/leaderboard/getOtherPosition"
+
+    # 仓位爬取引擎: sync为逐个请求的串行模式，async为基于aiohttp的并发模式
+    POSITION_ENGINE_SYNC = "sync"
+    POSITION_ENGINE_ASYNC = "async"
+
+    # 仓位爬取的分片模式: standalone为单进程爬取全部带单人，coordinator为按一致性哈希分发给worker节点
+    SHARD_MODE_STANDALONE = "standalone"
+    SHARD_MODE_COORDINATOR = "coordinator"
+    SHARD_CONTROL_QUEUE = "quantrend.binance_futures_umargin_position_shard_control"
+    SHARD_RESULT_QUEUE = "quantrend.binance_futures_umargin_position_shard_result"
+    SHARD_WORKER_QUEUE_PREFIX = "quantrend.binance_futures_umargin_position_shard_worker."
+    SHARD_HEARTBEAT_INTERVAL = 5
+    SHARD_WORKER_TIMEOUT = 30
+    SHARD_REBALANCE_INTERVAL = 2
+
+    # 仓位变动事件流，发布到topic exchange
+    POSITION_EVENT_EXCHANGE = "quantrend.binance_futures_umargin_position_events"
+    POSITION_EVENT_BATCH_SIZE = 200
+    POSITION_EVENT_FLUSH_INTERVAL = 0.05
+    POSITION_EVENT_MAX_PENDING = 100000
+
+    # 本地检查点的路径与写入间隔(秒)，默认不使用检查点，需通过环境变量或参数指定路径
+    CHECKPOINT_PATH = os.environ.get("QTR_CRAWL_CHECKPOINT_PATH", "")
+    CHECKPOINT_INTERVAL = 60
+
+    # 关闭时等待仓位命令处理与mongodb写入完成的最长时间(秒)
+    SHUTDOWN_TIMEOUT = 30
+
+    # 启动时批量加载数据时每次$in查询的uid数量
+    WARM_LOAD_BATCH_SIZE = 5000
+
+    # 仓位历史格式: operations集合保存完整的新旧仓位，position_history集合保存增量与定期关键帧
+    POSITION_HISTORY_FULL = True
+    POSITION_HISTORY_DELTA = True
+    POSITION_KEYFRAME_INTERVAL = 50
+
+    # 仓位命令队列: 写入线程数、总容量以及队列满时的背压策略
+    POSITION_WRITER_COUNT = 4
+    POSITION_QUEUE_CAPACITY = 10000
+    POSITION_BACKPRESSURE_BLOCK = "block"
+    POSITION_BACKPRESSURE_COALESCE = "coalesce"
+
+    # 带单人战绩与基本信息的增量刷新配置，时间单位为秒(INFO_REFRESH_PERIOD为分钟)
+    INFO_REFRESH_PERIOD = 60
+    INFO_REFRESH_BUDGET = 2000
+    INFO_FRESH_INTERVAL = 24 * 3600
+    INFO_PRESENCE_WINDOW = 3 * 24 * 3600
+    INFO_ABSENT_MIN_INTERVAL = 7 * 24 * 3600
+    INFO_MAX_INTERVAL = 30 * 24 * 3600
+    # 排行榜上的positionShared在此时间内有效，期间不再请求基本信息
+    SHARE_STATE_FRESH_INTERVAL = 2 * 24 * 3600
+
+    # http传输层配置
+    HTTP_CONNECT_TIMEOUT = 5
+    HTTP_READ_TIMEOUT = 15
+    HTTP_POOL_SIZE = 16
+
+    # AIMD自适应限速配置，速率单位为每秒请求数
+    ADAPTIVE_MIN_RATE = 0.05
+    ADAPTIVE_INCREASE_STEP = 0.05
+    ADAPTIVE_DECREASE_FACTOR = 0.5
+    # 各接口默认的速率上限，配置的速率更高时以配置为准
+    ADAPTIVE_MAX_RATES = {
+        RANK_URL: 5,
+        PERFORMANCE_URL: 5,
+        BASEINFO_URL: 5,
+        POSITION_URL: 20
+    }
 
     
     pass
\ No newline at end of file
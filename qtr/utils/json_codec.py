@@ -0,0 +1,86 @@
+"""
+json编解码的统一入口。安装了orjson时使用orjson，否则使用标准库json，两者输出的结构一致:
+Jsonable编码为to_document()或其__dict__，datetime按TradingConstants.TIME_FORMAT格式化，NoneJsonable编码为null，
+sympy/numpy等可选类型沿用json_encoder中的延迟处理。dumps返回utf-8编码的bytes，loads接受bytes或str
+"""
+import json
+from datetime import datetime
+from typing import Any
+
+from qtr.base.jsonable import Jsonable
+from qtr.base.nonjsonable import NoneJsonable
+from qtr.utils.constants import TradingConstants
+from qtr.utils.json_encoder import LAZY_TYPE_HANDLERS
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+# loads解析失败时抛出的异常，两种实现都是ValueError的子类。
+# 与requests的Response.json()不同，它不是RequestException，调用方需要单独捕获
+DecodeError = orjson.JSONDecodeError if orjson is not None else json.JSONDecodeError
+
+
+def encode_jsonable(o: Jsonable):
+    to_document = getattr(o, "to_document", None)
+    if to_document is not None:
+        return to_document()
+    # 编码过程中不会修改，无需像TradingObjectEncode那样复制__dict__
+    return o.__dict__
+
+
+def encode_datetime(o: datetime):
+    return datetime.strftime(o, TradingConstants.TIME_FORMAT)
+
+
+def encode_none(o: NoneJsonable):
+    return None
+
+
+# 具体类型 -> 编码函数，首次遇到某个类型时按isinstance确定后缓存，之后只需一次字典查找
+type_encoders: dict[type, Any] = {}
+
+
+def find_encoder(cls: type):
+    if issubclass(cls, Jsonable):
+        return encode_jsonable
+    if issubclass(cls, datetime):
+        return encode_datetime
+    if issubclass(cls, NoneJsonable):
+        return encode_none
+    for handler in LAZY_TYPE_HANDLERS:
+        handler_type = handler.resolve()
+        if handler_type is not None and issubclass(cls, handler_type):
+            return handler.converter
+    return None
+
+
+def default(o: Any) -> Any:
+    cls = type(o)
+    encoder = type_encoders.get(cls)
+    if encoder is None:
+        encoder = find_encoder(cls)
+        if encoder is None:
+            raise TypeError("Object of type " + cls.__name__ + " is not JSON serializable")
+        type_encoders[cls] = encoder
+    return encoder(o)
+
+
+if orjson is not None:
+    # datetime交给default按仓库统一的时间格式输出，与标准库路径一致
+    ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj, default=default, option=ORJSON_OPTIONS)
+
+    def loads(data):
+        return orjson.loads(data)
+else:
+    def dumps(obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, default=default,
+                          separators=(",", ":")).encode("utf-8")
+
+    def loads(data):
+        return json.loads(data)
@@ -1,20 +1,58 @@
 from typing import Any
 import json
-import sympy
+import sys
 from datetime import datetime
 from qtr.base.nonjsonable import NoneJsonable
 from qtr.base.jsonable import Jsonable
 from qtr.utils.constants import TradingConstants
 
+
+class LazyTypeHandler(object):
+    """
+    可选依赖中类型的编码方式。只有当模块已被其他代码导入时才会解析类型，
+    编码器自身不导入这些模块，没有用到它们的进程不需要为此付出导入时间和内存
+    """
+
+    def __init__(self, module_name: str, type_getter, converter) -> None:
+        self.module_name = module_name
+        self.type_getter = type_getter  # module -> type或type的tuple
+        self.converter = converter
+        self.resolved_type = None
+
+    def resolve(self):
+        if self.resolved_type is None:
+            module = sys.modules.get(self.module_name)
+            if module is not None:
+                self.resolved_type = self.type_getter(module)
+        return self.resolved_type
+
+
+LAZY_TYPE_HANDLERS: list[LazyTypeHandler] = [
+    LazyTypeHandler("sympy", lambda sympy: sympy.core.numbers.Float, float),
+    LazyTypeHandler("numpy", lambda numpy: numpy.floating, float),
+    LazyTypeHandler("numpy", lambda numpy: numpy.integer, int),
+    LazyTypeHandler("numpy", lambda numpy: numpy.ndarray, lambda o: o.tolist())
+]
+
+
+def register_type_handler(module_name: str, type_getter, converter):
+    LAZY_TYPE_HANDLERS.append(LazyTypeHandler(module_name, type_getter, converter))
+
+
 class TradingObjectEncode(json.JSONEncoder):
     def default(self, o: Any) -> Any:
         if isinstance(o, Jsonable):
+            to_document = getattr(o, "to_document", None)
+            if to_document is not None:
+                return to_document()
             obj = o.__dict__.copy()
             return obj
-        elif isinstance(o, sympy.core.numbers.Float):
-            return float(o)
         elif isinstance(o, datetime):
             return datetime.strftime(o, TradingConstants.TIME_FORMAT)
         elif isinstance(o, NoneJsonable):
             return None
-        return super().default(o)
\ No newline at end of file
+        for handler in LAZY_TYPE_HANDLERS:
+            handler_type = handler.resolve()
+            if handler_type is not None and isinstance(o, handler_type):
+                return handler.converter(o)
+        return super().default(o)
@@ -0,0 +1,232 @@
+import bisect
+import threading
+import time
+
+from qtr.base.nonjsonable import NoneJsonable
+
+# 默认的延迟分桶，单位为秒
+DEFAULT_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                           0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter(NoneJsonable):
+
+    def __init__(self, name: str, labels: tuple) -> None:
+        super().__init__()
+        self.name = name
+        self.labels = labels
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self.lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge(NoneJsonable):
+    """
+    可以直接设置，也可以绑定一个取值函数在导出时读取，例如队列深度
+    """
+
+    def __init__(self, name: str, labels: tuple) -> None:
+        super().__init__()
+        self.name = name
+        self.labels = labels
+        self.value = 0
+        self.function = None
+
+    def set(self, value: float):
+        self.value = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def snapshot(self):
+        if self.function is not None:
+            try:
+                return self.function()
+            except Exception:
+                return None
+        return self.value
+
+
+class Histogram(NoneJsonable):
+    """
+    固定分桶的直方图，observe只做一次二分查找和几次加法
+    """
+
+    def __init__(self, name: str, labels: tuple, buckets: tuple = DEFAULT_LATENCY_BUCKETS) -> None:
+        super().__init__()
+        self.name = name
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # 最后一个为+Inf
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+            if value > self.max:
+                self.max = value
+
+    def observe_many(self, values: list[float]):
+        indexes = [bisect.bisect_left(self.buckets, value) for value in values]
+        with self.lock:
+            for index in indexes:
+                self.counts[index] += 1
+            for value in values:
+                self.sum += value
+                if value > self.max:
+                    self.max = value
+            self.count += len(values)
+
+    def time(self):
+        return HistogramTimer(self)
+
+    def quantile(self, q: float, counts: list[int], count: int) -> float:
+        # 在目标分桶内按线性插值估算分位数，超出最后一个分桶时以最大值为上界
+        if count == 0:
+            return 0
+        rank = q * count
+        cumulative = 0
+        for index, bucket_count in enumerate(counts):
+            if bucket_count > 0 and cumulative + bucket_count >= rank:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else max(self.max, lower)
+                upper = min(upper, self.max)
+                lower = min(lower, upper)
+                return round(lower + (upper - lower) * (rank - cumulative) / bucket_count, 6)
+            cumulative += bucket_count
+        return self.max
+
+    def snapshot(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+            count = self.count
+            max_value = self.max
+        return {
+            "count": count,
+            "sum": round(total, 6),
+            "avg": round(total / count, 6) if count > 0 else 0,
+            "max": round(max_value, 6),
+            "p50": self.quantile(0.5, counts, count),
+            "p90": self.quantile(0.9, counts, count),
+            "p95": self.quantile(0.95, counts, count),
+            "p99": self.quantile(0.99, counts, count),
+            "buckets": counts
+        }
+
+
+class HistogramTimer(object):
+
+    def __init__(self, histogram: Histogram) -> None:
+        self.histogram = histogram
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class MetricsRegistry(NoneJsonable):
+    """
+    进程内的轻量指标登记表，支持计数器、仪表和固定分桶直方图。
+    热路径上应在初始化时取得指标对象并保存，之后的inc/observe不再查表
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.metrics: dict[tuple, object] = {}  # (name, labels) -> metric
+        self.helps: dict[str, str] = {}
+        self.lock = threading.Lock()
+
+    def get_or_create(self, cls, name: str, help: str, labels: dict, **kwargs):
+        label_items = tuple(sorted(labels.items())) if labels is not None else ()
+        key = (name, label_items)
+        metric = self.metrics.get(key)
+        if metric is not None:
+            return metric
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                metric = cls(name, label_items, **kwargs)
+                self.metrics[key] = metric
+                if help is not None:
+                    self.helps[name] = help
+        return metric
+
+    def counter(self, name: str, help: str = None, labels: dict = None) -> Counter:
+        return self.get_or_create(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str = None, labels: dict = None) -> Gauge:
+        return self.get_or_create(Gauge, name, help, labels)
+
+    def histogram(self, name: str, help: str = None, labels: dict = None,
+                  buckets: tuple = DEFAULT_LATENCY_BUCKETS) -> Histogram:
+        return self.get_or_create(Histogram, name, help, labels, buckets=buckets)
+
+    def snapshot(self) -> dict:
+        """
+        {name: [{"labels": {...}, "value": ...}]}，直方图的value为分桶统计
+        """
+        result: dict[str, list] = {}
+        for (name, labels), metric in list(self.metrics.items()):
+            result.setdefault(name, []).append({
+                "labels": dict(labels),
+                "value": metric.snapshot()
+            })
+        return result
+
+    def format_labels(self, labels: tuple, extra: tuple = ()) -> str:
+        items = labels + extra
+        if len(items) == 0:
+            return ""
+        return "{" + ",".join([k + "=\"" + str(v).replace("\"", "\\\"") + "\"" for k, v in items]) + "}"
+
+    def to_prometheus(self) -> str:
+        """
+        导出为Prometheus文本格式
+        """
+        lines = []
+        typed = set()
+        for (name, labels), metric in sorted(list(self.metrics.items()), key=lambda kv: kv[0]):
+            if name not in typed:
+                typed.add(name)
+                if name in self.helps:
+                    lines.append("# HELP " + name + " " + self.helps[name])
+                metric_type = "counter" if isinstance(metric, Counter) else \
+                    "histogram" if isinstance(metric, Histogram) else "gauge"
+                lines.append("# TYPE " + name + " " + metric_type)
+            if isinstance(metric, Histogram):
+                with metric.lock:
+                    counts = list(metric.counts)
+                    total = metric.sum
+                    count = metric.count
+                cumulative = 0
+                for index, bucket in enumerate(metric.buckets):
+                    cumulative += counts[index]
+                    lines.append(name + "_bucket" + self.format_labels(labels, (("le", repr(bucket)),)) +
+                                 " " + str(cumulative))
+                lines.append(name + "_bucket" + self.format_labels(labels, (("le", "+Inf"),)) +
+                             " " + str(count))
+                lines.append(name + "_sum" + self.format_labels(labels) + " " + repr(total))
+                lines.append(name + "_count" + self.format_labels(labels) + " " + str(count))
+            else:
+                value = metric.snapshot()
+                lines.append(name + self.format_labels(labels) + " " +
+                             ("NaN" if value is None else repr(float(value))))
+        return "\n".join(lines) + "\n"
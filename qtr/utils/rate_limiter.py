@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import math
+import threading
+import time
+
+from qtr.base.nonjsonable import NoneJsonable
+
+LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
+              '-35s %(lineno) -5d: %(message)s')
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.INFO)
+
+
+class RateLimiter(NoneJsonable):
+    """
+    按固定速率放行请求的限速器(GCRA算法)，同时支持线程阻塞等待与asyncio等待。
+    rate为每秒允许的请求数，burst为允许的突发请求数。
+    """
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        super().__init__()
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.theoretical_arrival = 0.0
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate: float):
+        with self.lock:
+            self.rate = rate
+
+    def reserve(self) -> float:
+        """
+        预约一次请求，返回需要等待的秒数
+        """
+        with self.lock:
+            if self.rate is None or self.rate <= 0:
+                return 0
+            interval = 1.0 / self.rate
+            now = time.monotonic()
+            tat = max(self.theoretical_arrival, now)
+            delay = max(0.0, tat - now - (self.burst - 1) * interval)
+            self.theoretical_arrival = tat + interval
+            return delay
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """
+    AIMD自适应限速器：响应正常时每秒加性提升increase_step的速率，
+    遇到限流(403/429/5xx)时乘性降低速率，并遵守服务器返回的Retry-After。
+    max_rate为默认的速率上限，set_rate设置的速率更高时以设置的速率为上限，不会被默认上限截断
+    """
+
+    def __init__(self, rate: float, min_rate: float, max_rate: float,
+                 increase_step: float = 0.05, decrease_factor: float = 0.5,
+                 decrease_cooldown: float = 1.0, burst: int = 1) -> None:
+        super().__init__(rate, burst)
+        self.min_rate = min_rate
+        self.default_max_rate = max_rate
+        self.max_rate = max_rate
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown = decrease_cooldown  # 并发请求同时被限流时，冷却期内只降速一次
+        self.backoff_until = 0.0
+        self.last_decrease = 0.0
+        self.total_success = 0
+        self.total_throttled = 0
+        self.last_throttled_status: int = None
+        self.last_throttled_time: float = None
+
+    def set_rate(self, rate: float):
+        with self.lock:
+            # 配置的速率作为上限，但不低于默认上限；不限速(inf)时无法做加性增减，仍使用默认上限
+            if math.isfinite(rate):
+                self.max_rate = max(self.default_max_rate, rate)
+            else:
+                self.max_rate = self.default_max_rate
+            self.rate = min(self.max_rate, max(self.min_rate, rate))
+            if self.rate != rate:
+                LOGGER.info("rate %s clamped to %s (min %s, max %s)", rate, self.rate, self.min_rate, self.max_rate)
+
+    def reserve(self) -> float:
+        with self.lock:
+            now = time.monotonic()
+            if self.backoff_until > now and self.theoretical_arrival < self.backoff_until:
+                self.theoretical_arrival = self.backoff_until
+        return super().reserve()
+
+    def on_success(self):
+        with self.lock:
+            self.total_success += 1
+            # 每个成功响应增加step/rate，响应按rate到达时相当于每秒增加step
+            self.rate = min(self.max_rate, self.rate + self.increase_step / self.rate)
+
+    def on_throttled(self, status: int, retry_after: float = None):
+        with self.lock:
+            now = time.monotonic()
+            self.total_throttled += 1
+            self.last_throttled_status = status
+            self.last_throttled_time = time.time()
+            if now - self.last_decrease >= self.decrease_cooldown:
+                self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+                self.last_decrease = now
+            if retry_after is not None and retry_after > 0:
+                self.backoff_until = max(self.backoff_until, now + retry_after)
+
+    def get_status(self) -> dict:
+        with self.lock:
+            backoff_remaining = max(0.0, self.backoff_until - time.monotonic())
+            return {
+                "rate": round(self.rate, 4),
+                "min_rate": self.min_rate,
+                "max_rate": self.max_rate,
+                "in_backoff": backoff_remaining > 0,
+                "backoff_remaining": round(backoff_remaining, 3),
+                "total_success": self.total_success,
+                "total_throttled": self.total_throttled,
+                "last_throttled_status": self.last_throttled_status,
+                "last_throttled_time": self.last_throttled_time
+            }
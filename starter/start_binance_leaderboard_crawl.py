@@ -1,4 +1,7 @@
 import logging
+import os
+import signal
+import threading
 
 from qtr.crawl.binance.futures_umargin.leaderboard_crawl_controller import LeaderboardCrawlController
 from qtr.utils.constants import TradingConstants
@@ -13,4 +16,12 @@ LOGGER.info("ready to setup")
 if binanceLeaderboardCrawlController.setup():
     LOGGER.info("ready to start crawl")
     binanceLeaderboardCrawlController.start_crawl()
-    LOGGER.info("crawl launched")
\ No newline at end of file
+    LOGGER.info("crawl launched")
+    # 收到SIGTERM/SIGINT时先关闭controller再退出，爬虫线程不是守护线程，直接退出
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+    while not stop_event.wait(1):
+        pass
+    binanceLeaderboardCrawlController.shutdown()
+    os._exit(0)
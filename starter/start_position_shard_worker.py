@@ -0,0 +1,24 @@
+import logging
+import os
+import sys
+
+from qtr.crawl.binance.futures_umargin.position_shard_worker import PositionShardWorker
+from qtr.utils.constants import TradingConstants
+
+LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
+              '-35s %(lineno) -5d: %(message)s')
+LOGGER = logging.getLogger(__name__)
+logging.basicConfig(level=logging.WARNING, format=LOG_FORMAT)
+
+# 用法: python start_position_shard_worker.py [worker_id] [mq_url]
+# 同一台机器上可以用不同的worker_id启动多个worker，协调器端以shard_mode="coordinator"启动controller
+worker_id = sys.argv[1] if len(sys.argv) > 1 else None
+mq_url = sys.argv[2] if len(sys.argv) > 2 else TradingConstants.DEFAULT_MQ_URL
+
+worker = PositionShardWorker(worker_id=worker_id, mq_url=mq_url)
+crawl_thread = worker.start_task()
+try:
+    crawl_thread.join()
+except KeyboardInterrupt:
+    worker.leave()
+    os._exit(0)
@@ -0,0 +1,70 @@
+import unittest
+
+from qtr.crawl.binance.futures_umargin.crawl_checkpoint import CrawlCheckpoint
+from qtr.crawl.binance.futures_umargin.trader_ranks_crawl_service import TraderRanksCrawlService
+from qtr.crawl.binance.futures_umargin.trader_registry import TraderRegistry
+from qtr.utils.metrics import MetricsRegistry
+
+
+class FakeController(object):
+
+    def __init__(self) -> None:
+        self.metrics = MetricsRegistry()
+        self.all_traders = TraderRegistry()
+        self.trader_position_mapping = {}
+        self.position_scheduler = None
+        self.rank_crawl_service = TraderRanksCrawlService(self)
+
+    def on_new_traders(self, uids: list[str]):
+        self.all_traders.add_all(uids)
+
+    def on_trader_close_share(self, uid: str):
+        self.all_traders.remove(uid)
+
+
+class RestoreShareStateTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.controller = FakeController()
+        self.checkpoint = CrawlCheckpoint(self.controller, "unused", 60)
+        self.state = {
+            "time": 100,
+            "positions": {},
+            "share_traders": ["kept", "closed_in_db"],
+            "share_state": {"kept": True, "closed_in_db": True, "opened_after_db": True, "reopened_in_db": False},
+        }
+
+    def build_from_db(self, shared: dict[str, tuple[bool, float]]):
+        # 模拟build_all_trader_info: 按库中的共享状态建立映射并加入共享带单人
+        rank_service = self.controller.rank_crawl_service
+        rank_service.trader_share_mapping = {uid: v[0] for uid, v in shared.items()}
+        rank_service.share_state_time_mapping = {uid: v[1] for uid, v in shared.items()}
+        self.controller.on_new_traders([uid for uid, v in shared.items() if v[0]])
+
+    def test_db_newer_than_checkpoint(self):
+        self.checkpoint.restore_positions(self.state)
+        self.build_from_db({
+            "kept": (True, 50),
+            "closed_in_db": (False, 200),
+            "opened_after_db": (False, 50),
+            "reopened_in_db": (True, 200),
+        })
+        self.checkpoint.restore_share_state(self.state)
+        self.assertEqual(set(self.controller.all_traders.snapshot()),
+                         {"kept", "opened_after_db", "reopened_in_db"})
+        self.assertFalse(self.controller.rank_crawl_service.trader_share_mapping["closed_in_db"])
+
+    def test_share_trader_missing_in_db(self):
+        self.checkpoint.restore_positions(self.state)
+        self.build_from_db({})
+        self.checkpoint.restore_share_state(self.state)
+        self.assertEqual(set(self.controller.all_traders.snapshot()),
+                         {"kept", "closed_in_db", "opened_after_db"})
+
+    def test_restore_positions_does_not_add_share_traders(self):
+        self.checkpoint.restore_positions(self.state)
+        self.assertEqual(len(self.controller.all_traders), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
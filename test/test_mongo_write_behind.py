@@ -0,0 +1,100 @@
+import unittest
+
+from pymongo import InsertOne, ReplaceOne, UpdateOne
+from pymongo.errors import PyMongoError
+
+from qtr.base.db.mongo_write_behind import MongoWriteBehind
+
+
+class FakeCollection(object):
+    """
+    记录bulk_write收到的操作，fail_times次之前整批失败
+    """
+
+    def __init__(self, fail_times: int = 0) -> None:
+        self.full_name = "test.collection"
+        self.fail_times = fail_times
+        self.batches: list[list] = []
+
+    def bulk_write(self, operations: list, ordered: bool = True):
+        if self.fail_times > 0:
+            self.fail_times -= 1
+            raise PyMongoError("fake failure")
+        self.batches.append(operations)
+
+
+class MongoWriteBehindTest(unittest.TestCase):
+
+    def test_replace_then_update_folds_into_replace(self):
+        collection = FakeCollection()
+        writer = MongoWriteBehind()
+        writer.replace(collection, {"uid": "u1"}, {"uid": "u1", "v": 1})
+        writer.update(collection, {"uid": "u1"}, {"$set": {"last_seen": 2}})
+        self.assertEqual(writer.pending_count, 1)
+        writer.flush()
+        self.assertEqual(len(collection.batches), 1)
+        operation = collection.batches[0][0]
+        self.assertEqual(operation, ReplaceOne({"uid": "u1"}, {"uid": "u1", "v": 1, "last_seen": 2}, upsert=True))
+
+    def test_update_then_replace_keeps_replace(self):
+        collection = FakeCollection()
+        writer = MongoWriteBehind()
+        writer.update(collection, {"uid": "u1"}, {"$set": {"last_seen": 2}})
+        writer.replace(collection, {"uid": "u1"}, {"uid": "u1", "v": 3})
+        writer.flush()
+        self.assertEqual(collection.batches[0], [ReplaceOne({"uid": "u1"}, {"uid": "u1", "v": 3}, upsert=True)])
+
+    def test_updates_are_merged(self):
+        collection = FakeCollection()
+        writer = MongoWriteBehind()
+        writer.update(collection, {"uid": "u1"}, {"$set": {"a": 1, "b": 1}})
+        writer.update(collection, {"uid": "u1"}, {"$set": {"b": 2}})
+        writer.flush()
+        self.assertEqual(collection.batches[0], [UpdateOne({"uid": "u1"}, {"$set": {"a": 1, "b": 2}}, upsert=False)])
+
+    def test_unsupported_update_is_rejected(self):
+        writer = MongoWriteBehind()
+        with self.assertRaises(ValueError):
+            writer.update(FakeCollection(), {"uid": "u1"}, {"$inc": {"a": 1}})
+        with self.assertRaises(ValueError):
+            writer.update(FakeCollection(), {"uid": "u1"}, {"$set": {"a.b": 1}})
+
+    def test_retry_is_folded_before_newer_write(self):
+        collection = FakeCollection(fail_times=1)
+        writer = MongoWriteBehind()
+        writer.replace(collection, {"uid": "u1"}, {"uid": "u1", "v": 1})
+        writer.flush()
+        # 失败的替换重新入队后，新的$set合并在其之后
+        writer.update(collection, {"uid": "u1"}, {"$set": {"last_seen": 2}})
+        writer.flush()
+        self.assertEqual(collection.batches[0],
+                         [ReplaceOne({"uid": "u1"}, {"uid": "u1", "v": 1, "last_seen": 2}, upsert=True)])
+        self.assertEqual(writer.total_retried_ops, 1)
+
+    def test_on_dropped_after_max_retries(self):
+        collection = FakeCollection(fail_times=10)
+        writer = MongoWriteBehind(max_retries=2)
+        dropped = []
+        writer.insert(collection, {"uid": "u1"}, on_dropped=dropped.append)
+        writer.replace(collection, {"uid": "u2"}, {"uid": "u2"}, on_dropped=lambda op: dropped.append("u2"))
+        for _ in range(3):
+            writer.flush()
+        self.assertEqual(writer.pending_count, 0)
+        self.assertEqual(writer.total_dropped_ops, 2)
+        self.assertEqual(len(dropped), 2)
+        self.assertIsInstance(dropped[0], InsertOne)
+        self.assertEqual(dropped[1], "u2")
+
+    def test_stop_flushes_pending(self):
+        collection = FakeCollection(fail_times=1)
+        writer = MongoWriteBehind(flush_interval=60)
+        writer.start()
+        for i in range(10):
+            writer.insert(collection, {"i": i})
+        self.assertTrue(writer.stop(5))
+        self.assertEqual(sum([len(batch) for batch in collection.batches]), 10)
+        self.assertFalse(writer.running)
+
+
+if __name__ == "__main__":
+    unittest.main()
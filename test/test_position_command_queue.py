@@ -0,0 +1,127 @@
+import threading
+import unittest
+
+from qtr.crawl.binance.futures_umargin.position_command_queue import PositionCommandQueue
+from qtr.crawl.binance.futures_umargin.trader_position import TraderPosition
+from qtr.utils.crawl_constants import CrawlConstants
+
+
+def make_position(symbol: str, amount: float) -> TraderPosition:
+    return TraderPosition(symbol=symbol, leverage=10, amount=amount, entry_price=100.0, update_time=1)
+
+
+def make_diff_command(uid: str, old: list[TraderPosition], new: list[TraderPosition]) -> dict:
+    changed, added, removed = TraderPosition.diff_position_list(old, new)
+    return {
+        "name": "diff",
+        "uid": uid,
+        "old": old,
+        "new": new,
+        "diff": {"changed": changed, "added": added, "removed": removed}
+    }
+
+
+def make_queue(capacity: int, backpressure: str) -> PositionCommandQueue:
+    # 不启动写入线程，直接检查队列内容
+    return PositionCommandQueue(lambda command: None, worker_count=1, capacity=capacity,
+                                backpressure=backpressure)
+
+
+class PositionCommandQueueTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.a = [make_position("BTCUSDT", 1)]
+        self.b = [make_position("BTCUSDT", 2)]
+        self.c = [make_position("BTCUSDT", 2), make_position("ETHUSDT", -3)]
+
+    def test_no_coalesce_below_capacity(self):
+        queue = make_queue(10, CrawlConstants.POSITION_BACKPRESSURE_COALESCE)
+        queue.put(make_diff_command("u1", self.a, self.b))
+        queue.put(make_diff_command("u1", self.b, self.a))
+        shard = queue.shards[0]
+        self.assertEqual(len(shard.commands), 2)
+        self.assertEqual(queue.total_coalesced, 0)
+        self.assertEqual(len(shard.commands[0]["diff"]["changed"]), 1)
+        self.assertEqual(len(shard.commands[1]["diff"]["changed"]), 1)
+
+    def test_coalesce_diff_when_full(self):
+        queue = make_queue(1, CrawlConstants.POSITION_BACKPRESSURE_COALESCE)
+        queue.put(make_diff_command("u1", self.a, self.b))
+        queue.put(make_diff_command("u1", self.b, self.c))
+        shard = queue.shards[0]
+        self.assertEqual(len(shard.commands), 1)
+        self.assertEqual(queue.total_coalesced, 1)
+        merged = shard.commands[0]
+        self.assertEqual(merged["name"], "diff")
+        self.assertIs(merged["old"], self.a)
+        self.assertIs(merged["new"], self.c)
+        self.assertEqual([(p[0].amount, p[1].amount) for p in merged["diff"]["changed"]], [(1, 2)])
+        self.assertEqual([p.symbol for p in merged["diff"]["added"]], ["ETHUSDT"])
+        self.assertEqual(merged["diff"]["removed"], [])
+
+    def test_merge_diff_into_new_keeps_diff(self):
+        queue = make_queue(1, CrawlConstants.POSITION_BACKPRESSURE_COALESCE)
+        queue.put({"name": "new", "uid": "u1", "positions": self.a})
+        queue.put(make_diff_command("u1", self.a, self.b))
+        queue.put(make_diff_command("u1", self.b, self.c))
+        merged = queue.shards[0].commands[0]
+        self.assertEqual(queue.total_coalesced, 2)
+        self.assertEqual(merged["name"], "new")
+        self.assertIs(merged["positions"], self.a)
+        self.assertIs(merged["new"], self.c)
+        self.assertEqual([(p[0].amount, p[1].amount) for p in merged["diff"]["changed"]], [(1, 2)])
+        self.assertEqual([p.symbol for p in merged["diff"]["added"]], ["ETHUSDT"])
+
+    def test_new_command_is_never_merged(self):
+        queue = make_queue(1, CrawlConstants.POSITION_BACKPRESSURE_COALESCE)
+        queue.put(make_diff_command("u1", self.a, self.b))
+        blocked = threading.Thread(target=queue.put, args=({"name": "new", "uid": "u1", "positions": self.c},))
+        blocked.start()
+        blocked.join(0.2)
+        self.assertTrue(blocked.is_alive())
+        self.assertEqual(queue.take(queue.shards[0])["name"], "diff")
+        blocked.join(1)
+        self.assertFalse(blocked.is_alive())
+        self.assertEqual(queue.take(queue.shards[0])["name"], "new")
+        self.assertEqual(queue.total_coalesced, 0)
+
+    def test_coalesce_blocks_without_pending_command(self):
+        queue = make_queue(1, CrawlConstants.POSITION_BACKPRESSURE_COALESCE)
+        queue.put(make_diff_command("u1", self.a, self.b))
+        blocked = threading.Thread(target=queue.put, args=(make_diff_command("u2", self.a, self.b),))
+        blocked.start()
+        blocked.join(0.2)
+        self.assertTrue(blocked.is_alive())
+        queue.take(queue.shards[0])
+        blocked.join(1)
+        self.assertFalse(blocked.is_alive())
+        self.assertEqual(queue.total_blocked, 1)
+
+    def test_block_mode_never_merges(self):
+        queue = make_queue(1, CrawlConstants.POSITION_BACKPRESSURE_BLOCK)
+        queue.put(make_diff_command("u1", self.a, self.b))
+        blocked = threading.Thread(target=queue.put, args=(make_diff_command("u1", self.b, self.c),))
+        blocked.start()
+        blocked.join(0.2)
+        self.assertTrue(blocked.is_alive())
+        first = queue.take(queue.shards[0])
+        blocked.join(1)
+        self.assertFalse(blocked.is_alive())
+        second = queue.take(queue.shards[0])
+        self.assertIs(first["new"], self.b)
+        self.assertIs(second["new"], self.c)
+        self.assertEqual(queue.total_coalesced, 0)
+        self.assertEqual(queue.total_blocked, 1)
+
+    def test_taken_command_is_not_merged(self):
+        queue = make_queue(1, CrawlConstants.POSITION_BACKPRESSURE_COALESCE)
+        queue.put(make_diff_command("u1", self.a, self.b))
+        taken = queue.take(queue.shards[0])
+        queue.put(make_diff_command("u1", self.b, self.c))
+        self.assertIs(taken["new"], self.b)
+        self.assertEqual(len(queue.shards[0].commands), 1)
+        self.assertEqual(queue.total_coalesced, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+
+from qtr.crawl.binance.futures_umargin.position_event_publisher import PositionEventPublisher
+from qtr.crawl.binance.futures_umargin.trader_position import TraderPosition
+
+
+def make_position(symbol: str) -> TraderPosition:
+    return TraderPosition(symbol=symbol, leverage=10, amount=1.0, entry_price=100.0, update_time=1)
+
+
+class PendingOverflowTest(unittest.TestCase):
+    # 不启动发布线程，也不连接broker，只检查内存队列
+
+    def setUp(self) -> None:
+        self.publisher = PositionEventPublisher("amqp://unused", batch_size=3, flush_interval=0.01, max_pending=4)
+
+    def routing_keys(self) -> list[str]:
+        return [e[0] for e in self.publisher.pending]
+
+    def publish(self, *symbols: str):
+        self.publisher.publish_diff("u", {"added": [make_position(s) for s in symbols]}, 1.0)
+
+    def test_publish_drops_oldest(self):
+        self.publish("S1USDT", "S2USDT", "S3USDT")
+        self.publish("S4USDT", "S5USDT", "S6USDT")
+        self.assertEqual(self.routing_keys(),
+                         ["u.S3USDT.added", "u.S4USDT.added", "u.S5USDT.added", "u.S6USDT.added"])
+        self.assertEqual(self.publisher.total_dropped, 2)
+
+    def test_requeue_drops_oldest(self):
+        self.publish("S1USDT", "S2USDT", "S3USDT")
+        batch = self.publisher.take_batch()
+        # 发布失败期间又有新的事件进入队列
+        self.publish("S4USDT", "S5USDT", "S6USDT")
+        self.publisher.requeue(batch)
+        self.assertEqual(self.routing_keys(),
+                         ["u.S3USDT.added", "u.S4USDT.added", "u.S5USDT.added", "u.S6USDT.added"])
+        self.assertEqual(self.publisher.total_dropped, 2)
+
+    def test_requeue_keeps_order(self):
+        self.publish("S1USDT", "S2USDT", "S3USDT", "S4USDT")
+        batch = self.publisher.take_batch()
+        self.publisher.requeue(batch)
+        self.assertEqual(self.routing_keys(),
+                         ["u.S1USDT.added", "u.S2USDT.added", "u.S3USDT.added", "u.S4USDT.added"])
+        self.assertEqual(self.publisher.total_dropped, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,140 @@
+import random
+import unittest
+
+import pymongo
+
+from qtr.crawl.binance.futures_umargin.position_history import PositionHistoryReader, PositionHistoryWriter
+from qtr.crawl.binance.futures_umargin.trader_position import TraderPosition
+
+
+def match(doc: dict, query: dict) -> bool:
+    # 只实现PositionHistoryReader用到的相等、$lte与$gt条件
+    for field, condition in query.items():
+        value = doc.get(field)
+        if isinstance(condition, dict):
+            if "$lte" in condition and not value <= condition["$lte"]:
+                return False
+            if "$gt" in condition and not value > condition["$gt"]:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+class FakeHistoryCollection(object):
+
+    def __init__(self) -> None:
+        self.documents: list[dict] = []
+
+    def find(self, query: dict, sort: list = None) -> list[dict]:
+        result = [doc for doc in self.documents if match(doc, query)]
+        for field, direction in reversed(sort or []):
+            result.sort(key=lambda doc: doc[field], reverse=direction == pymongo.DESCENDING)
+        return result
+
+    def find_one(self, query: dict, sort: list = None) -> dict:
+        result = self.find(query, sort)
+        return result[0] if len(result) > 0 else None
+
+
+class DirectWriter(object):
+    # 代替MongoWriteBehind，直接写入假集合
+
+    def insert(self, collection: FakeHistoryCollection, document: dict):
+        collection.documents.append(dict(document))
+
+
+def evolve(rnd: random.Random, positions: list[TraderPosition], t: int) -> list[TraderPosition]:
+    new_positions = []
+    for p in positions:
+        r = rnd.random()
+        if r < 0.15:
+            continue
+        if r < 0.4:
+            p = TraderPosition(symbol=p.symbol, leverage=p.leverage, amount=p.amount * 2,
+                               entry_price=p.entry_price + 1, update_time=t)
+        new_positions.append(p)
+    if rnd.random() < 0.4 or len(new_positions) == 0:
+        opened = TraderPosition(symbol="SYM" + str(rnd.randint(0, 20)) + "USDT", leverage=10,
+                                amount=rnd.choice([-1, 1]) * rnd.randint(1, 5), entry_price=100.0, update_time=t)
+        if opened.type_key() not in [p.type_key() for p in new_positions]:
+            new_positions.append(opened)
+    return new_positions
+
+
+def as_set(positions: list[TraderPosition]) -> set:
+    return set([tuple(p.to_compact()) for p in positions])
+
+
+class PositionHistoryTest(unittest.TestCase):
+    """
+    按时间依次写入仓位变动，同时保存每个时间点的完整快照，检查关键帧+增量重建的结果与快照一致
+    """
+
+    UID = "u1"
+    KEYFRAME_INTERVAL = 4
+
+    def setUp(self) -> None:
+        self.collection = FakeHistoryCollection()
+        self.reader = PositionHistoryReader(self.collection)
+        self.snapshots: list[tuple[float, list[TraderPosition]]] = []
+        self.rnd = random.Random(3)
+
+    def new_writer(self) -> PositionHistoryWriter:
+        return PositionHistoryWriter(DirectWriter(), self.collection, self.KEYFRAME_INTERVAL)
+
+    def write_changes(self, writer: PositionHistoryWriter, positions: list[TraderPosition],
+                      start: int, count: int) -> list[TraderPosition]:
+        for t in range(start, start + count):
+            new_positions = evolve(self.rnd, positions, t)
+            changed, added, removed = TraderPosition.diff_position_list(positions, new_positions)
+            writer.on_diff(self.UID, new_positions, {"changed": changed, "added": added, "removed": removed},
+                           float(t))
+            self.snapshots.append((float(t), new_positions))
+            positions = new_positions
+        return positions
+
+    def keyframe_times(self) -> list[float]:
+        return sorted([doc["t"] for doc in self.collection.documents if doc["k"] == 1])
+
+    def assert_matches_snapshots(self):
+        for t, positions in self.snapshots:
+            self.assertEqual(as_set(self.reader.positions_at(self.UID, t)), as_set(positions), "at " + str(t))
+            # 两次变动之间仍为前一次变动后的仓位
+            self.assertEqual(as_set(self.reader.positions_at(self.UID, t + 0.5)), as_set(positions),
+                             "at " + str(t + 0.5))
+
+    def test_before_first_keyframe(self):
+        writer = self.new_writer()
+        writer.on_new(self.UID, [], 10.0)
+        self.assertIsNone(self.reader.positions_at(self.UID, 9.0))
+        self.assertEqual(self.reader.positions_at(self.UID, 10.0), [])
+
+    def test_keyframe_boundaries_and_between(self):
+        writer = self.new_writer()
+        initial = evolve(self.rnd, [], 0)
+        writer.on_new(self.UID, initial, 0.0)
+        self.snapshots.append((0.0, initial))
+        self.write_changes(writer, initial, 1, 30)
+        keyframes = self.keyframe_times()
+        # 初始关键帧之后每KEYFRAME_INTERVAL次变动一个关键帧
+        self.assertEqual(keyframes, [float(t) for t in range(0, 31, self.KEYFRAME_INTERVAL)])
+        self.assert_matches_snapshots()
+
+    def test_restart_forces_keyframe(self):
+        writer = self.new_writer()
+        initial = evolve(self.rnd, [], 0)
+        writer.on_new(self.UID, initial, 0.0)
+        self.snapshots.append((0.0, initial))
+        positions = self.write_changes(writer, initial, 1, 6)
+        # 重启后写入器不知道距上一个关键帧的变动次数，第一次变动时补写关键帧
+        restarted = self.new_writer()
+        self.write_changes(restarted, positions, 7, 10)
+        keyframes = self.keyframe_times()
+        self.assertIn(7.0, keyframes)
+        self.assertEqual(keyframes, [0.0, 4.0, 7.0, 11.0, 15.0])
+        self.assert_matches_snapshots()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import unittest
+
+from qtr.crawl.binance.futures_umargin.trader_poll_scheduler import TraderPollScheduler
+
+
+class TraderPollSchedulerTest(unittest.TestCase):
+
+    MIN_INTERVAL = 30
+    MAX_STALENESS = 1800
+
+    def setUp(self) -> None:
+        self.scheduler = TraderPollScheduler(self.MIN_INTERVAL, self.MAX_STALENESS, decay=0.3)
+
+    def test_interval_clamp_bounds(self):
+        self.assertEqual(self.scheduler.interval_for(1.0), self.MIN_INTERVAL)
+        # 活跃度不会超过1，即使超过也不低于min_interval
+        self.assertEqual(self.scheduler.interval_for(5.0), self.MIN_INTERVAL)
+        self.assertEqual(self.scheduler.interval_for(0.5), self.MIN_INTERVAL * 2)
+        self.assertEqual(self.scheduler.interval_for(0.0), self.MAX_STALENESS)
+        self.assertEqual(self.scheduler.interval_for(-1.0), self.MAX_STALENESS)
+        self.assertEqual(self.scheduler.interval_for(1e-9), self.MAX_STALENESS)
+        self.assertEqual(self.scheduler.interval_for(self.MIN_INTERVAL / self.MAX_STALENESS), self.MAX_STALENESS)
+
+    def test_activity_ema(self):
+        self.scheduler.sync(["u1"], now=0)
+        self.assertEqual(self.scheduler.pop_due(now=0), ["u1"])
+        self.scheduler.on_polled("u1", False, now=0)
+        self.assertAlmostEqual(self.scheduler.states["u1"].activity, 0.7)
+        self.scheduler.on_polled("u1", True, now=0)
+        self.assertAlmostEqual(self.scheduler.states["u1"].activity, 0.3 + 0.7 * 0.7)
+        state = self.scheduler.states["u1"]
+        self.assertEqual(state.poll_count, 2)
+        self.assertEqual(state.change_count, 1)
+
+    def test_active_trader_polled_at_min_interval(self):
+        self.scheduler.sync(["u1"], now=0)
+        self.scheduler.pop_due(now=0)
+        self.scheduler.on_polled("u1", True, now=100)
+        self.assertEqual(self.scheduler.next_due_time(), 100 + self.MIN_INTERVAL)
+
+    def test_inactive_trader_never_exceeds_max_staleness(self):
+        self.scheduler.sync(["u1"], now=0)
+        now = 0
+        intervals = []
+        for _ in range(100):
+            self.assertEqual(self.scheduler.pop_due(now=now), ["u1"])
+            self.scheduler.on_polled("u1", False, now=now)
+            next_due = self.scheduler.next_due_time()
+            intervals.append(round(next_due - now, 6))
+            now = next_due
+        self.assertEqual(intervals, sorted(intervals))
+        self.assertTrue(all([self.MIN_INTERVAL <= i <= self.MAX_STALENESS for i in intervals]))
+        self.assertEqual(intervals[-1], self.MAX_STALENESS)
+        self.assertEqual(self.scheduler.get_tier("u1"), TraderPollScheduler.TIER_COLD)
+
+    def test_pop_due_does_not_repeat_until_polled(self):
+        self.scheduler.sync(["u1", "u2"], now=0)
+        self.assertEqual(sorted(self.scheduler.pop_due(now=0)), ["u1", "u2"])
+        self.assertEqual(self.scheduler.pop_due(now=10000), [])
+        self.scheduler.on_poll_failed("u1", now=0)
+        self.assertEqual(self.scheduler.pop_due(now=self.MIN_INTERVAL), ["u1"])
+
+    def test_sync_removes_traders(self):
+        self.scheduler.sync(["u1", "u2"], now=0)
+        self.scheduler.sync(["u2"], now=0)
+        self.assertEqual(self.scheduler.pop_due(now=0), ["u2"])
+        self.scheduler.on_polled("u1", True, now=0)
+        self.assertNotIn("u1", self.scheduler.states)
+
+    def test_export_restore_round_trip(self):
+        self.scheduler.sync(["hot", "cold", "inflight"], now=0)
+        self.scheduler.pop_due(now=0)
+        for t in range(0, 300, 30):
+            self.scheduler.on_polled("hot", True, now=t)
+            self.scheduler.on_polled("cold", False, now=t)
+        # inflight已出堆但轮询结果尚未返回
+        exported = self.scheduler.export_state()
+        self.assertIsNone(exported["inflight"][1])
+
+        restored = TraderPollScheduler(self.MIN_INTERVAL, self.MAX_STALENESS, decay=0.3)
+        restored.restore_state(exported, now=500)
+        restored_export = restored.export_state()
+        for uid in ("hot", "cold"):
+            self.assertEqual(restored_export[uid], exported[uid])
+            self.assertEqual(restored.get_tier(uid), self.scheduler.get_tier(uid))
+        # 正在轮询的带单人恢复后立即到期
+        self.assertEqual(restored_export["inflight"][1], 500)
+        self.assertEqual(restored.pop_due(now=500), ["hot", "inflight"])
+        self.assertEqual(restored.pop_due(now=exported["cold"][1]), ["cold"])
+        # 恢复后sync不会重置已恢复的状态
+        restored.sync(["hot", "cold", "inflight"], now=600)
+        self.assertEqual(restored.states["cold"].activity, exported["cold"][0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+import random
+import unittest
+
+from qtr.crawl.binance.futures_umargin.trader_position import TraderPosition
+
+
+def legacy_diff_position_list(current_list: list[TraderPosition], new_list: list[TraderPosition]):
+    # 改为哈希比对之前的实现，作为比对结果的基准
+    current_positions = current_list[0: len(current_list)]
+    changed_list = []
+    add_list = []
+    for pos in new_list:
+        cp = next((p for p in current_positions if p.is_same_type(pos)), None)
+        if cp is not None:
+            if not cp.is_same_position(pos):
+                changed_list.append((cp, pos))
+            current_positions.remove(cp)
+        else:
+            add_list.append(pos)
+    return changed_list, add_list, list(current_positions)
+
+
+def make_position(symbol: str, amount: float, leverage: int = 10, entry_price: float = 100.0) -> TraderPosition:
+    return TraderPosition(symbol=symbol, leverage=leverage, amount=amount, entry_price=entry_price,
+                          update_time=1660000000000)
+
+
+def random_lists(rnd: random.Random, count: int) -> tuple[list[TraderPosition], list[TraderPosition]]:
+    # 币种很少，保证出现重复的(symbol, position_side)
+    symbols = ["BTCUSDT", "ETHUSDT", "BNBUSDT"]
+    current = [make_position(rnd.choice(symbols), rnd.choice([-1, 1]) * rnd.randint(1, 3))
+               for _ in range(count)]
+    new = []
+    for p in current:
+        r = rnd.random()
+        if r < 0.2:
+            continue
+        if r < 0.5:
+            new.append(make_position(p.symbol, p.amount * 2))
+        else:
+            new.append(make_position(p.symbol, p.amount))
+    new.extend([make_position(rnd.choice(symbols), rnd.choice([-1, 1])) for _ in range(rnd.randint(0, 3))])
+    rnd.shuffle(new)
+    return current, new
+
+
+class DiffPositionListTest(unittest.TestCase):
+
+    def assert_same_as_legacy(self, current: list[TraderPosition], new: list[TraderPosition]):
+        expected = legacy_diff_position_list(current, new)
+        actual = TraderPosition.diff_position_list(current, new)
+        self.assertEqual(expected, actual)
+
+    def test_reordered_lists_are_unchanged(self):
+        current = [make_position("BTCUSDT", 1), make_position("ETHUSDT", -2), make_position("BNBUSDT", 3)]
+        new = [make_position("BNBUSDT", 3), make_position("BTCUSDT", 1), make_position("ETHUSDT", -2)]
+        self.assertEqual(TraderPosition.diff_position_list(current, new), ([], [], []))
+        self.assert_same_as_legacy(current, new)
+
+    def test_added_changed_removed(self):
+        current = [make_position("BTCUSDT", 1), make_position("ETHUSDT", -2)]
+        new = [make_position("SOLUSDT", 5), make_position("BTCUSDT", 2)]
+        changed, added, removed = TraderPosition.diff_position_list(current, new)
+        self.assertEqual(changed, [(current[0], new[1])])
+        self.assertEqual(added, [new[0]])
+        self.assertEqual(removed, [current[1]])
+
+    def test_long_and_short_of_same_symbol_are_different_types(self):
+        current = [make_position("BTCUSDT", 1)]
+        new = [make_position("BTCUSDT", -1)]
+        changed, added, removed = TraderPosition.diff_position_list(current, new)
+        self.assertEqual(changed, [])
+        self.assertEqual(added, new)
+        self.assertEqual(removed, current)
+
+    def test_duplicate_types_match_in_order(self):
+        current = [make_position("BTCUSDT", 1, leverage=5), make_position("BTCUSDT", 2, leverage=10),
+                   make_position("BTCUSDT", 3, leverage=20)]
+        new = [make_position("BTCUSDT", 2, leverage=10), make_position("BTCUSDT", 1, leverage=5)]
+        changed, added, removed = TraderPosition.diff_position_list(current, new)
+        # 同类型的仓位按出现顺序一一匹配，多出的旧仓位视为删除
+        self.assertEqual(changed, [(current[0], new[0]), (current[1], new[1])])
+        self.assertEqual(added, [])
+        self.assertEqual(removed, [current[2]])
+        self.assert_same_as_legacy(current, new)
+
+    def test_matches_legacy_on_both_paths(self):
+        rnd = random.Random(7)
+        limit = TraderPosition.DIFF_LINEAR_LIMIT
+        for count in [0, 1, 2, 5, limit, limit + 1, 40, 200]:
+            for _ in range(50):
+                current, new = random_lists(rnd, count)
+                self.assert_same_as_legacy(current, new)
+
+    def test_linear_and_hashed_paths_agree(self):
+        rnd = random.Random(11)
+        for count in [1, 3, 8, 30]:
+            for _ in range(50):
+                current, new = random_lists(rnd, count)
+                linear = TraderPosition.diff_position_list_linear(current, new)
+                limit = TraderPosition.DIFF_LINEAR_LIMIT
+                try:
+                    TraderPosition.DIFF_LINEAR_LIMIT = -1
+                    hashed = TraderPosition.diff_position_list(current, new)
+                finally:
+                    TraderPosition.DIFF_LINEAR_LIMIT = limit
+                self.assertEqual(linear, hashed)
+
+
+if __name__ == "__main__":
+    unittest.main()
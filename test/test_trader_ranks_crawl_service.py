@@ -0,0 +1,81 @@
+import unittest
+
+from qtr.crawl.binance.futures_umargin.trader_ranks_crawl_service import TraderRanksCrawlService
+from qtr.utils.metrics import MetricsRegistry
+
+WAF_PAGE = b"<html><head><title>403 Forbidden</title></head><body>Request blocked</body></html>"
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code: int, content: bytes) -> None:
+        self.status_code = status_code
+        self.content = content
+
+
+class FakeHttpClient(object):
+    # 所有请求都返回非json的403页面，与币安waf拦截时一致
+
+    def __init__(self) -> None:
+        self.requests: list[str] = []
+
+    def post(self, url: str, payload: dict) -> FakeResponse:
+        self.requests.append(url)
+        return FakeResponse(403, WAF_PAGE)
+
+
+class FakeCollection(object):
+
+    def delete_many(self, query: dict):
+        pass
+
+
+class FakeController(object):
+
+    def __init__(self) -> None:
+        self.metrics = MetricsRegistry()
+        self.http_client = FakeHttpClient()
+
+    def on_new_traders(self, uids: list[str]):
+        pass
+
+    def on_trader_close_share(self, uid: str):
+        pass
+
+
+class NonJsonResponseTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.controller = FakeController()
+        self.service = TraderRanksCrawlService(self.controller)
+        self.service.trader_rank_summary_col = FakeCollection()
+
+    def assert_lock_released(self):
+        self.assertTrue(self.service.task_lock.acquire(blocking=False))
+        self.service.task_lock.release()
+
+    def test_rank_fetch_survives_html_403(self):
+        self.service.fetch_trader_ranks()
+        self.assertGreater(len(self.controller.http_client.requests), 0)
+        self.assertEqual(self.service.last_rank_count, 0)
+        self.assert_lock_released()
+
+    def test_info_fetch_survives_html_403(self):
+        self.service.all_crawl_trader_ids.add_all(["u1", "u2"])
+        self.service.fetch_trader_info()
+        # 每个带单人请求战绩与基本信息各一次
+        self.assertEqual(len(self.controller.http_client.requests), 4)
+        self.assertEqual(self.service.last_performance_count, 2)
+        self.assert_lock_released()
+
+    def test_lock_released_on_unexpected_error(self):
+        def fail(url: str, payload: dict):
+            raise RuntimeError("unexpected")
+        self.controller.http_client.post = fail
+        with self.assertRaises(RuntimeError):
+            self.service.fetch_trader_ranks()
+        self.assert_lock_released()
+
+
+if __name__ == "__main__":
+    unittest.main()